@@ -3,6 +3,9 @@
 import dataclasses
 from typing import List, Optional, Dict
 
+# Fields stored by AgentSessionManager under their own Redis key and loaded on first access
+LAZY_FIELDS = ('chat_history', 'thought_history')
+
 @dataclasses.dataclass
 class AgentDataModel:
     name: str
@@ -13,10 +16,26 @@ class AgentDataModel:
     kwargs: Dict = dataclasses.field(default_factory=dict)
     is_interactive: bool = False
     json_chain: Optional[dict] = None
+    chain_id: Optional[str] = None #set when the json_chain is planned, tags the checkpoints of its agents
     state: str = "idle" #idle, running_chain, waiting_for_user_answer, completed
     agent_chain_step: int = 0
-    sequential_agent_step: int = 0
-    memory_logs: List[str] = dataclasses.field(default_factory=list)
+    pending_question_agent: Optional[str] = None
+    pending_questions: List[str] = dataclasses.field(default_factory=list) #ids (<agent_nickname>:<index>) of the questions of the last questionnaire
+    chain_stats: Optional[Dict] = None
     thought_history: List[str] = dataclasses.field(default_factory=list)
     final_answer: Optional[str] = None
     start_system_prompt: str = dataclasses.field(default_factory=str)
+    version: int = 0 #number of saves of the session, used to detect concurrent turns
+    saved_observations: List[str] = dataclasses.field(default_factory=list) #agents whose observation is stored in the session observations hash
+    llm_cost_usd: float = 0.0 #estimated cost of the LLM calls of the session, checked against its cost budget
+    field_digests: Dict[str, str] = dataclasses.field(default_factory=dict) #digests of the lazy fields as last saved, to skip unchanged ones
+    speculative_agents: List[str] = dataclasses.field(default_factory=list) #agents left running in the background when the turn was saved
+
+    def __getattr__(self, name):
+        # only called for attributes missing from the instance, i.e. lazy fields not loaded yet
+        field_loader = self.__dict__.get('field_loader')
+        if name in LAZY_FIELDS and field_loader is not None:
+            value = field_loader(name)
+            setattr(self, name, value)
+            return value
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
@@ -1,17 +1,91 @@
 # session_manager.py
 
 import redis
-import pickle
+import redis.asyncio
+import asyncio
+import dataclasses
+import hashlib
+import os
 import threading
+import weakref
 import logging
 import traceback
-from agent_data_model import AgentDataModel
+from typing import Dict, List
+from agent_data_model import AgentDataModel, LAZY_FIELDS
+from session_codec import SessionCodec
+from telemetry import span, set_span_attributes
+from session_logs import SESSION_LOG_MAX_ENTRIES
+
+SESSION_CODEC = os.getenv("SESSION_CODEC", "json")
+SESSION_COMPRESSION = os.getenv("SESSION_COMPRESSION", "zlib")
+SESSION_COMPRESSION_THRESHOLD = int(os.getenv("SESSION_COMPRESSION_THRESHOLD", 1024))
+# expiry of sessions in the middle of a chain, and of sessions whose chain is completed (0 = never)
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 7 * 24 * 3600))
+SESSION_COMPLETED_TTL_SECONDS = int(os.getenv("SESSION_COMPLETED_TTL_SECONDS", 24 * 3600))
+# a chain whose lease is not renewed (by a checkpoint) for this long is considered interrupted;
+# it must exceed the longest agent call
+CHAIN_LEASE_SECONDS = int(os.getenv("CHAIN_LEASE_SECONDS", 300))
+# hash of the sessions saved in the middle of a chain, {session_id: recovery attempts}
+RUNNING_CHAINS_KEY = 'running_chains'
+
+
+# Connection pools shared by every AgentSessionManager of the process, keyed by
+# (host, port, db). Async pools are bound to an event loop, so they are kept per loop,
+# and dropped with it.
+_pools = {}
+_async_pools = weakref.WeakKeyDictionary()
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(redis_host, redis_port, db):
+    with _pools_lock:
+        key = (redis_host, redis_port, db)
+        if key not in _pools:
+            _pools[key] = redis.ConnectionPool(host=redis_host, port=redis_port, db=db)
+        return _pools[key]
+
+
+def get_async_connection_pool(redis_host, redis_port, db):
+    pools = _async_pools.setdefault(asyncio.get_running_loop(), {})
+    key = (redis_host, redis_port, db)
+    if key not in pools:
+        pools[key] = redis.asyncio.ConnectionPool(host=redis_host, port=redis_port, db=db)
+    return pools[key]
+
+
+class SessionConflictError(Exception):
+    """
+    Raised when a session was saved by another turn after it was loaded by this one.
+    """
+
+
+class StaleHistoryError(SessionConflictError):
+    """
+    Raised when a delta turn was built on another chat history than the one stored in the session.
+    """
 
 
 class AgentSessionManager:
-    def __init__(self, redis_host='redis', redis_port=6379, db=0):
-        self.redis = redis.StrictRedis(host=redis_host, port=redis_port, db=db)
-        self.lock = threading.Lock()
+    def __init__(
+            self,
+            redis_host='redis',
+            redis_port=6379,
+            db=0,
+            codec: SessionCodec = None,
+            ttl_seconds: int = SESSION_TTL_SECONDS,
+            completed_ttl_seconds: int = SESSION_COMPLETED_TTL_SECONDS
+    ):
+        self.codec = codec or SessionCodec(
+            codec=SESSION_CODEC,
+            compression=SESSION_COMPRESSION,
+            compression_threshold=SESSION_COMPRESSION_THRESHOLD
+        )
+        self.ttl_seconds = ttl_seconds
+        self.completed_ttl_seconds = completed_ttl_seconds
+        self.redis_host = redis_host
+        self.redis_port = redis_port
+        self.db = db
+        self.redis = redis.StrictRedis(connection_pool=get_connection_pool(redis_host, redis_port, db))
         logging.basicConfig(
             level=logging.INFO,
             format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
@@ -19,29 +93,366 @@ class AgentSessionManager:
         )
         self.logger = logging.getLogger(__name__)
 
+    @property
+    def async_redis(self):
+        return redis.asyncio.StrictRedis(
+            connection_pool=get_async_connection_pool(self.redis_host, self.redis_port, self.db)
+        )
+
     def get_session_key(self, session_id):
         return f"session:{session_id}"
 
+    def get_version_key(self, session_id):
+        return f"session_version:{session_id}"
+
+    def get_field_key(self, session_id, field):
+        # observations, agent checkpoints, chain lease, speculation record, logs and the LAZY_FIELDS are stored apart from the session
+        return f"session_{field}:{session_id}"
+
+    def build_data_model(self, session_id, serialized_data, version):
+        if serialized_data:
+            self.logger.info(f"Loading existing session for session_id: {session_id}")
+            fields = self.codec.decode_fields(serialized_data)
+            data_model = AgentDataModel(**fields)
+            for name in LAZY_FIELDS:
+                if name not in fields:
+                    # stored under its own key, loaded by AgentDataModel.__getattr__ on first access
+                    delattr(data_model, name)
+            data_model.field_loader = lambda name: self.load_field(session_id, name)
+
+        else:
+            self.logger.info(f"No existing session found. Creating new session for session_id: {session_id}")
+            # Create a new DataModel
+            data_model = AgentDataModel(
+                name="AgentSInteractive",
+                session_id=session_id
+            )
+        data_model.version = int(version or 0)
+        return data_model
+
+    def queue_session_writes(self, pipe, data_model: AgentDataModel):
+        """
+        Queues on a MULTI pipeline the writes of a session, skipping the observations and
+        the lazy fields that did not change since they were loaded. Returns the function
+        that records the saved state once the pipeline has been executed.
+        """
+        session_id = data_model.session_id
+        ttl = self.get_ttl(data_model)
+        agents = data_model.json_chain['agents'] if data_model.json_chain else []
+
+        # observations: one hash field per agent, written once when the agent completes
+        observations_key = self.get_field_key(session_id, 'observations')
+        nicknames = [agent['agent_nickname'] for agent in agents]
+        new_observations = {
+            agent['agent_nickname']: self.codec.encode_value(agent['observation'])
+            for agent in agents
+            if 'observation' in agent and agent['agent_nickname'] not in data_model.saved_observations
+        }
+        stale_observations = [nickname for nickname in data_model.saved_observations if nickname not in nicknames]
+        if not agents:
+            pipe.delete(observations_key, self.get_field_key(session_id, 'checkpoints'))
+        elif stale_observations:
+            pipe.hdel(observations_key, *stale_observations)
+        if new_observations:
+            pipe.hset(observations_key, mapping=new_observations)
+        saved_observations = [
+            nickname for nickname in data_model.saved_observations if nickname not in stale_observations
+        ] + list(new_observations)
+
+        # lazy fields: written only when loaded or assigned, and changed
+        field_digests = dict(data_model.field_digests)
+        lazy_bytes = 0
+        for name in LAZY_FIELDS:
+            if name not in data_model.__dict__:
+                continue
+            payload = self.codec.encode_value(data_model.__dict__[name])
+            digest = hashlib.sha1(payload).hexdigest()
+            # a missing key loads as an empty list
+            saved_digest = field_digests.get(name) or hashlib.sha1(self.codec.encode_value([])).hexdigest()
+            if saved_digest != digest:
+                pipe.set(self.get_field_key(session_id, name), payload)
+                field_digests[name] = digest
+                lazy_bytes += len(payload)
+
+        # logs: append the entries logged since the last save to the capped stream
+        log_entries, consume_logs = self.queue_logs(pipe, data_model)
+        appended_bytes = sum(len(value) for value in new_observations.values()) + sum(
+            len(entry.encode('utf-8')) for entry in log_entries
+        )
+
+        fields = {
+            field.name: data_model.__dict__[field.name] for field in dataclasses.fields(AgentDataModel)
+            if field.name not in LAZY_FIELDS
+        }
+        if data_model.json_chain:
+            fields['json_chain'] = {
+                **data_model.json_chain,
+                # list() copies the items at once: agents started early may still be adding their observation
+                'agents': [{k: v for k, v in list(agent.items()) if k != 'observation'} for agent in agents]
+            }
+        fields['saved_observations'] = saved_observations
+        fields['field_digests'] = field_digests
+        fields['version'] = data_model.version + 1
+        session_payload = self.codec.encode_fields(fields)
+        pipe.set(self.get_session_key(session_id), session_payload, ex=ttl)
+        set_span_attributes(payload_bytes=len(session_payload) + lazy_bytes + appended_bytes)
+        pipe.set(self.get_version_key(session_id), data_model.version + 1, ex=ttl)
+        # a session saved in the middle of a chain is leased to this turn until its next save
+        if data_model.state == 'running_chain':
+            pipe.set(self.get_field_key(session_id, 'lease'), 1, ex=CHAIN_LEASE_SECONDS)
+            pipe.hsetnx(RUNNING_CHAINS_KEY, session_id, 0)
+        else:
+            pipe.delete(self.get_field_key(session_id, 'lease'))
+            pipe.hdel(RUNNING_CHAINS_KEY, session_id)
+        # the agents left running in the background, waited for by the next turn until `end_speculation`
+        if data_model.speculative_agents:
+            pipe.set(self.get_field_key(session_id, 'speculation'), data_model.chain_id, ex=CHAIN_LEASE_SECONDS)
+        for name in ('observations', 'checkpoints', 'logs') + LAZY_FIELDS:
+            if ttl:
+                pipe.expire(self.get_field_key(session_id, name), ttl)
+            else:
+                pipe.persist(self.get_field_key(session_id, name))
+
+        def on_saved():
+            data_model.version += 1
+            data_model.saved_observations = saved_observations
+            data_model.field_digests = field_digests
+            consume_logs()
+        return on_saved
+
+    def queue_logs(self, pipe, data_model: AgentDataModel):
+        """
+        Queues the log entries of the session logged since its last save. Returns them, and
+        the function that drops them from the buffer once the pipeline has been executed.
+        """
+        log_buffer = data_model.__dict__.get('log_buffer')
+        if not log_buffer:
+            return [], lambda: None
+        log_entries, log_seq = log_buffer.snapshot()
+        for entry in log_entries:
+            pipe.xadd(
+                self.get_field_key(data_model.session_id, 'logs'), {'entry': entry},
+                maxlen=SESSION_LOG_MAX_ENTRIES, approximate=True
+            )
+        return log_entries, lambda: log_buffer.consume(log_seq)
+
+    def load_field(self, session_id, name):
+        serialized_data = self.redis.get(self.get_field_key(session_id, name))
+        return self.codec.decode_value(serialized_data) if serialized_data else []
+
+    async def load_field_async(self, data_model: AgentDataModel, name):
+        """
+        Loads a lazy field of the data model, if not loaded yet, without blocking the event loop.
+        """
+        if name not in data_model.__dict__:
+            serialized_data = await self.async_redis.get(self.get_field_key(data_model.session_id, name))
+            setattr(data_model, name, self.codec.decode_value(serialized_data) if serialized_data else [])
+        return data_model.__dict__[name]
+
+    def decode_observations(self, nicknames: List[str], values) -> Dict[str, str]:
+        return {
+            nickname: self.codec.decode_value(value)
+            for nickname, value in zip(nicknames, values) if value is not None
+        }
+
+    def load_observations(self, session_id, nicknames: List[str]) -> Dict[str, str]:
+        """
+        Loads the saved observations of the given agents.
+        """
+        values = self.redis.hmget(self.get_field_key(session_id, 'observations'), nicknames)
+        return self.decode_observations(nicknames, values)
+
+    async def load_observations_async(self, session_id, nicknames: List[str]) -> Dict[str, str]:
+        """
+        Same as `load_observations`, without blocking the event loop on Redis I/O.
+        """
+        values = await self.async_redis.hmget(self.get_field_key(session_id, 'observations'), nicknames)
+        return self.decode_observations(nicknames, values)
+
+    def queue_agent_checkpoint(self, pipe, data_model: AgentDataModel, nickname: str, observation: str):
+        key = self.get_field_key(data_model.session_id, 'checkpoints')
+        value = self.codec.encode_value({'chain_id': data_model.chain_id, 'observation': observation})
+        ttl = self.get_ttl(data_model)
+        pipe.hset(key, nickname, value)
+        if ttl:
+            pipe.expire(key, ttl)
+        # renews the lease of the chain, if the turn holds one, or its speculation record
+        pipe.expire(self.get_field_key(data_model.session_id, 'lease'), CHAIN_LEASE_SECONDS)
+        pipe.expire(self.get_field_key(data_model.session_id, 'speculation'), CHAIN_LEASE_SECONDS)
+
+    def save_agent_checkpoint(self, data_model: AgentDataModel, nickname: str, observation: str):
+        """
+        Stores the observation of an agent as soon as it completes, without a new session
+        version: the next turn of the same chain takes it over (see `load_agent_checkpoints`),
+        whether the turn was interrupted or the agent ran in the background after it was saved.
+        """
+        with self.redis.pipeline() as pipe:
+            self.queue_agent_checkpoint(pipe, data_model, nickname, observation)
+            pipe.execute()
+
+    async def save_agent_checkpoint_async(self, data_model: AgentDataModel, nickname: str, observation: str):
+        async with self.async_redis.pipeline() as pipe:
+            self.queue_agent_checkpoint(pipe, data_model, nickname, observation)
+            await pipe.execute()
+
+    def decode_agent_checkpoints(self, chain_id: str, values: Dict) -> Dict[str, str]:
+        # entries of an earlier chain of the session are ignored
+        observations = {}
+        for nickname, value in values.items():
+            entry = self.codec.decode_value(value)
+            if entry['chain_id'] == chain_id:
+                observations[nickname.decode('utf-8')] = entry['observation']
+        return observations
+
+    def load_agent_checkpoints(self, data_model: AgentDataModel) -> Dict[str, str]:
+        """
+        Loads the observations checkpointed for the chain of the session since its last save.
+        """
+        values = self.redis.hgetall(self.get_field_key(data_model.session_id, 'checkpoints'))
+        return self.decode_agent_checkpoints(data_model.chain_id, values)
+
+    async def load_agent_checkpoints_async(self, data_model: AgentDataModel) -> Dict[str, str]:
+        values = await self.async_redis.hgetall(self.get_field_key(data_model.session_id, 'checkpoints'))
+        return self.decode_agent_checkpoints(data_model.chain_id, values)
+
+    def speculation_running(self, data_model: AgentDataModel) -> bool:
+        """
+        Whether agents of the chain of the session still run in the background after the turn
+        that saved it. The record expires if their process dies without renewing it.
+        """
+        chain_id = self.redis.get(self.get_field_key(data_model.session_id, 'speculation'))
+        return chain_id is not None and chain_id.decode('utf-8') == data_model.chain_id
+
+    async def speculation_running_async(self, data_model: AgentDataModel) -> bool:
+        chain_id = await self.async_redis.get(self.get_field_key(data_model.session_id, 'speculation'))
+        return chain_id is not None and chain_id.decode('utf-8') == data_model.chain_id
+
+    def queue_end_speculation(self, pipe, data_model: AgentDataModel, cost_usd: float):
+        session_id = data_model.session_id
+        pipe.delete(self.get_field_key(session_id, 'speculation'))
+        if cost_usd:
+            pipe.incrbyfloat(self.get_field_key(session_id, 'speculation_cost'), cost_usd)
+            pipe.expire(self.get_field_key(session_id, 'speculation_cost'), self.get_ttl(data_model) or CHAIN_LEASE_SECONDS)
+        return self.queue_logs(pipe, data_model)[1]
+
+    def end_speculation(self, data_model: AgentDataModel, cost_usd: float):
+        """
+        Records the end of the agents run in the background: their LLM cost, taken over by
+        the next turn with `take_speculation_cost`, and the entries they logged.
+        """
+        with self.redis.pipeline() as pipe:
+            consume_logs = self.queue_end_speculation(pipe, data_model, cost_usd)
+            pipe.execute()
+        consume_logs()
+
+    async def end_speculation_async(self, data_model: AgentDataModel, cost_usd: float):
+        async with self.async_redis.pipeline() as pipe:
+            consume_logs = self.queue_end_speculation(pipe, data_model, cost_usd)
+            await pipe.execute()
+        consume_logs()
+
+    def take_speculation_cost(self, session_id) -> float:
+        with self.redis.pipeline() as pipe:
+            pipe.get(self.get_field_key(session_id, 'speculation_cost'))
+            pipe.delete(self.get_field_key(session_id, 'speculation_cost'))
+            cost, _ = pipe.execute()
+        return float(cost or 0)
+
+    async def take_speculation_cost_async(self, session_id) -> float:
+        async with self.async_redis.pipeline() as pipe:
+            pipe.get(self.get_field_key(session_id, 'speculation_cost'))
+            pipe.delete(self.get_field_key(session_id, 'speculation_cost'))
+            cost, _ = await pipe.execute()
+        return float(cost or 0)
+
+    def lease_error(self, session_id) -> SessionConflictError:
+        return SessionConflictError(f"The chain of session {session_id} is still running in another turn")
+
+    def acquire_chain_lease(self, session_id):
+        """
+        Takes over the chain of a session saved in the middle of it. Fails with
+        SessionConflictError while the turn running it still renews its lease.
+        """
+        if not self.redis.set(self.get_field_key(session_id, 'lease'), 1, nx=True, ex=CHAIN_LEASE_SECONDS):
+            raise self.lease_error(session_id)
+
+    async def acquire_chain_lease_async(self, session_id):
+        if not await self.async_redis.set(self.get_field_key(session_id, 'lease'), 1, nx=True, ex=CHAIN_LEASE_SECONDS):
+            raise self.lease_error(session_id)
+
+    def release_chain_lease(self, session_id):
+        self.redis.delete(self.get_field_key(session_id, 'lease'))
+
+    async def release_chain_lease_async(self, session_id):
+        await self.async_redis.delete(self.get_field_key(session_id, 'lease'))
+
+    def queue_abandon_chain(self, pipe, session_id):
+        pipe.delete(self.get_field_key(session_id, 'lease'))
+        pipe.hdel(RUNNING_CHAINS_KEY, session_id)
+
+    def abandon_chain(self, session_id):
+        """
+        Releases the lease of a chain whose turn was cancelled, and leaves it out of the
+        recovery sweep: it still resumes if a request sends its message again.
+        """
+        with self.redis.pipeline() as pipe:
+            self.queue_abandon_chain(pipe, session_id)
+            pipe.execute()
+
+    async def abandon_chain_async(self, session_id):
+        async with self.async_redis.pipeline() as pipe:
+            self.queue_abandon_chain(pipe, session_id)
+            await pipe.execute()
+
+    def interrupted_chains(self) -> List[str]:
+        """
+        The sessions saved in the middle of a chain whose lease has expired.
+        """
+        session_ids = [session_id.decode('utf-8') for session_id in self.redis.hkeys(RUNNING_CHAINS_KEY)]
+        with self.redis.pipeline(transaction=False) as pipe:
+            for session_id in session_ids:
+                pipe.exists(self.get_field_key(session_id, 'lease'))
+            leased = pipe.execute()
+        return [session_id for session_id, exists in zip(session_ids, leased) if not exists]
+
+    def decode_logs(self, entries) -> List[str]:
+        # XREVRANGE returns the newest first
+        return [fields[b'entry'].decode('utf-8') for _, fields in reversed(entries)]
+
+    def load_logs(self, session_id, count: int = 200) -> List[str]:
+        """
+        Loads the last `count` log entries saved for the session, oldest first.
+        """
+        return self.decode_logs(self.redis.xrevrange(self.get_field_key(session_id, 'logs'), count=count))
+
+    async def load_logs_async(self, session_id, count: int = 200) -> List[str]:
+        return self.decode_logs(await self.async_redis.xrevrange(self.get_field_key(session_id, 'logs'), count=count))
+
+    def get_ttl(self, data_model: AgentDataModel):
+        # the chain is cleared by reset_to_init_data_model once the Aggregator has answered
+        ttl = self.completed_ttl_seconds if data_model.json_chain is None else self.ttl_seconds
+        return ttl or None
+
+    def check_version(self, data_model: AgentDataModel, stored_version):
+        stored_version = int(stored_version or 0)
+        if stored_version != data_model.version:
+            raise SessionConflictError(
+                f"Session {data_model.session_id} was saved by another turn "
+                f"(loaded version {data_model.version}, stored version {stored_version})"
+            )
+
     def load_session(self, session_id):
         """
-        Load (unpickle) the user's DataModel from Redis.
+        Load (decode) the user's DataModel from Redis, together with its version.
         If not found, create a new DataModel.
         """
-        with self.lock:
+        with span('session_load', session_id=session_id):
             try:
-                serialized_data = self.redis.get(self.get_session_key(session_id))
-                if serialized_data:
-                    self.logger.info(f"Loading existing session for session_id: {session_id}")
-                    data_model = pickle.loads(serialized_data)
-
-                else:
-                    self.logger.info(f"No existing session found. Creating new session for session_id: {session_id}")
-                    # Create a new DataModel
-                    data_model = AgentDataModel(
-                        name="AgentSInteractive",
-                        session_id=session_id
-                    )
-                return data_model
+                serialized_data, version = self.redis.mget(
+                    self.get_session_key(session_id), self.get_version_key(session_id)
+                )
+                set_span_attributes(payload_bytes=len(serialized_data or b''))
+                return self.build_data_model(session_id, serialized_data, version)
             except Exception as e:
                 self.logger.error("Error loading session:")
                 self.logger.error(traceback.format_exc())
@@ -49,13 +460,71 @@ class AgentSessionManager:
 
     def save_session(self, data_model: AgentDataModel):
         """
-        Serialize (pickle) the DataModel and store it in Redis.
+        Serialize (encode) the DataModel and store it in Redis, with the idle or completed TTL.
+        Observations, memory logs and the lazy fields are written to their own keys, and only
+        when they changed.
+        The save is optimistic: it fails with SessionConflictError if another turn
+        of the same session saved it since it was loaded.
         """
-        with self.lock:
+        with span('session_save', session_id=data_model.session_id):
+            version_key = self.get_version_key(data_model.session_id)
             try:
-                serialized_data = pickle.dumps(data_model)
-                self.redis.set(self.get_session_key(data_model.session_id), serialized_data)
+                with self.redis.pipeline() as pipe:
+                    pipe.watch(version_key)
+                    self.check_version(data_model, pipe.get(version_key))
+                    pipe.multi()
+                    on_saved = self.queue_session_writes(pipe, data_model)
+                    pipe.execute()
+                on_saved()
                 self.logger.info(f"Session saved for session_id: {data_model.session_id}")
+            except SessionConflictError as e:
+                self.logger.warning(f"Session not saved: {e}")
+                raise e
+            except redis.WatchError:
+                self.logger.warning(f"Session not saved: {data_model.session_id} was saved by another turn")
+                raise SessionConflictError(f"Session {data_model.session_id} was saved by another turn")
+            except Exception as e:
+                self.logger.error("Error saving session:")
+                self.logger.error(traceback.format_exc())
+                raise e
+
+    async def load_session_async(self, session_id):
+        """
+        Same as `load_session`, without blocking the event loop on Redis I/O.
+        """
+        with span('session_load', session_id=session_id):
+            try:
+                serialized_data, version = await self.async_redis.mget(
+                    self.get_session_key(session_id), self.get_version_key(session_id)
+                )
+                set_span_attributes(payload_bytes=len(serialized_data or b''))
+                return self.build_data_model(session_id, serialized_data, version)
+            except Exception as e:
+                self.logger.error("Error loading session:")
+                self.logger.error(traceback.format_exc())
+                raise e
+
+    async def save_session_async(self, data_model: AgentDataModel):
+        """
+        Same as `save_session`, without blocking the event loop on Redis I/O.
+        """
+        with span('session_save', session_id=data_model.session_id):
+            version_key = self.get_version_key(data_model.session_id)
+            try:
+                async with self.async_redis.pipeline() as pipe:
+                    await pipe.watch(version_key)
+                    self.check_version(data_model, await pipe.get(version_key))
+                    pipe.multi()
+                    on_saved = self.queue_session_writes(pipe, data_model)
+                    await pipe.execute()
+                on_saved()
+                self.logger.info(f"Session saved for session_id: {data_model.session_id}")
+            except SessionConflictError as e:
+                self.logger.warning(f"Session not saved: {e}")
+                raise e
+            except redis.WatchError:
+                self.logger.warning(f"Session not saved: {data_model.session_id} was saved by another turn")
+                raise SessionConflictError(f"Session {data_model.session_id} was saved by another turn")
             except Exception as e:
                 self.logger.error("Error saving session:")
                 self.logger.error(traceback.format_exc())
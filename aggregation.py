@@ -0,0 +1,88 @@
+# aggregation.py
+
+import os
+from typing import Dict, List, Optional
+
+# chains with at least this many subtask agents are aggregated as a tree (0 = always one Aggregator call)
+AGGREGATION_TREE_MIN_AGENTS = int(os.getenv("AGGREGATION_TREE_MIN_AGENTS", 0))
+# inputs of every intermediate synthesis, and most inputs of the final Aggregator
+AGGREGATION_FAN_IN = int(os.getenv("AGGREGATION_FAN_IN", 4))
+# complexity tier of the model_router for the intermediate syntheses
+AGGREGATION_NODE_COMPLEXITY = os.getenv("AGGREGATION_NODE_COMPLEXITY", "medium")
+
+
+class AggregationTree:
+    """
+    Tree-reduce plan of the Aggregator of a wide chain. The subtask agents are grouped
+    `fan_in` at a time into synthesis nodes, the nodes again into higher level nodes, until
+    at most `fan_in` inputs are left for the final Aggregator. The nodes are run by the
+    ChainScheduler as agents whose `input_from_agents` are their group, so a synthesis starts
+    as soon as the agents of its group are done.
+    """
+
+    def __init__(self, leaves: List[str], aggregator_nickname: str, fan_in: int = AGGREGATION_FAN_IN):
+        fan_in = max(fan_in, 2)
+        self.nodes = []
+        self.covers = {nickname: [nickname] for nickname in leaves}
+        level = 1
+        current = list(leaves)
+        while len(current) > fan_in:
+            next_level = []
+            for index in range(0, len(current), fan_in):
+                group = current[index:index + fan_in]
+                if len(group) == 1:
+                    next_level.append(group[0])
+                    continue
+                nickname = f"{aggregator_nickname}/{level}.{index // fan_in}"
+                self.covers[nickname] = [leaf for member in group for leaf in self.covers[member]]
+                self.nodes.append({
+                    'agent_nickname': nickname,
+                    'agent_llm_prompt': f"Synthesis of the observations of {', '.join(group)}",
+                    'input_from_agents': group,
+                    'complexity': AGGREGATION_NODE_COMPLEXITY,
+                    'aggregation_level': level
+                })
+                next_level.append(nickname)
+            current = next_level
+            level += 1
+        self.top = current
+        self.by_nickname = {node['agent_nickname']: node for node in self.nodes}
+
+    def is_node(self, agent: Dict) -> bool:
+        return agent['agent_nickname'] in self.by_nickname
+
+    def inputs(self, nicknames: List[str], observations: Dict[str, str]) -> List[Dict]:
+        """
+        The inputs of a node or of the final Aggregator that have an observation, as
+        {agent_nickname, agent_llm_prompt, input_from_agents, observation}. A node without an
+        observation (it failed) is replaced by its own inputs.
+        """
+        entries = []
+        for nickname in nicknames:
+            node = self.by_nickname.get(nickname)
+            if node is None:
+                if nickname in observations:
+                    entries.append({'agent_nickname': nickname, 'observation': observations[nickname]})
+            elif 'observation' in node:
+                entries.append({
+                    'agent_nickname': nickname, 'agent_llm_prompt': node['agent_llm_prompt'],
+                    'input_from_agents': self.covers[nickname], 'observation': node['observation']
+                })
+            else:
+                entries.extend(self.inputs(node['input_from_agents'], observations))
+        return entries
+
+
+def plan_aggregation(
+        leaves: List[str],
+        aggregator_nickname: str,
+        min_agents: int = AGGREGATION_TREE_MIN_AGENTS,
+        fan_in: int = AGGREGATION_FAN_IN
+) -> Optional[AggregationTree]:
+    """
+    The AggregationTree of a chain whose subtask agents are `leaves`, in the order they are
+    expected to complete; None when the chain is aggregated in one call.
+    """
+    if not min_agents or len(leaves) < min_agents or len(leaves) <= max(fan_in, 2):
+        return None
+    return AggregationTree(leaves, aggregator_nickname, fan_in)
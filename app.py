@@ -1,7 +1,16 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 import os
-from planner import AgentPlanner
+from planner import AgentPlanner, delta_turn, questionnaire_options
+from agent_session_manager import SessionConflictError
+from runtime_stats import component_stats
+from telemetry import registry
+from model_router import request_budgets
+from job_queue import get_job_queue, JOB_QUEUE_BACKEND
+from job_worker import start_workers
+import json
+import queue
 import logging
+import threading
 import traceback
 
 logging.basicConfig(
@@ -11,11 +20,51 @@ logging.basicConfig(
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
+# idle seconds after which the event stream sends a comment, so that proxies
+# and load balancers do not drop the connection while a long agent is running
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+
+if JOB_QUEUE_BACKEND == 'memory':
+    # no separate worker processes: the jobs run in threads of the web process
+    start_workers()
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 
+@app.route('/<component>/stats')
+def get_stats(component):
+    # llm-cache, chain-cache, llm-scheduler and llm-latency
+    stats = component_stats(component)
+    if stats is None:
+        return jsonify({"error": f"Unknown component: {component}"}), 404
+    return jsonify(stats), 200
+
+
+@app.route('/sessions/<session_id>/history')
+def session_history(session_id):
+    """
+    Chat history stored for the session, for a client whose delta turn was rejected as stale.
+    """
+    history = AgentPlanner.load_chat_history(session_id)
+    return jsonify({"history": history, "history_length": len(history)}), 200
+
+
+@app.route('/sessions/<session_id>/logs')
+def session_logs(session_id):
+    """
+    Last ?count=N (default 200) log entries of the session, oldest first.
+    """
+    count = request.args.get('count', default=200, type=int)
+    return jsonify({"logs": AgentPlanner.load_session_logs(session_id, count)}), 200
+
+
+@app.route('/metrics')
+def metrics():
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @app.route('/agent-planner', methods=['POST'])
 def agent_planner():
     try:
@@ -23,27 +72,120 @@ def agent_planner():
         if not data:
             return jsonify({"error": "Request body is empty"}), 400
 
-        required_fields = ['session_chat_history']
-        missing_fields = [field for field in required_fields if field not in data]
-        if missing_fields:
-            return jsonify({
-                "error": f"Missing required fields: {', '.join(missing_fields)}"
-            }), 400
+        if 'session_chat_history' not in data and 'message' not in data and 'answers' not in data:
+            return jsonify({"error": "Missing required fields: session_chat_history or message"}), 400
 
         session_id = data.get('session_id', None)
         user_id = data.get('user_id', None)
-        chat_history = data['session_chat_history']
+        chat_history = data.get('session_chat_history')
+        delta = delta_turn(data)
+        budgets = request_budgets(data)
+        questionnaire = questionnaire_options(data)
+
+        if data.get('async'):
+            job_id = get_job_queue().enqueue({
+                'session_chat_history': chat_history, 'session_id': session_id, 'user_id': user_id,
+                **delta, 'budgets': budgets, 'questionnaire': questionnaire
+            })
+            return jsonify({"job_id": job_id, "status": "queued"}), 202
 
-        planner = AgentPlanner(chat_history, is_interactive=True, session_id=session_id, user_id=user_id)
+        planner = AgentPlanner(chat_history, is_interactive=True, session_id=session_id, user_id=user_id, **delta, **budgets, **questionnaire)
         planner.run_planner()
 
-        return jsonify({"assistant": planner.data.final_answer}), 200
+        return jsonify(planner.reply()), 200
+
+    except SessionConflictError as e:
+        logging.warning("Session conflict: %s", str(e))
+        return jsonify({"error": f"Session was updated by another request: {str(e)}"}), 409
 
     except Exception as e:
         logging.error("Exception occurred: %s", str(e))
         logging.error(traceback.format_exc())
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+
+@app.route('/agent-planner/stream', methods=['POST'])
+def agent_planner_stream():
+    """
+    Streaming variant of /agent-planner, with the events of the asgi.py endpoint. The chain
+    runs in a thread; if the client goes away, the turn is cancelled.
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "Request body is empty"}), 400
+
+    if 'session_chat_history' not in data and 'message' not in data and 'answers' not in data:
+        return jsonify({"error": "Missing required fields: session_chat_history or message"}), 400
+
+    session_id = data.get('session_id', None)
+    user_id = data.get('user_id', None)
+    chat_history = data.get('session_chat_history')
+    delta = delta_turn(data)
+    budgets = request_budgets(data)
+    questionnaire = questionnaire_options(data)
+    events = queue.Queue()
+    planners = []
+
+    def run_planner():
+        try:
+            planner = AgentPlanner(
+                chat_history, is_interactive=True, session_id=session_id, user_id=user_id, **delta, **budgets, **questionnaire,
+                on_event=lambda event, payload: events.put((event, payload))
+            )
+            planners.append(planner)
+            planner.run_planner()
+            events.put(('final', planner.reply()))
+        except SessionConflictError as e:
+            logging.warning("Session conflict: %s", str(e))
+            events.put(('error', {"error": f"Session was updated by another request: {str(e)}"}))
+        except Exception as e:
+            logging.error("Exception occurred: %s", str(e))
+            logging.error(traceback.format_exc())
+            events.put(('error', {"error": f"Internal server error: {str(e)}"}))
+        finally:
+            events.put(None)
+
+    def stream_events():
+        thread = threading.Thread(target=run_planner, name='stream-chain', daemon=True)
+        thread.start()
+        try:
+            while True:
+                try:
+                    item = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if item is None:
+                    break
+                event, payload = item
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            if thread.is_alive() and planners:
+                planners[0].cancel('client disconnected')
+
+    response = Response(stream_events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Status, progress and result of a job enqueued with {"async": true}.
+    With ?events_from=N, the chain events of the job from the N-th on are included.
+    """
+    job_queue = get_job_queue()
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    job.pop('payload', None)
+    events_from = request.args.get('events_from', type=int)
+    if events_from is not None:
+        job['events'] = job_queue.events(job_id, events_from)
+    return jsonify(job), 200
+
+
 if __name__ == '__main__':
     app.run(
         host='0.0.0.0',
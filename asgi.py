@@ -0,0 +1,222 @@
+from quart import Quart, Response, request, jsonify, render_template
+from planner import AgentPlanner, delta_turn, questionnaire_options
+from agent_session_manager import SessionConflictError
+from runtime_stats import component_stats_async
+from telemetry import registry
+from model_router import request_budgets
+from job_queue import get_job_queue, JOB_QUEUE_BACKEND
+from job_worker import start_workers
+import asyncio
+import json
+import logging
+import os
+import traceback
+
+logging.basicConfig(
+    level=logging.INFO,  # Change to DEBUG for more verbosity
+    format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s'
+)
+
+# ASGI counterpart of app.py: every chain runs as a coroutine on the event loop,
+# so a single worker can hold many in-flight chains waiting on the LLM.
+# Run with: hypercorn asgi:app --bind 0.0.0.0:5000
+app = Quart(__name__, static_folder='static', template_folder='templates')
+
+# idle seconds after which the event stream sends a comment, so that proxies
+# and load balancers do not drop the connection while a long agent is running
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+# how often the event stream of a job checks for new events
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 0.5))
+
+if JOB_QUEUE_BACKEND == 'memory':
+    # no separate worker processes: the jobs run in threads of the web process
+    start_workers()
+
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+
+@app.route('/<component>/stats')
+async def get_stats(component):
+    # llm-cache, chain-cache, llm-scheduler and llm-latency
+    stats = await component_stats_async(component)
+    if stats is None:
+        return jsonify({"error": f"Unknown component: {component}"}), 404
+    return jsonify(stats), 200
+
+
+@app.route('/sessions/<session_id>/history')
+async def session_history(session_id):
+    """
+    Chat history stored for the session, for a client whose delta turn was rejected as stale.
+    """
+    history = await AgentPlanner.load_chat_history_async(session_id)
+    return jsonify({"history": history, "history_length": len(history)}), 200
+
+
+@app.route('/sessions/<session_id>/logs')
+async def session_logs(session_id):
+    """
+    Last ?count=N (default 200) log entries of the session, oldest first.
+    """
+    count = request.args.get('count', default=200, type=int)
+    return jsonify({"logs": await AgentPlanner.load_session_logs_async(session_id, count)}), 200
+
+
+@app.route('/metrics')
+async def metrics():
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route('/agent-planner', methods=['POST'])
+async def agent_planner():
+    try:
+        data = await request.get_json()
+        if not data:
+            return jsonify({"error": "Request body is empty"}), 400
+
+        if 'session_chat_history' not in data and 'message' not in data and 'answers' not in data:
+            return jsonify({"error": "Missing required fields: session_chat_history or message"}), 400
+
+        session_id = data.get('session_id', None)
+        user_id = data.get('user_id', None)
+        chat_history = data.get('session_chat_history')
+        delta = delta_turn(data)
+        budgets = request_budgets(data)
+        questionnaire = questionnaire_options(data)
+
+        if data.get('async'):
+            job_id = await asyncio.to_thread(get_job_queue().enqueue, {
+                'session_chat_history': chat_history, 'session_id': session_id, 'user_id': user_id,
+                **delta, 'budgets': budgets, 'questionnaire': questionnaire
+            })
+            return jsonify({"job_id": job_id, "status": "queued"}), 202
+
+        planner = await AgentPlanner.create_async(chat_history, is_interactive=True, session_id=session_id, user_id=user_id, **delta, **budgets, **questionnaire)
+        await planner.run_planner_async()
+
+        return jsonify(planner.reply()), 200
+
+    except SessionConflictError as e:
+        logging.warning("Session conflict: %s", str(e))
+        return jsonify({"error": f"Session was updated by another request: {str(e)}"}), 409
+
+    except Exception as e:
+        logging.error("Exception occurred: %s", str(e))
+        logging.error(traceback.format_exc())
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+
+@app.route('/agent-planner/stream', methods=['POST'])
+async def agent_planner_stream():
+    """
+    Streaming variant of /agent-planner. Sends Server-Sent Events while the chain runs:
+    `json_chain` when the planner returns, `agent_start` / `agent_finish` for every agent,
+    `token` for every piece of the Aggregator answer, then `final` (or `error`).
+    """
+    data = await request.get_json()
+    if not data:
+        return jsonify({"error": "Request body is empty"}), 400
+
+    if 'session_chat_history' not in data and 'message' not in data and 'answers' not in data:
+        return jsonify({"error": "Missing required fields: session_chat_history or message"}), 400
+
+    session_id = data.get('session_id', None)
+    user_id = data.get('user_id', None)
+    chat_history = data.get('session_chat_history')
+    delta = delta_turn(data)
+    budgets = request_budgets(data)
+    questionnaire = questionnaire_options(data)
+    events = asyncio.Queue()
+
+    async def run_planner():
+        try:
+            planner = await AgentPlanner.create_async(
+                chat_history, is_interactive=True, session_id=session_id, user_id=user_id, **delta, **budgets, **questionnaire,
+                on_event=lambda event, payload: events.put_nowait((event, payload))
+            )
+            await planner.run_planner_async()
+            events.put_nowait(('final', planner.reply()))
+        except SessionConflictError as e:
+            logging.warning("Session conflict: %s", str(e))
+            events.put_nowait(('error', {"error": f"Session was updated by another request: {str(e)}"}))
+        except Exception as e:
+            logging.error("Exception occurred: %s", str(e))
+            logging.error(traceback.format_exc())
+            events.put_nowait(('error', {"error": f"Internal server error: {str(e)}"}))
+        finally:
+            events.put_nowait(None)
+
+    async def stream_events():
+        task = asyncio.ensure_future(run_planner())
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(events.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if item is None:
+                    break
+                event, payload = item
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            if not task.done():
+                task.cancel()
+
+    response = Response(stream_events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.timeout = None
+    return response
+
+
+@app.route('/jobs/<job_id>')
+async def job_status(job_id):
+    """
+    Status, progress and result of a job enqueued with {"async": true}.
+    With ?events_from=N, the chain events of the job from the N-th on are included.
+    """
+    job_queue = get_job_queue()
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    job.pop('payload', None)
+    events_from = request.args.get('events_from', type=int)
+    if events_from is not None:
+        job['events'] = await asyncio.to_thread(job_queue.events, job_id, events_from)
+    return jsonify(job), 200
+
+
+@app.route('/jobs/<job_id>/stream')
+async def job_stream(job_id):
+    """
+    Server-Sent Events of a job, with the same events as /agent-planner/stream except
+    `token`. The stream can be opened at any time, it replays the events sent so far.
+    """
+    job_queue = get_job_queue()
+    if await asyncio.to_thread(job_queue.get, job_id) is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+
+    async def stream_events():
+        sent = 0
+        idle = 0.0
+        while True:
+            events = await asyncio.to_thread(job_queue.events, job_id, sent)
+            for item in events:
+                yield f"event: {item['event']}\ndata: {json.dumps(item['data'])}\n\n"
+                if item['event'] in ('final', 'error'):
+                    return
+            sent += len(events)
+            idle = 0.0 if events else idle + JOB_POLL_SECONDS
+            if idle >= SSE_KEEPALIVE_SECONDS:
+                idle = 0.0
+                yield ': keep-alive\n\n'
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+    response = Response(stream_events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.timeout = None
+    return response
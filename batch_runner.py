@@ -0,0 +1,218 @@
+# batch_runner.py
+
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+import traceback
+import multiprocessing
+from typing import Dict, Iterator, Tuple
+from llm_scheduler import LLM_RPM_LIMIT, LLM_TPM_LIMIT
+
+# Run with: python batch_runner.py prompts.jsonl results.jsonl
+# Every input line is {"id": ..., "prompt": "..."} or {"id": ..., "session_chat_history": [...]};
+# every output line is {"line": N, "id": ..., "answer": "...", "seconds": S} or {..., "error": "..."}.
+# The lines that failed are run again by the next run with the same checkpoint.
+BATCH_PROCESSES = int(os.getenv("BATCH_PROCESSES", 4))
+BATCH_THREADS = int(os.getenv("BATCH_THREADS", 4))
+# LLM concurrency of the whole run; it and the LLM_RPM_LIMIT / LLM_TPM_LIMIT of the API key
+# are split evenly between the processes, each admitting its calls with its own llm_scheduler
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", os.getenv("LLM_MAX_CONCURRENCY", 16)))
+
+logger = logging.getLogger(__name__)
+
+
+class BatchCheckpoint:
+    """
+    Input lines already answered, as the count of leading lines all done (`watermark`) plus
+    the done lines after it, and the size of the output file when it was written. Only the
+    lines completed out of order are kept, so its size is bounded by the items in flight.
+    The lines that failed are kept apart and are not done: a resumed run retries them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.watermark = 0
+        self.done = set()
+        self.failed = set()
+        self.output_bytes = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.watermark = state['watermark']
+            self.done = set(state['done'])
+            self.failed = set(state.get('failed', []))
+            self.output_bytes = state['output_bytes']
+
+    def is_done(self, line: int) -> bool:
+        return (line < self.watermark or line in self.done) and line not in self.failed
+
+    def mark_done(self, line: int, output_bytes: int, failed: bool = False):
+        if failed:
+            self.failed.add(line)
+        else:
+            self.failed.discard(line)
+        self.done.add(line)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+        self.output_bytes = output_bytes
+        # written aside and renamed, so that a crash leaves the previous checkpoint intact
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({
+                'watermark': self.watermark, 'done': sorted(self.done), 'failed': sorted(self.failed),
+                'output_bytes': output_bytes
+            }, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def read_items(path: str, checkpoint: BatchCheckpoint) -> Iterator[Tuple[int, Dict]]:
+    """
+    Yields (line number, item) of the input lines not answered yet, reading one line at a time.
+    """
+    with open(path) as f:
+        for line, text in enumerate(f):
+            if text.strip() and not checkpoint.is_done(line):
+                yield line, json.loads(text)
+
+
+def run_item(line: int, item: Dict) -> Dict:
+    from planner import AgentPlanner
+    chat_history = item.get('session_chat_history') or [{'role': 'user', 'content': item['prompt']}]
+    result = {'line': line, 'id': item.get('id', line)}
+    start = time.monotonic()
+    try:
+        planner = AgentPlanner(chat_history, is_interactive=False)
+        planner.run_planner()
+        result['answer'] = planner.data.final_answer
+    except Exception as e:
+        logger.error("Exception occurred in batch line %s: %s", line, str(e))
+        logger.error(traceback.format_exc())
+        result['error'] = str(e)
+    result['seconds'] = round(time.monotonic() - start, 3)
+    return result
+
+
+def work(tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        results.put(run_item(*task))
+
+
+def process_limits(processes: int, llm_concurrency: int) -> Dict[str, str]:
+    """
+    The llm_scheduler settings of every process, their share of the limits of the run (0 = no limit).
+    """
+    def share(limit):
+        return str(max(limit // processes, 1) if limit else 0)
+    return {
+        'LLM_MAX_CONCURRENCY': share(llm_concurrency),
+        'LLM_RPM_LIMIT': share(LLM_RPM_LIMIT),
+        'LLM_TPM_LIMIT': share(LLM_TPM_LIMIT)
+    }
+
+
+def run_batch_process(tasks, results, threads: int, limits: Dict[str, str]):
+    # spawned processes import llm_scheduler after their share of the limits is set
+    os.environ.update(limits)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(name)s %(processName)s %(threadName)s : %(message)s'
+    )
+    workers = [
+        threading.Thread(target=work, args=(tasks, results), name=f'batch-worker-{index}')
+        for index in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def feed(input_path: str, checkpoint: BatchCheckpoint, tasks, workers: int, counts: Dict):
+    for task in read_items(input_path, checkpoint):
+        tasks.put(task)  # blocks while the queue is full, so the input is never all in memory
+        counts['submitted'] += 1
+    for _ in range(workers):
+        tasks.put(None)
+    counts['fed'] = True
+
+
+def run_batch(
+        input_path: str,
+        output_path: str,
+        checkpoint_path: str = None,
+        processes: int = BATCH_PROCESSES,
+        threads: int = BATCH_THREADS,
+        llm_concurrency: int = BATCH_LLM_CONCURRENCY
+) -> Dict:
+    """
+    Runs a non-interactive chain for every input line across `processes` processes of `threads`
+    chains each, appending the results to `output_path` as they complete. A run started again
+    with the same checkpoint skips the lines already answered, and retries the failed ones.
+    """
+    checkpoint = BatchCheckpoint(checkpoint_path or output_path + '.checkpoint')
+    output_bytes = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+    if output_bytes < checkpoint.output_bytes:
+        raise ValueError(f"{output_path} is shorter than recorded in the checkpoint {checkpoint.path}")
+    workers = processes * threads
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue(maxsize=workers * 2)
+    # an interrupted run exits without waiting for the tasks nobody will read
+    tasks.cancel_join_thread()
+    results = context.Queue()
+    limits = process_limits(processes, llm_concurrency)
+    pool = [
+        context.Process(
+            target=run_batch_process, name=f'batch-process-{index}',
+            args=(tasks, results, threads, limits), daemon=True
+        )
+        for index in range(processes)
+    ]
+    for process in pool:
+        process.start()
+    counts = {'submitted': 0, 'fed': False}
+    threading.Thread(target=feed, args=(input_path, checkpoint, tasks, workers, counts), daemon=True).start()
+
+    completed = failed = 0
+    with open(output_path, 'ab') as output:
+        # drop the lines written after the last checkpoint, they are run again
+        output.truncate(checkpoint.output_bytes)
+        while not counts['fed'] or completed < counts['submitted']:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in pool):
+                    raise RuntimeError("All batch processes exited before the end of the input")
+                continue
+            output.write((json.dumps(result) + '\n').encode('utf-8'))
+            output.flush()
+            checkpoint.mark_done(result['line'], output.tell(), failed='error' in result)
+            completed += 1
+            failed += 'error' in result
+            if completed % 100 == 0:
+                logger.info('🟣 --------------------- Batch: %s lines completed, %s failed', completed, failed)
+    for process in pool:
+        process.join()
+    return {'completed': completed, 'failed': failed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--processes', type=int, default=BATCH_PROCESSES)
+    parser.add_argument('--threads', type=int, default=BATCH_THREADS)
+    parser.add_argument('--llm-concurrency', type=int, default=BATCH_LLM_CONCURRENCY)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s : %(message)s')
+    stats = run_batch(args.input, args.output, args.checkpoint, args.processes, args.threads, args.llm_concurrency)
+    logger.info('🟣 --------------------- Batch done: %s', stats)
+    sys.exit(1 if stats['failed'] else 0)
@@ -0,0 +1,108 @@
+# benchmarks/aggregation_benchmark.py
+#
+# Aggregator latency against chain width, with one Aggregator call (flat) and with the
+# tree-reduce aggregation (tree), on wide chains answered by the local mock LLM server
+# (benchmarks/mock_llm_server.py). Every width and mode runs in its own process, since the
+# aggregation settings are read on import. Non-interactive chains, no Redis needed.
+# The aggregation tail is the time from the end of the last subtask agent to the final answer.
+#
+# Usage: python benchmarks/aggregation_benchmark.py [--widths 4,8,16,32] [--chains 5]
+#        [--fan-in 4] [--latency lognormal:1.0,0.3] [--token-latency 0.05,2.0]
+#        [--observation-chars 1500]
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MESSAGE = 'Write a market report on electric bicycles covering every European country.'
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def run_chains(args) -> dict:
+    from mock_llm_server import start_server
+    server, state = start_server(
+        args.mock_port, 'wide', args.latency, 0.0, args.observation_chars, args.width, args.token_latency
+    )
+    # the OpenAI clients of llm_backends.py are built on the first call, after these are set
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{args.mock_port}/v1'
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    import logging
+    logging.disable(logging.INFO)
+    from planner import AgentPlanner
+
+    totals, tails = [], []
+    for _ in range(args.chains):
+        planner = AgentPlanner([{'role': 'user', 'content': MESSAGE}], is_interactive=False)
+        run_chain_agent = planner.run_chain_agent
+        agents_end = []
+
+        def timed_agent(agent):
+            output = run_chain_agent(agent)
+            if not planner.aggregation or not planner.aggregation.is_node(agent):
+                agents_end.append(time.perf_counter())
+            return output
+
+        planner.run_chain_agent = timed_agent
+        start = time.perf_counter()
+        planner.run_planner()
+        end = time.perf_counter()
+        totals.append(end - start)
+        tails.append(end - max(agents_end))
+    with state.lock:
+        calls = state.stats['calls']
+    server.shutdown()
+    return {'totals': totals, 'tails': tails, 'calls': calls / args.chains}
+
+
+def run_mode(args, width: int, mode: str) -> dict:
+    env = dict(
+        os.environ, LLM_CACHE_ENABLED='0', CHAIN_CACHE_ENABLED='0', PLANNER_STREAMING_ENABLED='0',
+        AGGREGATION_TREE_MIN_AGENTS='0' if mode == 'flat' else '1', AGGREGATION_FAN_IN=str(args.fan_in),
+        AGENT_MAX_WORKERS=str(width + width // 2)
+    )
+    command = [
+        sys.executable, os.path.abspath(__file__), '--run', '--width', str(width), '--chains', str(args.chains),
+        '--latency', args.latency, '--token-latency', args.token_latency,
+        '--observation-chars', str(args.observation_chars), '--mock-port', str(args.mock_port)
+    ]
+    output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--widths', default='4,8,16,32')
+    parser.add_argument('--chains', type=int, default=5)
+    parser.add_argument('--fan-in', type=int, default=4)
+    parser.add_argument('--latency', default='lognormal:1.0,0.3')
+    parser.add_argument('--token-latency', default='0.05,2.0')
+    parser.add_argument('--observation-chars', type=int, default=1500)
+    parser.add_argument('--mock-port', type=int, default=8090)
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--width', type=int, default=8, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_chains(args)))
+        sys.exit(0)
+
+    print(f"{args.chains} wide chains per width, fan-in {args.fan_in}, latency {args.latency}, token latency {args.token_latency}")
+    print(f"{'width':>6}{'mode':>6}{'tail p50 s':>12}{'tail max s':>12}{'chain p50 s':>13}{'LLM calls':>11}")
+    for width in [int(width) for width in args.widths.split(',')]:
+        for mode in ('flat', 'tree'):
+            result = run_mode(args, width, mode)
+            print(
+                f"{width:>6}{mode:>6}{percentile(result['tails'], 0.5):>12.2f}{max(result['tails']):>12.2f}"
+                f"{percentile(result['totals'], 0.5):>13.2f}{result['calls']:>11.1f}"
+            )
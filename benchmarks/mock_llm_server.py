@@ -0,0 +1,227 @@
+# benchmarks/mock_llm_server.py
+#
+# Local OpenAI-compatible stub of /v1/chat/completions, to benchmark the planner without
+# calling OpenAI. The planner prompt is answered with a canned json_chain, every other
+# prompt with a generated observation, after a delay drawn from the latency distribution.
+# Point the app at it with OPENAI_BASE_URL=http://localhost:8089/v1 and any OPENAI_API_KEY.
+# Usage: python benchmarks/mock_llm_server.py [--port 8089] [--shape wide|deep|questions]
+#        [--agents N] [--latency lognormal:1.0,0.5] [--token-latency 0.05,1.0]
+#        [--failure-rate 0.0] [--observation-chars 1500]
+# --token-latency adds the given seconds per 1000 prompt and per 1000 completion tokens.
+# GET /stats returns the calls and prompt bytes received so far.
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompts import SYSTEM_PROMPT_AGENT_PLANNER, AGGREGATOR_PROMPT, PARTIAL_AGGREGATOR_PROMPT
+
+# the canned user questions start with it, so that a load generator can answer them
+QUESTION_PREFIX = 'Which option do you prefer'
+WORDS = 'the plan agent market data report analysis cost risk user result summary value option step'.split()
+
+
+def wide_chain(agents: int = 8):
+    # independent agents all feeding the Aggregator
+    return [
+        {'agent_nickname': f'Agent{i}', 'agent_llm_prompt': f'Analyse aspect {i} of the request.', 'input_from_agents': [], 'user_questions': []}
+        for i in range(agents)
+    ]
+
+
+def deep_chain(agents: int = 6):
+    # every agent takes the output of the previous one
+    return [
+        {'agent_nickname': f'Agent{i}', 'agent_llm_prompt': f'Refine step {i} of the plan.', 'input_from_agents': [f'Agent{i - 1}'] if i else [], 'user_questions': []}
+        for i in range(agents)
+    ]
+
+
+def question_chain(agents: int = 6):
+    # half of the agents ask the user a question before they can run
+    return [
+        {
+            'agent_nickname': f'Agent{i}', 'agent_llm_prompt': f'Handle part {i} of the request.',
+            'input_from_agents': [f'Agent{i - 1}'] if i % 3 else [],
+            'user_questions': [f'{QUESTION_PREFIX} for part {i}?'] if i % 2 == 0 else []
+        }
+        for i in range(agents)
+    ]
+
+
+SHAPES = {'wide': wide_chain, 'deep': deep_chain, 'questions': question_chain}
+
+
+def json_chain(shape: str, agents: int = None) -> str:
+    agents = SHAPES[shape](agents) if agents else SHAPES[shape]()
+    agents.append({
+        'agent_nickname': 'Aggregator', 'agent_llm_prompt': 'Aggregate the observations into the final answer.',
+        'input_from_agents': [agent['agent_nickname'] for agent in agents], 'user_questions': []
+    })
+    return json.dumps({'agents': agents})
+
+
+def parse_latency(spec: str):
+    """
+    fixed:S, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA, in seconds.
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',')] if params else []
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_token_latency(spec: str):
+    prompt_seconds, _, completion_seconds = spec.partition(',')
+    return float(prompt_seconds or 0), float(completion_seconds or 0)
+
+
+class MockLLMState:
+    def __init__(self, shape: str, latency, failure_rate: float, observation_chars: int, agents: int = None, token_latency=(0.0, 0.0)):
+        self.shape = shape
+        self.agents = agents
+        self.latency = latency
+        self.token_latency = token_latency
+        self.failure_rate = failure_rate
+        self.observation_chars = observation_chars
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'planner_calls': 0, 'failures': 0, 'prompt_bytes': 0}
+
+    def answer(self, prompt: str) -> str:
+        if prompt.startswith(SYSTEM_PROMPT_AGENT_PLANNER[:80]):
+            with self.lock:
+                self.stats['planner_calls'] += 1
+            return json_chain(self.shape, self.agents)
+        aggregating = prompt.startswith(AGGREGATOR_PROMPT[:80]) or prompt.startswith(PARTIAL_AGGREGATOR_PROMPT[:80])
+        size = self.observation_chars * (2 if aggregating else 1)
+        return ' '.join(random.choices(WORDS, k=max(size // 6, 1)))
+
+    def delay(self, prompt: str, answer: str) -> float:
+        # about 4 characters per token
+        prompt_seconds, completion_seconds = self.token_latency
+        return self.latency() + (len(prompt) * prompt_seconds + len(answer) * completion_seconds) / 4000
+
+    def record(self, prompt: str) -> bool:
+        """
+        Counts the call and returns whether it must fail.
+        """
+        failed = random.random() < self.failure_rate
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['prompt_bytes'] += len(prompt.encode('utf-8'))
+            self.stats['failures'] += failed
+        return failed
+
+
+def make_handler(state: MockLLMState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status: int, body: dict, headers: dict = None):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path.rstrip('/') != '/stats':
+                return self.send_json(404, {'error': 'not found'})
+            with state.lock:
+                self.send_json(200, dict(state.stats))
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                return self.send_json(404, {'error': {'message': 'not found'}})
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            prompt = ''.join(message.get('content', '') for message in body.get('messages', []))
+            failed = state.record(prompt)
+            answer = state.answer(prompt)
+            time.sleep(state.delay(prompt, answer))
+            if failed:
+                # alternate between the two errors the call layer retries
+                if random.random() < 0.5:
+                    return self.send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit'}}, {'retry-after': '1'})
+                return self.send_json(500, {'error': {'message': 'Mock server error', 'type': 'server_error'}})
+
+            usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(answer) // 4, 'total_tokens': (len(prompt) + len(answer)) // 4}
+            if body.get('stream'):
+                include_usage = (body.get('stream_options') or {}).get('include_usage')
+                return self.stream(body.get('model'), answer, usage if include_usage else None)
+            self.send_json(200, {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+
+        def stream(self, model: str, answer: str, usage: dict = None):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            words = answer.split(' ')
+            for index in range(0, len(words), 20):
+                delta = ' '.join(words[index:index + 20]) + ' '
+                chunk = {
+                    'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                    'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            if usage:
+                chunk = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model, 'choices': [], 'usage': usage}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+    return Handler
+
+
+def start_server(port: int = 8089, shape: str = 'wide', latency: str = 'lognormal:1.0,0.5',
+                 failure_rate: float = 0.0, observation_chars: int = 1500, agents: int = None, token_latency: str = '0,0'):
+    """
+    Starts the stub in a background thread and returns (server, state).
+    """
+    state = MockLLMState(shape, parse_latency(latency), failure_rate, observation_chars, agents, parse_token_latency(token_latency))
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-llm', daemon=True).start()
+    return server, state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='wide')
+    parser.add_argument('--latency', default='lognormal:1.0,0.5')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--observation-chars', type=int, default=1500)
+    parser.add_argument('--agents', type=int, default=None)
+    parser.add_argument('--token-latency', default='0,0')
+    args = parser.parse_args()
+    server, _ = start_server(
+        args.port, args.shape, args.latency, args.failure_rate, args.observation_chars, args.agents, args.token_latency
+    )
+    print(f"Mock LLM server on http://127.0.0.1:{args.port}/v1 ({args.shape} chains, latency {args.latency})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,183 @@
+# benchmarks/planner_load_benchmark.py
+#
+# Load test of the planner against the local mock LLM server (benchmarks/mock_llm_server.py),
+# started in this process. Runs `--chains` conversations, `--concurrency` at a time, answering
+# the user questions of the chain until it completes, and reports throughput, latency
+# percentiles, LLM calls and prompt bytes, Redis commands and peak RSS.
+# Needs the Redis of REDIS_HOST / REDIS_PORT; LLM_CACHE_ENABLED and CHAIN_CACHE_ENABLED default
+# to 0 so that every chain reaches the mock server.
+#
+# Usage: python benchmarks/planner_load_benchmark.py [--mode sync|async|http] [--chains 50]
+#        [--concurrency 10] [--shape wide|deep|questions] [--latency lognormal:1.0,0.5]
+#        [--failure-rate 0.0] [--url http://localhost:5000/agent-planner]
+# In http mode the app under test must use the mock server: OPENAI_BASE_URL=http://<host>:8089/v1
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import resource
+import urllib.request
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_llm_server import start_server, SHAPES, QUESTION_PREFIX
+
+MESSAGE = 'Plan a three day trip to Rome for a family of four with a budget of 2000 euros.'
+ANSWER = 'The first option, please.'
+MAX_TURNS = 20
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def redis_commands() -> int:
+    import redis
+    client = redis.StrictRedis(
+        host=os.getenv("REDIS_HOST", "redis"), port=int(os.getenv("REDIS_PORT", 6379)), db=int(os.getenv("REDIS_DB", 0))
+    )
+    return int(client.info('stats')['total_commands_processed'])
+
+
+def waiting_for_answer(reply: str) -> bool:
+    return reply.startswith(QUESTION_PREFIX)
+
+
+def run_conversation(session_id: str) -> int:
+    from planner import AgentPlanner
+    history = [{'role': 'user', 'content': MESSAGE}]
+    for turn in range(1, MAX_TURNS + 1):
+        planner = AgentPlanner(list(history), is_interactive=True, session_id=session_id, user_id='benchmark')
+        planner.run_planner()
+        if planner.data.state != 'waiting_for_user_answer':
+            return turn
+        history += [{'role': 'assistant', 'content': planner.data.final_answer}, {'role': 'user', 'content': ANSWER}]
+    return MAX_TURNS
+
+
+async def run_conversation_async(session_id: str) -> int:
+    from planner import AgentPlanner
+    history = [{'role': 'user', 'content': MESSAGE}]
+    for turn in range(1, MAX_TURNS + 1):
+        planner = await AgentPlanner.create_async(list(history), is_interactive=True, session_id=session_id, user_id='benchmark')
+        await planner.run_planner_async()
+        if planner.data.state != 'waiting_for_user_answer':
+            return turn
+        history += [{'role': 'assistant', 'content': planner.data.final_answer}, {'role': 'user', 'content': ANSWER}]
+    return MAX_TURNS
+
+
+def run_conversation_http(url: str, session_id: str) -> int:
+    history = [{'role': 'user', 'content': MESSAGE}]
+    for turn in range(1, MAX_TURNS + 1):
+        body = json.dumps({'session_chat_history': history, 'session_id': session_id, 'user_id': 'benchmark'}).encode('utf-8')
+        request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=600) as response:
+            reply = json.loads(response.read())['assistant']
+        if not waiting_for_answer(reply):
+            return turn
+        history += [{'role': 'assistant', 'content': reply}, {'role': 'user', 'content': ANSWER}]
+    return MAX_TURNS
+
+
+def timed(run, *args):
+    """
+    Returns (seconds, turns, error) of a conversation.
+    """
+    start = time.perf_counter()
+    try:
+        turns = run(*args)
+    except Exception as e:
+        return time.perf_counter() - start, 0, e
+    return time.perf_counter() - start, turns, None
+
+
+def run_threads(run, args, chains: int, concurrency: int, run_id: str):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(timed, run, *args, f'{run_id}-{index}') for index in range(chains)]
+        return [future.result() for future in futures]
+
+
+async def run_coroutines(chains: int, concurrency: int, run_id: str):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                turns = await run_conversation_async(f'{run_id}-{index}')
+            except Exception as e:
+                return time.perf_counter() - start, 0, e
+            return time.perf_counter() - start, turns, None
+
+    return await asyncio.gather(*[one(index) for index in range(chains)])
+
+
+def report(args, results, wall: float, llm_stats: dict, commands: int):
+    latencies = [seconds for seconds, _, error in results if error is None]
+    errors = [error for _, _, error in results if error is not None]
+    chains = len(results)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{args.chains} chains ({args.shape}), {args.concurrency} concurrent, mode {args.mode}, latency {args.latency}, failure rate {args.failure_rate}")
+    rows = [
+        ('chains/sec', f"{len(latencies) / wall:.2f}"),
+        ('failed chains', f"{len(errors)}"),
+        ('latency p50 / p95 / p99 s', f"{percentile(latencies, 0.5):.2f} / {percentile(latencies, 0.95):.2f} / {percentile(latencies, 0.99):.2f}"),
+        ('turns per chain', f"{sum(turns for _, turns, _ in results) / chains:.1f}"),
+        ('LLM calls per chain', f"{llm_stats['calls'] / chains:.1f} ({llm_stats['failures']} injected failures)"),
+        ('prompt bytes per call', f"{llm_stats['prompt_bytes'] / max(llm_stats['calls'], 1):.0f}"),
+        ('Redis commands per chain', f"{commands / chains:.1f}"),
+        ('peak RSS MB (this process)', f"{peak_rss_mb:.1f}"),
+    ]
+    for name, value in rows:
+        print(f"{name:<28}{value:>30}")
+    for error in errors[:3]:
+        print(f"error: {type(error).__name__}: {error}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['sync', 'async', 'http'], default='sync')
+    parser.add_argument('--chains', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='wide')
+    parser.add_argument('--latency', default='lognormal:1.0,0.5')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--observation-chars', type=int, default=1500)
+    parser.add_argument('--mock-port', type=int, default=8089)
+    parser.add_argument('--url', default='http://localhost:5000/agent-planner')
+    args = parser.parse_args()
+
+    server, state = start_server(args.mock_port, args.shape, args.latency, args.failure_rate, args.observation_chars)
+    # the OpenAI clients of llm_backends.py are built on the first call, after these are set
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{args.mock_port}/v1'
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    os.environ.setdefault('LLM_CACHE_ENABLED', '0')
+    os.environ.setdefault('CHAIN_CACHE_ENABLED', '0')
+    import logging
+    logging.disable(logging.INFO)
+
+    run_id = f'benchmark-{uuid.uuid4().hex[:8]}'
+    commands_before = redis_commands()
+    start = time.perf_counter()
+    if args.mode == 'sync':
+        results = run_threads(run_conversation, (), args.chains, args.concurrency, run_id)
+    elif args.mode == 'async':
+        results = asyncio.run(run_coroutines(args.chains, args.concurrency, run_id))
+    else:
+        results = run_threads(run_conversation_http, (args.url,), args.chains, args.concurrency, run_id)
+    wall = time.perf_counter() - start
+    commands = redis_commands() - commands_before - 1
+
+    with state.lock:
+        llm_stats = dict(state.stats)
+    report(args, results, wall, llm_stats, commands)
+    server.shutdown()
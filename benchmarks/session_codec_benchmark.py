@@ -0,0 +1,80 @@
+# benchmarks/session_codec_benchmark.py
+#
+# Compares the size and the encode/decode time of a session stored with raw pickle
+# and with the SessionCodec formats available in this environment.
+# Usage: python benchmarks/session_codec_benchmark.py [agents] [observation_chars]
+
+import os
+import sys
+import time
+import pickle
+import random
+import string
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent_data_model import AgentDataModel
+from session_codec import SessionCodec, CODECS, COMPRESSIONS
+
+
+def sample_text(words: int) -> str:
+    vocabulary = [''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 10))) for _ in range(400)]
+    return ' '.join(random.choices(vocabulary, k=words))
+
+
+def sample_session(agents: int, observation_chars: int) -> AgentDataModel:
+    # the logs of the session are appended to its own capped stream, not encoded with it
+    json_chain = {'agents': [
+        {
+            'agent_nickname': f'Agent{i}',
+            'agent_llm_prompt': sample_text(60),
+            'input_from_agents': [f'Agent{j}' for j in range(max(0, i - 2), i)],
+            'user_questions': [sample_text(12)],
+            'user_answers': [sample_text(8)],
+            'observation': sample_text(observation_chars // 6),
+        }
+        for i in range(agents)
+    ]}
+    return AgentDataModel(
+        name="AgentSInteractive",
+        session_id="planner-benchmark",
+        chat_history=[{'role': 'user' if i % 2 == 0 else 'assistant', 'content': sample_text(40)} for i in range(12)],
+        initial_message=sample_text(60),
+        json_chain=json_chain,
+        state='waiting_for_user_answer',
+        start_system_prompt=sample_text(400),
+    )
+
+
+def measure(encode, decode, data_model, rounds: int = 50):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        payload = encode(data_model)
+    encode_ms = (time.perf_counter() - start) * 1000 / rounds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decode(payload)
+    decode_ms = (time.perf_counter() - start) * 1000 / rounds
+    return len(payload), encode_ms, decode_ms
+
+
+if __name__ == '__main__':
+    agents = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    observation_chars = int(sys.argv[2]) if len(sys.argv) > 2 else 4000
+    random.seed(0)
+    data_model = sample_session(agents, observation_chars)
+
+    results = [('pickle', *measure(pickle.dumps, pickle.loads, data_model))]
+    for codec in CODECS:
+        for compression in COMPRESSIONS:
+            try:
+                session_codec = SessionCodec(codec=codec, compression=compression)
+            except ValueError:
+                continue
+            results.append((f'{codec}+{compression}', *measure(session_codec.encode, session_codec.decode, data_model)))
+
+    print(f"Session with {agents} agents, ~{observation_chars} chars per observation")
+    print(f"{'format':<16}{'bytes':>10}{'vs pickle':>11}{'encode ms':>11}{'decode ms':>11}")
+    pickle_bytes = results[0][1]
+    for name, size, encode_ms, decode_ms in results:
+        print(f"{name:<16}{size:>10}{size / pickle_bytes:>10.0%}{encode_ms:>11.3f}{decode_ms:>11.3f}")
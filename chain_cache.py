@@ -0,0 +1,268 @@
+# chain_cache.py
+
+import os
+import re
+import json
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+from agent_session_manager import get_connection_pool, get_async_connection_pool
+import redis
+import redis.asyncio
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+
+CHAIN_CACHE_ENABLED = os.getenv("CHAIN_CACHE_ENABLED", "1") == "1"
+# estimated Jaccard similarity of the initial messages above which a cached chain is reused
+CHAIN_CACHE_SIMILARITY = float(os.getenv("CHAIN_CACHE_SIMILARITY", 0.85))
+CHAIN_CACHE_TTL_SECONDS = int(os.getenv("CHAIN_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+SHINGLE_SIZE = 3
+STATS_KEY = "chain_cache_stats"
+
+
+def normalize_message(message: str) -> str:
+    message = re.sub(r'[^\w\s$%]', ' ', message.lower())
+    return re.sub(r'\s+', ' ', message).strip()
+
+
+def shingles(normalized: str) -> set:
+    words = normalized.split(' ')
+    if len(words) < SHINGLE_SIZE:
+        return {normalized}
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def minhash_signature(normalized: str) -> List[int]:
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for shingle in shingles(normalized)
+    ]
+    # permutation i is simulated by xor-ing every shingle hash with a fixed per-permutation seed
+    seeds = [
+        int.from_bytes(hashlib.blake2b(str(i).encode(), digest_size=8).digest(), 'big')
+        for i in range(NUM_PERMUTATIONS)
+    ]
+    return [min(h ^ seed for h in hashes) for seed in seeds]
+
+
+def similarity(signature: List[int], other: List[int]) -> float:
+    return sum(a == b for a, b in zip(signature, other)) / NUM_PERMUTATIONS
+
+
+def validate_json_chain(json_chain) -> bool:
+    """
+    A chain is reusable when it has agents with unique nicknames and prompts, and every
+    input_from_agents refers to an agent of the chain.
+    """
+    if not isinstance(json_chain, dict) or not isinstance(json_chain.get('agents'), list) or len(json_chain['agents']) < 2:
+        return False
+    nicknames = set()
+    for agent in json_chain['agents']:
+        if not isinstance(agent, dict) or not agent.get('agent_nickname') or not isinstance(agent.get('agent_llm_prompt'), str):
+            return False
+        nicknames.add(agent['agent_nickname'])
+    if len(nicknames) != len(json_chain['agents']):
+        return False
+    return all(
+        nickname in nicknames
+        for agent in json_chain['agents'] for nickname in agent.get('input_from_agents', []) or []
+    )
+
+
+class ChainCache:
+    """
+    Store of the json_chains generated by the planner, looked up by near-duplicate initial message.
+
+    Messages are normalized, split into word shingles and reduced to a MinHash signature;
+    the signatures are indexed in Redis with LSH banding, so a lookup only compares the
+    templates that share at least one band with the new message.
+    """
+
+    def __init__(
+            self,
+            redis_host: str = REDIS_HOST,
+            redis_port: int = REDIS_PORT,
+            db: int = REDIS_DB,
+            threshold: float = CHAIN_CACHE_SIMILARITY,
+            ttl_seconds: int = CHAIN_CACHE_TTL_SECONDS
+    ):
+        self.redis_host = redis_host
+        self.redis_port = redis_port
+        self.db = db
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def redis(self):
+        return redis.StrictRedis(connection_pool=get_connection_pool(self.redis_host, self.redis_port, self.db))
+
+    @property
+    def async_redis(self):
+        return redis.asyncio.StrictRedis(
+            connection_pool=get_async_connection_pool(self.redis_host, self.redis_port, self.db)
+        )
+
+    def get_template_key(self, template_id: str) -> str:
+        return f"chain_template:{template_id}"
+
+    def band_keys(self, signature: List[int]) -> List[str]:
+        keys = []
+        for band in range(BANDS):
+            rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+            band_hash = hashlib.sha1(','.join(map(str, rows)).encode()).hexdigest()[:16]
+            keys.append(f"chain_lsh:{band}:{band_hash}")
+        return keys
+
+    def prepare(self, initial_message: str) -> Tuple[str, List[int]]:
+        normalized = normalize_message(initial_message)
+        return normalized, minhash_signature(normalized)
+
+    def best_match(self, normalized: str, signature: List[int], templates) -> Optional[Tuple[float, Dict]]:
+        best = None
+        for template in templates:
+            if template is None:
+                continue
+            template = json.loads(template)
+            score = 1.0 if template['message'] == normalized else similarity(signature, template['signature'])
+            if score >= self.threshold and (best is None or score > best[0]):
+                best = (score, template)
+        return best
+
+    def template(self, normalized: str, signature: List[int], json_chain: Dict) -> Tuple[str, str]:
+        # answers and observations belong to a conversation, the questions are part of the plan
+        agents = [
+            {k: v for k, v in agent.items() if k not in ('observation', 'user_answers')}
+            for agent in json_chain['agents']
+        ]
+        template_id = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+        return template_id, json.dumps({
+            'message': normalized,
+            'signature': signature,
+            'json_chain': {**json_chain, 'agents': agents}
+        })
+
+    def queue_store(self, pipe, signature: List[int], template_id: str, template: str, planner_seconds: float):
+        ttl = self.ttl_seconds or None
+        pipe.set(self.get_template_key(template_id), template, ex=ttl)
+        for key in self.band_keys(signature):
+            pipe.sadd(key, template_id)
+            if ttl:
+                pipe.expire(key, ttl)
+        pipe.hincrby(STATS_KEY, 'misses', 1)
+        pipe.hincrbyfloat(STATS_KEY, 'planner_seconds', planner_seconds)
+
+    def log_hit(self, score: float, template: Dict):
+        self.logger.info(
+            '🟢 --------------------- Reusing cached json chain (similarity %.2f) planned for: %s',
+            score, template['message']
+        )
+
+    def saved_seconds(self, stats: Dict) -> float:
+        # a hit saves, on average, the latency of the planner calls that were made
+        misses = int(stats.get(b'misses', 0))
+        return float(stats.get(b'planner_seconds', 0)) / misses if misses else 0.0
+
+    def lookup(self, initial_message: str) -> Optional[Dict]:
+        """
+        Returns the cached json_chain of the most similar prior message above the threshold.
+        """
+        normalized, signature = self.prepare(initial_message)
+        try:
+            client = self.redis
+            with client.pipeline(transaction=False) as pipe:
+                for key in self.band_keys(signature):
+                    pipe.smembers(key)
+                candidates = set().union(*pipe.execute())
+            templates = client.mget([self.get_template_key(c.decode()) for c in candidates]) if candidates else []
+            best = self.best_match(normalized, signature, templates)
+            if best is None:
+                return None
+            client.hincrby(STATS_KEY, 'hits', 1)
+            client.hincrbyfloat(STATS_KEY, 'saved_seconds', self.saved_seconds(client.hgetall(STATS_KEY)))
+        except redis.RedisError as e:
+            self.logger.warning(f"Chain cache unavailable: {e}")
+            return None
+        self.log_hit(*best)
+        return best[1]['json_chain']
+
+    async def lookup_async(self, initial_message: str) -> Optional[Dict]:
+        """
+        Same as `lookup`, without blocking the event loop on Redis I/O.
+        """
+        normalized, signature = self.prepare(initial_message)
+        try:
+            client = self.async_redis
+            async with client.pipeline(transaction=False) as pipe:
+                for key in self.band_keys(signature):
+                    pipe.smembers(key)
+                candidates = set().union(*await pipe.execute())
+            templates = await client.mget([self.get_template_key(c.decode()) for c in candidates]) if candidates else []
+            best = self.best_match(normalized, signature, templates)
+            if best is None:
+                return None
+            await client.hincrby(STATS_KEY, 'hits', 1)
+            await client.hincrbyfloat(STATS_KEY, 'saved_seconds', self.saved_seconds(await client.hgetall(STATS_KEY)))
+        except redis.RedisError as e:
+            self.logger.warning(f"Chain cache unavailable: {e}")
+            return None
+        self.log_hit(*best)
+        return best[1]['json_chain']
+
+    def store(self, initial_message: str, json_chain: Dict, planner_seconds: float):
+        """
+        Stores a json_chain produced by the live planner, if it is valid.
+        """
+        if not validate_json_chain(json_chain):
+            self.logger.warning('🟠 --------------------- Not caching invalid json chain')
+            return
+        normalized, signature = self.prepare(initial_message)
+        template_id, template = self.template(normalized, signature, json_chain)
+        try:
+            with self.redis.pipeline() as pipe:
+                self.queue_store(pipe, signature, template_id, template, planner_seconds)
+                pipe.execute()
+        except redis.RedisError as e:
+            self.logger.warning(f"Chain cache unavailable: {e}")
+
+    async def store_async(self, initial_message: str, json_chain: Dict, planner_seconds: float):
+        """
+        Same as `store`, without blocking the event loop on Redis I/O.
+        """
+        if not validate_json_chain(json_chain):
+            self.logger.warning('🟠 --------------------- Not caching invalid json chain')
+            return
+        normalized, signature = self.prepare(initial_message)
+        template_id, template = self.template(normalized, signature, json_chain)
+        try:
+            async with self.async_redis.pipeline() as pipe:
+                self.queue_store(pipe, signature, template_id, template, planner_seconds)
+                await pipe.execute()
+        except redis.RedisError as e:
+            self.logger.warning(f"Chain cache unavailable: {e}")
+
+    def stats(self) -> Dict:
+        return self.format_stats(self.redis.hgetall(STATS_KEY))
+
+    async def stats_async(self) -> Dict:
+        return self.format_stats(await self.async_redis.hgetall(STATS_KEY))
+
+    def format_stats(self, raw_stats: Dict) -> Dict:
+        stats = {key.decode(): float(value) for key, value in raw_stats.items()}
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        return {
+            'hits': int(stats.get('hits', 0)),
+            'misses': int(stats.get('misses', 0)),
+            'hit_rate': round(stats.get('hits', 0) / lookups, 3) if lookups else 0.0,
+            'planner_seconds': round(stats.get('planner_seconds', 0), 3),
+            'saved_seconds': round(stats.get('saved_seconds', 0), 3),
+        }
+
+
+chain_cache = ChainCache()
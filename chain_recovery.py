@@ -0,0 +1,68 @@
+# chain_recovery.py
+#
+# Resumes the chains whose turn was interrupted (worker crash, timeout, redeploy) and that no
+# request has retried since: every session saved in the middle of a chain whose lease has expired
+# is run from its agent checkpoints to its next question or final answer, which is appended to its
+# chat history. Job workers run the sweep every CHAIN_RECOVERY_INTERVAL_SECONDS.
+# Usage: python chain_recovery.py [--dry-run]
+
+import os
+import sys
+import logging
+import traceback
+from agent_session_manager import AgentSessionManager, SessionConflictError, RUNNING_CHAINS_KEY
+from planner import AgentPlanner, REDIS_HOST, REDIS_PORT, REDIS_DB
+
+# interval of the sweep in the job workers (0 = off)
+CHAIN_RECOVERY_INTERVAL_SECONDS = int(os.getenv("CHAIN_RECOVERY_INTERVAL_SECONDS", 60))
+# a chain interrupted again after this many recoveries is given up
+CHAIN_MAX_RECOVERIES = int(os.getenv("CHAIN_MAX_RECOVERIES", 3))
+
+logger = logging.getLogger(__name__)
+
+
+def recover_chain(session_manager: AgentSessionManager, session_id: str) -> bool:
+    # fails with SessionConflictError if another sweep, or a request, took the chain over
+    session_manager.acquire_chain_lease(session_id)
+    # counted before the run, so that a chain crashing its worker every time is eventually given up
+    attempts = session_manager.redis.hincrby(RUNNING_CHAINS_KEY, session_id, 1)
+    if attempts > CHAIN_MAX_RECOVERIES:
+        logger.warning('🟠 --------------------- Giving up the interrupted chain of %s after %s recoveries', session_id, attempts - 1)
+        session_manager.redis.hdel(RUNNING_CHAINS_KEY, session_id)
+        session_manager.release_chain_lease(session_id)
+        return False
+    data_model = session_manager.load_session(session_id)
+    if data_model.state != 'running_chain':
+        # expired, or saved by another turn since the sweep listed it
+        session_manager.redis.hdel(RUNNING_CHAINS_KEY, session_id)
+        session_manager.release_chain_lease(session_id)
+        return False
+    logger.info('🟢 --------------------- Recovering the interrupted chain of %s', session_id)
+    planner = AgentPlanner(data_model.chat_history, data_model=data_model, lease_acquired=True, **data_model.kwargs)
+    planner.run_planner()
+    return True
+
+
+def recover_interrupted_chains(session_manager: AgentSessionManager, dry_run: bool = False) -> int:
+    recovered = 0
+    for session_id in session_manager.interrupted_chains():
+        if dry_run:
+            logger.info(f"{session_id}: interrupted chain")
+            recovered += 1
+            continue
+        try:
+            recovered += recover_chain(session_manager, session_id)
+        except SessionConflictError as e:
+            # a request of the session resumed it first
+            logger.info(f"{session_id}: {e}")
+        except Exception as e:
+            logger.error("Error recovering the chain of %s: %s", session_id, str(e))
+            logger.error(traceback.format_exc())
+    return recovered
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    session_manager = AgentSessionManager(redis_host=REDIS_HOST, redis_port=REDIS_PORT, db=REDIS_DB)
+    count = recover_interrupted_chains(session_manager, dry_run='--dry-run' in sys.argv)
+    logger.info(f"Recovered {count} chains")
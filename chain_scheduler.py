@@ -0,0 +1,345 @@
+# chain_scheduler.py
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+import concurrent.futures
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Threads shared by the chains of the process; the LLM calls they make are admitted by llm_scheduler
+AGENT_POOL_THREADS = int(os.getenv("AGENT_POOL_THREADS", 64))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=AGENT_POOL_THREADS, thread_name_prefix='agent'
+            )
+        return _executor
+
+
+class ChainScheduler:
+    """
+    Dependency-driven executor for the subtask agents of a json_chain.
+
+    Every agent is submitted to the worker pool as soon as all the agents listed
+    in its `input_from_agents` have finished, so independent branches never wait
+    behind each other. At most `max_workers` agents of a chain run at once.
+    Agents for which `is_blocked(agent)` is true (e.g. agents with an
+    unanswered user question) are held back together with everything
+    that depends on them, while the rest of the chain keeps running.
+    Agents can also be started with `start` / `start_async` before the chain is
+    complete (e.g. while the planner is still generating it), and the rest added
+    with `add_agents` before `run`.
+    """
+
+    def __init__(
+            self,
+            agents: List[Dict],
+            run_agent: Callable[[Dict], Any],
+            is_blocked: Callable[[Dict], bool] = lambda agent: False,
+            max_workers: int = 5,
+            completed: Iterable[str] = ()
+    ):
+        self.agents = []
+        self.run_agent = run_agent
+        self.is_blocked = is_blocked
+        self.max_workers = max_workers
+        self.logger = logging.getLogger(__name__)
+
+        self.nicknames = []
+        self.dependencies = {}
+        self.saved = set(completed)
+        self.completed = set()
+        self.failed = set()
+        self.blocked = []
+        self.timings = {}
+        self.chain_start = None
+        self.ready_at = {}
+        # agents launched by `start` / `start_async` and not finished yet
+        self.running = {}
+        self.semaphore = None
+        self.add_agents(agents)
+
+    def add_agents(self, agents: List[Dict]):
+        """
+        Adds the agents of the chain not known yet.
+        """
+        agents = [agent for agent in agents if agent['agent_nickname'] not in self.nicknames]
+        self.agents.extend(agents)
+        self.nicknames.extend(agent['agent_nickname'] for agent in agents)
+        for agent in agents:
+            inputs = agent.get('input_from_agents', []) or []
+            unknown = [nickname for nickname in inputs if nickname not in self.nicknames]
+            if unknown:
+                self.logger.warning(
+                    '🟠 --------------------- Agent %s has unknown inputs %s, ignoring them',
+                    agent['agent_nickname'], unknown
+                )
+            self.dependencies[agent['agent_nickname']] = [
+                nickname for nickname in inputs
+                if nickname in self.nicknames and nickname != agent['agent_nickname']
+            ]
+            # agents with an observation, or listed in `completed` (e.g. saved but not loaded), are done
+            if 'observation' in agent or agent['agent_nickname'] in self.saved:
+                self.completed.add(agent['agent_nickname'])
+
+    def can_start(self, agent: Dict) -> bool:
+        return (
+            agent['agent_nickname'] not in self.completed
+            and not self.is_blocked(agent)
+            and not (agent.get('input_from_agents', []) or [])
+        )
+
+    def start(self, agent: Dict) -> bool:
+        """
+        Adds an agent without inputs and launches it at once on the shared thread pool,
+        if a worker of the chain is free; `run` waits for it.
+        """
+        self.add_agents([agent])
+        if not self.can_start(agent) or len(self.running) >= self.max_workers:
+            return False
+        if self.chain_start is None:
+            self.chain_start = time.monotonic()
+        self.ready_at[agent['agent_nickname']] = time.monotonic() - self.chain_start
+        future = get_executor().submit(contextvars.copy_context().run, self.timed_run, agent, self.chain_start)
+        self.running[future] = agent
+        return True
+
+    def start_async(self, agent: Dict) -> bool:
+        """
+        Same as `start`, as a task of the running event loop.
+        """
+        self.add_agents([agent])
+        if not self.can_start(agent):
+            return False
+        if self.chain_start is None:
+            self.chain_start = time.monotonic()
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+        self.ready_at[agent['agent_nickname']] = time.monotonic() - self.chain_start
+        task = asyncio.ensure_future(self.timed_run_async(agent, self.chain_start, self.semaphore))
+        self.running[task] = agent
+        return True
+
+    def dependencies_done(self, nickname: str) -> bool:
+        return all(dep in self.completed or dep in self.failed for dep in self.dependencies[nickname])
+
+    def launchable_agents(self, pending: List[Dict], ready_at: Dict, now: float, has_running: bool) -> List[Dict]:
+        launchable = []
+        for agent in pending:
+            nickname = agent['agent_nickname']
+            if not self.dependencies_done(nickname):
+                continue
+            if self.is_blocked(agent):
+                continue
+            ready_at.setdefault(nickname, now)
+            launchable.append(agent)
+
+        if not launchable and not has_running:
+            stuck = [
+                agent for agent in pending
+                if not self.is_blocked(agent) and not self.depends_on_blocked(agent, pending)
+            ]
+            if stuck:
+                # Circular input_from_agents: unlock the earliest agent in chain order.
+                agent = stuck[0]
+                self.logger.warning(
+                    '🟠 --------------------- Circular dependency detected, forcing agent %s',
+                    agent['agent_nickname']
+                )
+                ready_at.setdefault(agent['agent_nickname'], now)
+                launchable.append(agent)
+        return launchable
+
+    @staticmethod
+    def outcome(future) -> Optional[BaseException]:
+        # an agent cancelled on its own (e.g. at the deadline of its turn) failed
+        if future.cancelled():
+            return asyncio.CancelledError('cancelled')
+        return future.exception()
+
+    def record_result(self, agent: Dict, ready_at: Dict, error: Optional[BaseException]):
+        nickname = agent['agent_nickname']
+        if error is None:
+            self.completed.add(nickname)
+        else:
+            self.failed.add(nickname)
+            self.logger.error(f"Error processing agent {nickname}: {error}")
+        # an agent cancelled before it got a worker never started
+        timing = self.timings.setdefault(
+            nickname, {'start': ready_at[nickname], 'end': ready_at[nickname], 'duration': 0.0}
+        )
+        timing['ready'] = ready_at[nickname]
+        timing['wait'] = timing['start'] - ready_at[nickname]
+
+    def run(self) -> Dict:
+        """
+        Runs every agent that can run in this turn on the shared thread pool and returns
+        the scheduling stats.
+        Agents left in `self.blocked` are waiting for the user.
+        """
+        if self.chain_start is None:
+            self.chain_start = time.monotonic()
+        chain_start = self.chain_start
+        running = self.running
+        started = {agent['agent_nickname'] for agent in running.values()}
+        pending = [
+            agent for agent in self.agents
+            if agent['agent_nickname'] not in self.completed and agent['agent_nickname'] not in started
+        ]
+        ready_at = self.ready_at
+
+        executor = get_executor()
+
+        while True:
+            launchable = self.launchable_agents(pending, ready_at, time.monotonic() - chain_start, bool(running))
+            for agent in launchable[:self.max_workers - len(running)]:
+                pending.remove(agent)
+                # the agent runs in the context of the caller, e.g. inside its trace span
+                future = executor.submit(contextvars.copy_context().run, self.timed_run, agent, chain_start)
+                running[future] = agent
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                agent = running.pop(future)
+                self.record_result(agent, ready_at, self.outcome(future))
+
+        self.blocked = [agent for agent in pending]
+        return self.stats(time.monotonic() - chain_start)
+
+    async def run_async(self) -> Dict:
+        """
+        Same as `run`, with `run_agent` being a coroutine function. Concurrency is capped
+        by a semaphore of `max_workers` instead of a thread pool.
+        Cancelling the run cancels the running agents.
+        """
+        if self.chain_start is None:
+            self.chain_start = time.monotonic()
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+        chain_start = self.chain_start
+        running = self.running
+        started = {agent['agent_nickname'] for agent in running.values()}
+        pending = [
+            agent for agent in self.agents
+            if agent['agent_nickname'] not in self.completed and agent['agent_nickname'] not in started
+        ]
+        ready_at = self.ready_at
+        semaphore = self.semaphore
+
+        while True:
+            launchable = self.launchable_agents(pending, ready_at, time.monotonic() - chain_start, bool(running))
+            for agent in launchable:
+                pending.remove(agent)
+                task = asyncio.ensure_future(self.timed_run_async(agent, chain_start, semaphore))
+                running[task] = agent
+
+            if not running:
+                break
+
+            try:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                # the turn was cancelled (e.g. its client went away): so are the LLM calls of its agents
+                for task in running:
+                    task.cancel()
+                raise
+            for task in done:
+                agent = running.pop(task)
+                self.record_result(agent, ready_at, self.outcome(task))
+
+        self.blocked = [agent for agent in pending]
+        return self.stats(time.monotonic() - chain_start)
+
+    def timed_run(self, agent: Dict, chain_start: float):
+        nickname = agent['agent_nickname']
+        start = time.monotonic() - chain_start
+        self.timings[nickname] = {'start': start}
+        try:
+            return self.run_agent(agent)
+        finally:
+            end = time.monotonic() - chain_start
+            self.timings[nickname].update({'end': end, 'duration': end - start})
+
+    async def timed_run_async(self, agent: Dict, chain_start: float, semaphore: asyncio.Semaphore):
+        nickname = agent['agent_nickname']
+        async with semaphore:
+            start = time.monotonic() - chain_start
+            self.timings[nickname] = {'start': start}
+            try:
+                return await self.run_agent(agent)
+            finally:
+                end = time.monotonic() - chain_start
+                self.timings[nickname].update({'end': end, 'duration': end - start})
+
+    def depends_on_blocked(self, agent: Dict, pending: List[Dict]) -> bool:
+        blocked = {a['agent_nickname'] for a in pending if self.is_blocked(a)}
+        seen = set()
+        stack = list(self.dependencies[agent['agent_nickname']])
+        while stack:
+            nickname = stack.pop()
+            if nickname in seen:
+                continue
+            seen.add(nickname)
+            if nickname in blocked:
+                return True
+            stack.extend(self.dependencies[nickname])
+        return False
+
+    def critical_path(self):
+        """
+        Longest chain of dependent agents executed in this run, weighted by their duration.
+        """
+        best = {}
+
+        def longest(nickname, visiting=frozenset()):
+            if nickname in best:
+                return best[nickname]
+            own = self.timings[nickname]['duration']
+            candidates = [
+                longest(dep, visiting | {nickname})
+                for dep in self.dependencies[nickname]
+                if dep in self.timings and dep not in visiting
+            ]
+            upstream = max(candidates, key=lambda c: c[0], default=(0.0, []))
+            best[nickname] = (upstream[0] + own, upstream[1] + [nickname])
+            return best[nickname]
+
+        paths = [longest(nickname) for nickname in self.nicknames if nickname in self.timings]
+        return max(paths, key=lambda p: p[0], default=(0.0, []))
+
+    def stats(self, wall_time: float) -> Dict:
+        critical_seconds, critical_agents = self.critical_path()
+        sequential_seconds = sum(t['duration'] for t in self.timings.values())
+        stats = {
+            'wall_time': round(wall_time, 3),
+            'sequential_time': round(sequential_seconds, 3),
+            'critical_path_time': round(critical_seconds, 3),
+            'critical_path': critical_agents,
+            'agents': {
+                nickname: {key: round(value, 3) for key, value in timing.items()}
+                for nickname, timing in self.timings.items()
+            },
+            'failed': sorted(self.failed),
+            'blocked': [agent['agent_nickname'] for agent in self.blocked]
+        }
+        self.logger.info(
+            '🟤 --------------------- Chain scheduled: wall %.2fs, sequential %.2fs, critical path %.2fs (%s)',
+            wall_time, sequential_seconds, critical_seconds, ' -> '.join(critical_agents)
+        )
+        for nickname, timing in stats['agents'].items():
+            self.logger.info(
+                '🟤 --------------------- Agent %s waited %.2fs in pool, ran %.2fs',
+                nickname, timing.get('wait', 0.0), timing.get('duration', 0.0)
+            )
+        return stats
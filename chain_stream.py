@@ -0,0 +1,191 @@
+# chain_stream.py
+
+import re
+import json
+import logging
+from typing import Dict, List, Optional
+
+AGENTS_ARRAY = re.compile(r'"agents"\s*:\s*\[')
+TRAILING_COMMA = re.compile(r',\s*([}\]])')
+FENCE = re.compile(r'^```(?:json)?\s*|```\s*$', re.MULTILINE)
+# closes a chain cut short after its last complete agent had already been run
+FALLBACK_AGGREGATOR_PROMPT = (
+    "Combine the observations of the other agents into a complete answer to the initial message."
+)
+
+logger = logging.getLogger(__name__)
+
+
+def loads_lenient(text: str):
+    """
+    json.loads, retried without trailing commas; None when the text is still not valid JSON.
+    """
+    for candidate in (text, TRAILING_COMMA.sub(r'\1', text)):
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def extract_json(text: str):
+    """
+    The JSON object of an LLM answer, without the ```json fences or the text around it.
+    """
+    text = FENCE.sub('', text).strip()
+    parsed = loads_lenient(text)
+    if parsed is None and '{' in text:
+        parsed = loads_lenient(text[text.index('{'):text.rindex('}') + 1])
+    return parsed
+
+
+def validate_agent(agent, nicknames) -> Optional[str]:
+    """
+    Normalizes an agent of the chain in place; returns why it cannot be run, if so.
+    """
+    if not isinstance(agent, dict):
+        return 'not an object'
+    nickname = agent.get('agent_nickname')
+    if not isinstance(nickname, str) or not nickname:
+        return 'no agent_nickname'
+    if nickname in nicknames:
+        return f'duplicate agent_nickname {nickname}'
+    if not isinstance(agent.get('agent_llm_prompt'), str):
+        return f'agent {nickname} has no agent_llm_prompt'
+    for field in ('input_from_agents', 'user_questions'):
+        value = agent.get(field)
+        if value is None:
+            agent[field] = []
+        elif isinstance(value, str):
+            agent[field] = [value]
+    return None
+
+
+class ChainStreamParser:
+    """
+    Incremental parser of the json_chain generated by the planner. `feed` takes the completion
+    as it streams and returns the agent objects of the "agents" array that are complete and
+    followed by another one, so that the last agent (the Aggregator) is never among them.
+    `finish` parses the whole completion, recovering the agents already streamed when it is
+    not valid JSON.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.state = 'seek'  # before the "agents" array, then 'array', then 'done' after it
+        self.position = 0  # next character to scan
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.object_start = None
+        self.objects = 0  # agent objects started so far
+        self.agents = []
+        self.ordinals = []  # object number of each parsed agent
+        self.released = 0
+        self.nicknames = set()
+
+    def feed(self, chunk: str) -> List[Dict]:
+        self.text += chunk
+        if self.state == 'seek':
+            match = AGENTS_ARRAY.search(self.text)
+            if match is None:
+                return []
+            self.state = 'array'
+            self.position = match.end()
+        if self.state == 'array':
+            self.scan()
+        return self.release()
+
+    def scan(self):
+        text = self.text
+        for index in range(self.position, len(text)):
+            char = text[index]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                if self.depth == 0 and char == '{':
+                    self.object_start = index
+                    self.objects += 1
+                self.depth += 1
+            elif char in '}]':
+                if self.depth == 0:
+                    self.state = 'done'
+                    break
+                self.depth -= 1
+                if self.depth == 0 and self.object_start is not None:
+                    self.add_agent(loads_lenient(text[self.object_start:index + 1]))
+                    self.object_start = None
+        self.position = len(text)
+
+    def add_agent(self, agent):
+        error = validate_agent(agent, self.nicknames)
+        if error:
+            logger.warning('🟠 --------------------- Streamed agent skipped: %s', error)
+            return
+        self.nicknames.add(agent['agent_nickname'])
+        self.agents.append(agent)
+        self.ordinals.append(self.objects)
+
+    def release(self) -> List[Dict]:
+        released = []
+        while self.released < len(self.agents) and self.objects > self.ordinals[self.released]:
+            released.append(self.agents[self.released])
+            self.released += 1
+        return released
+
+    def finish(self) -> Dict:
+        """
+        The whole json_chain. The agents streamed so far are kept as they are (the same
+        objects), the others are taken from the full completion.
+        """
+        chain = extract_json(self.text)
+        if not isinstance(chain, dict) or not isinstance(chain.get('agents'), list):
+            if not self.agents:
+                raise ValueError(f"The planner answer is not a json chain: {self.text[:200]}")
+            logger.warning(
+                '🟠 --------------------- Planner answer is not valid JSON, keeping the %s agents streamed', len(self.agents)
+            )
+            agents = list(self.agents)
+            if self.released == len(agents):
+                agents.append({
+                    'agent_nickname': 'Aggregator', 'agent_llm_prompt': FALLBACK_AGGREGATOR_PROMPT,
+                    'input_from_agents': [agent['agent_nickname'] for agent in agents], 'user_questions': []
+                })
+            return {'agents': agents}
+        streamed = {agent['agent_nickname']: agent for agent in self.agents}
+        agents = []
+        nicknames = set()
+        for agent in chain['agents']:
+            nickname = agent.get('agent_nickname') if isinstance(agent, dict) else None
+            if nickname in streamed and nickname not in nicknames:
+                agent = streamed[nickname]
+            else:
+                error = validate_agent(agent, nicknames)
+                if error:
+                    logger.warning('🟠 --------------------- Planned agent skipped: %s', error)
+                    continue
+            nicknames.add(agent['agent_nickname'])
+            agents.append(agent)
+        # streamed agents missing from the repaired completion still run
+        agents[len(agents) - 1:len(agents) - 1] = [
+            agent for agent in self.agents[:self.released] if agent['agent_nickname'] not in nicknames
+        ]
+        if not agents:
+            raise ValueError("The planner answer has no agents")
+        return {**chain, 'agents': agents}
+
+
+def parse_chain(text: str) -> Dict:
+    """
+    Parses a whole planner answer, with the recovery of ChainStreamParser.
+    """
+    parser = ChainStreamParser()
+    parser.feed(text)
+    return parser.finish()
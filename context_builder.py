@@ -0,0 +1,159 @@
+# context_builder.py
+
+import os
+import json
+import logging
+from typing import Dict, List
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token budgets of the JSON chain rendered in the prompt of a subtask agent and of the Aggregator
+AGENT_CONTEXT_TOKEN_BUDGET = int(os.getenv("AGENT_CONTEXT_TOKEN_BUDGET", 6000))
+AGGREGATOR_CONTEXT_TOKEN_BUDGET = int(os.getenv("AGGREGATOR_CONTEXT_TOKEN_BUDGET", 60000))
+# Length of the agent_llm_prompt of agents other than the current one
+CONTEXT_SUMMARY_CHARS = int(os.getenv("CONTEXT_SUMMARY_CHARS", 200))
+
+TRUNCATION_MARK = ' [...]'
+
+
+class ContextBuilder:
+    """
+    Renders the part of the json_chain an agent needs, as compact JSON, within a token budget.
+
+    A subtask agent sees the whole chain layout, its own prompt, and the observations of
+    its `input_from_agents` in full; the prompts of the other agents are shortened and
+    their questions, answers and observations are left out. The Aggregator sees every
+    observation. When the observations do not fit the budget, the longest ones are
+    truncated first, so that short observations are always kept whole.
+    """
+
+    def __init__(
+            self,
+            agent_token_budget: int = AGENT_CONTEXT_TOKEN_BUDGET,
+            aggregator_token_budget: int = AGGREGATOR_CONTEXT_TOKEN_BUDGET,
+            summary_chars: int = CONTEXT_SUMMARY_CHARS
+    ):
+        self.agent_token_budget = agent_token_budget
+        self.aggregator_token_budget = aggregator_token_budget
+        self.summary_chars = summary_chars
+        self.logger = logging.getLogger(__name__)
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                self.logger.warning('🟠 --------------------- tiktoken encoding not available, estimating tokens from length')
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        # about 4 characters per token for English text
+        return (len(text) + 3) // 4
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if self.count_tokens(text) <= max_tokens:
+            return text
+        max_tokens = max(max_tokens, 0)
+        if self.encoding is not None:
+            return self.encoding.decode(self.encoding.encode(text)[:max_tokens]) + TRUNCATION_MARK
+        return text[:max_tokens * 4] + TRUNCATION_MARK
+
+    def summarize(self, text: str) -> str:
+        if len(text) <= self.summary_chars:
+            return text
+        return text[:self.summary_chars].rsplit(' ', 1)[0] + TRUNCATION_MARK
+
+    def render(self, json_chain: Dict) -> str:
+        return json.dumps(json_chain, ensure_ascii=False, separators=(',', ':'))
+
+    def agent_context(self, json_chain: Dict, agent_nickname: str, input_nicknames: List[str]) -> str:
+        """
+        Context of a subtask agent: `input_nicknames` are the agents whose observation it receives.
+        """
+        agents = []
+        observations = {}
+        for agent in json_chain['agents']:
+            nickname = agent['agent_nickname']
+            entry = {
+                'agent_nickname': nickname,
+                'agent_llm_prompt': agent['agent_llm_prompt'] if nickname == agent_nickname else self.summarize(agent.get('agent_llm_prompt', '')),
+                'input_from_agents': agent.get('input_from_agents', []) or [],
+            }
+            if nickname in input_nicknames and 'observation' in agent:
+                observations[nickname] = agent['observation']
+            agents.append(entry)
+        return self.fit({**json_chain, 'agents': agents}, observations, self.agent_token_budget, agent_nickname)
+
+    def aggregator_context(self, json_chain: Dict, agent_nickname: str = 'Aggregator', inputs: List[Dict] = None) -> str:
+        """
+        Context of the Aggregator: every observation, or with a tree-reduce aggregation only
+        those of `inputs` (see AggregationTree.inputs), the syntheses being added to the chain.
+        """
+        agents = []
+        observations = {}
+        for agent in json_chain['agents']:
+            entry = {
+                'agent_nickname': agent['agent_nickname'],
+                'agent_llm_prompt': agent.get('agent_llm_prompt', ''),
+                'input_from_agents': agent.get('input_from_agents', []) or [],
+            }
+            if 'observation' in agent and inputs is None:
+                observations[agent['agent_nickname']] = agent['observation']
+            agents.append(entry)
+        for entry in inputs or []:
+            observations[entry['agent_nickname']] = entry['observation']
+            if 'input_from_agents' in entry:
+                agents.insert(len(agents) - 1, {k: v for k, v in entry.items() if k != 'observation'})
+        return self.fit({**json_chain, 'agents': agents}, observations, self.aggregator_token_budget, agent_nickname)
+
+    def synthesis_context(self, json_chain: Dict, agent_nickname: str, inputs: List[Dict]) -> str:
+        """
+        Context of an intermediate synthesis of a tree-reduce aggregation: only its inputs,
+        with their prompts and observations.
+        """
+        prompts = {agent['agent_nickname']: agent.get('agent_llm_prompt', '') for agent in json_chain['agents']}
+        agents = [
+            {
+                'agent_nickname': entry['agent_nickname'],
+                'agent_llm_prompt': entry.get('agent_llm_prompt', prompts.get(entry['agent_nickname'], '')),
+                'input_from_agents': entry.get('input_from_agents', []),
+            }
+            for entry in inputs
+        ]
+        observations = {entry['agent_nickname']: entry['observation'] for entry in inputs}
+        return self.fit({'agents': agents}, observations, self.aggregator_token_budget, agent_nickname)
+
+    def fit(self, json_chain: Dict, observations: Dict[str, str], token_budget: int, agent_nickname: str) -> str:
+        """
+        Adds the observations to the chain, truncating the longest ones until the rendered
+        chain fits `token_budget`.
+        """
+        # each observation also costs its key and the truncation mark
+        overhead = self.count_tokens(',"observation":""' + TRUNCATION_MARK)
+        available = token_budget - self.count_tokens(self.render(json_chain)) - overhead * len(observations)
+        sizes = {nickname: self.count_tokens(text) for nickname, text in observations.items()}
+        limits = dict(sizes)
+
+        if sum(sizes.values()) > available:
+            # water-filling: every observation gets an equal share of what the shorter ones leave
+            remaining = max(available, 0)
+            pending = sorted(sizes, key=sizes.get)
+            while pending:
+                share = remaining // len(pending)
+                nickname = pending.pop(0)
+                limits[nickname] = min(sizes[nickname], share)
+                remaining -= limits[nickname]
+            self.logger.warning(
+                '🟠 --------------------- Context of agent %s over budget (%s tokens available, %s needed), truncated observations of %s',
+                agent_nickname, available, sum(sizes.values()),
+                [nickname for nickname in sizes if limits[nickname] < sizes[nickname]]
+            )
+
+        for agent in json_chain['agents']:
+            nickname = agent['agent_nickname']
+            if nickname in observations:
+                agent['observation'] = self.truncate(observations[nickname], limits[nickname])
+        return self.render(json_chain)
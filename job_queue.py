@@ -0,0 +1,240 @@
+# job_queue.py
+
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from typing import Dict, List, Optional
+from agent_session_manager import get_connection_pool
+import redis
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+
+# "redis" to feed the worker processes of job_worker.py, "memory" to run the jobs in the web process
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "redis")
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", 24 * 3600))
+# jobs running for longer than this are considered lost with their worker and queued again
+JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT_SECONDS", 1800))
+
+QUEUE_KEY = "job_queue"
+PROCESSING_KEY = "job_processing"
+
+# events of the chain kept in the job, the Aggregator tokens are left out
+JOB_EVENTS = ('json_chain', 'agent_start', 'agent_finish', 'final', 'error')
+
+
+def new_job(payload: Dict) -> Dict:
+    return {
+        'job_id': uuid.uuid4().hex,
+        'status': 'queued',
+        'payload': payload,
+        'created_at': time.time(),
+    }
+
+
+def job_progress(job: Dict, event: str, data: Dict) -> Dict:
+    """
+    Fields of the job to update after a chain event.
+    """
+    if event == 'json_chain':
+        return {'agents_total': len(data.get('agents', [])), 'agents_done': 0}
+    if event == 'agent_finish':
+        return {'agents_done': int(job.get('agents_done', 0)) + 1}
+    return {}
+
+
+class InMemoryJobQueue:
+    """
+    Job queue of a single process, for tests and local runs without worker processes.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.job_events = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, payload: Dict) -> str:
+        job = new_job(payload)
+        with self.lock:
+            self.jobs[job['job_id']] = job
+            self.job_events[job['job_id']] = []
+        self.queue.put(job['job_id'])
+        return job['job_id']
+
+    def dequeue(self, timeout: float = 5) -> Optional[Dict]:
+        try:
+            job_id = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return self.update(job_id, status='running', started_at=time.time())
+
+    def update(self, job_id: str, **fields) -> Dict:
+        with self.lock:
+            self.jobs[job_id].update(fields)
+            return dict(self.jobs[job_id])
+
+    def add_event(self, job_id: str, event: str, data: Dict):
+        with self.lock:
+            self.job_events[job_id].append({'event': event, 'data': data})
+            self.jobs[job_id].update(job_progress(self.jobs[job_id], event, data))
+
+    def finish(self, job_id: str, result: Optional[Dict] = None, error: Optional[str] = None):
+        self.add_event(job_id, 'error' if error else 'final', {'error': error} if error else result)
+        self.update(
+            job_id, status='failed' if error else 'done', finished_at=time.time(),
+            **({'error': error} if error else {'result': result})
+        )
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def events(self, job_id: str, start: int = 0) -> List[Dict]:
+        with self.lock:
+            return list(self.job_events.get(job_id, [])[start:])
+
+    def requeue_stale(self) -> int:
+        return 0
+
+
+class RedisJobQueue:
+    """
+    Job queue shared by the web tier and the worker processes of every node.
+
+    A job is a hash `job:<id>` holding its status, payload, progress and result, and
+    a list `job_events:<id>` of the chain events. Job ids wait in the `job_queue`
+    list and are moved atomically to `job_processing` by the worker taking them, so
+    that a job whose worker died can be found and queued again.
+    """
+
+    def __init__(
+            self,
+            redis_host: str = REDIS_HOST,
+            redis_port: int = REDIS_PORT,
+            db: int = REDIS_DB,
+            ttl_seconds: int = JOB_TTL_SECONDS,
+            timeout_seconds: int = JOB_TIMEOUT_SECONDS
+    ):
+        self.redis_host = redis_host
+        self.redis_port = redis_port
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.timeout_seconds = timeout_seconds
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def redis(self):
+        return redis.StrictRedis(connection_pool=get_connection_pool(self.redis_host, self.redis_port, self.db))
+
+    def get_job_key(self, job_id: str) -> str:
+        return f"job:{job_id}"
+
+    def get_events_key(self, job_id: str) -> str:
+        return f"job_events:{job_id}"
+
+    def encode(self, fields: Dict) -> Dict:
+        return {name: json.dumps(value) for name, value in fields.items()}
+
+    def enqueue(self, payload: Dict) -> str:
+        job = new_job(payload)
+        with self.redis.pipeline() as pipe:
+            pipe.hset(self.get_job_key(job['job_id']), mapping=self.encode(job))
+            pipe.expire(self.get_job_key(job['job_id']), self.ttl_seconds)
+            pipe.lpush(QUEUE_KEY, job['job_id'])
+            pipe.execute()
+        return job['job_id']
+
+    def dequeue(self, timeout: float = 5) -> Optional[Dict]:
+        job_id = self.redis.blmove(QUEUE_KEY, PROCESSING_KEY, timeout, 'RIGHT', 'LEFT')
+        if job_id is None:
+            return None
+        job_id = job_id.decode()
+        job = self.update(job_id, status='running', started_at=time.time())
+        if 'payload' not in job:
+            # expired while waiting in the queue
+            with self.redis.pipeline() as pipe:
+                pipe.lrem(PROCESSING_KEY, 1, job_id)
+                pipe.delete(self.get_job_key(job_id))
+                pipe.execute()
+            return None
+        return job
+
+    def update(self, job_id: str, **fields) -> Dict:
+        client = self.redis
+        with client.pipeline() as pipe:
+            pipe.hset(self.get_job_key(job_id), mapping=self.encode(fields))
+            pipe.hgetall(self.get_job_key(job_id))
+            job = pipe.execute()[1]
+        return self.decode(job)
+
+    def add_event(self, job_id: str, event: str, data: Dict):
+        client = self.redis
+        with client.pipeline() as pipe:
+            pipe.rpush(self.get_events_key(job_id), json.dumps({'event': event, 'data': data}))
+            pipe.expire(self.get_events_key(job_id), self.ttl_seconds)
+            if event == 'agent_finish':
+                pipe.hincrby(self.get_job_key(job_id), 'agents_done', 1)
+            pipe.execute()
+        if event == 'json_chain':
+            self.update(job_id, **job_progress({}, event, data))
+
+    def finish(self, job_id: str, result: Optional[Dict] = None, error: Optional[str] = None):
+        self.add_event(job_id, 'error' if error else 'final', {'error': error} if error else result)
+        fields = {'status': 'failed' if error else 'done', 'finished_at': time.time()}
+        fields.update({'error': error} if error else {'result': result})
+        with self.redis.pipeline() as pipe:
+            pipe.hset(self.get_job_key(job_id), mapping=self.encode(fields))
+            pipe.lrem(PROCESSING_KEY, 1, job_id)
+            pipe.execute()
+
+    def decode(self, job: Dict) -> Dict:
+        # agents_done is written by HINCRBY as a plain integer, which is valid JSON as well
+        return {name.decode(): json.loads(value) for name, value in job.items()}
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        job = self.redis.hgetall(self.get_job_key(job_id))
+        return self.decode(job) if job else None
+
+    def events(self, job_id: str, start: int = 0) -> List[Dict]:
+        return [json.loads(event) for event in self.redis.lrange(self.get_events_key(job_id), start, -1)]
+
+    def requeue_stale(self) -> int:
+        """
+        Queues again the jobs that have been running for longer than `timeout_seconds`.
+        """
+        client = self.redis
+        requeued = 0
+        for job_id in client.lrange(PROCESSING_KEY, 0, -1):
+            job_id = job_id.decode()
+            job = self.get(job_id)
+            if job is not None and time.time() - job.get('started_at', 0) < self.timeout_seconds:
+                continue
+            # only the worker that removes the job from the processing list queues it again
+            if not client.lrem(PROCESSING_KEY, 1, job_id) or job is None:
+                continue
+            with client.pipeline() as pipe:
+                pipe.hset(self.get_job_key(job_id), mapping=self.encode({'status': 'queued'}))
+                pipe.lpush(QUEUE_KEY, job_id)
+                pipe.execute()
+            requeued += 1
+            self.logger.warning('🟠 --------------------- Requeued stale job %s', job_id)
+        return requeued
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = InMemoryJobQueue() if JOB_QUEUE_BACKEND == 'memory' else RedisJobQueue()
+        return _job_queue
@@ -0,0 +1,109 @@
+# job_worker.py
+
+import os
+import logging
+import threading
+import traceback
+import multiprocessing
+from typing import Dict
+from planner import AgentPlanner, delta_turn, REDIS_HOST, REDIS_PORT, REDIS_DB
+from agent_session_manager import AgentSessionManager, SessionConflictError
+from job_queue import get_job_queue, JOB_EVENTS
+from chain_recovery import recover_interrupted_chains, CHAIN_RECOVERY_INTERVAL_SECONDS
+
+# Run with: python job_worker.py
+# every process runs JOB_WORKER_THREADS chains at once, their LLM calls share its llm_scheduler
+JOB_WORKER_PROCESSES = int(os.getenv("JOB_WORKER_PROCESSES", 2))
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", 8))
+
+logger = logging.getLogger(__name__)
+
+
+def run_job(job_queue, job: Dict):
+    job_id = job['job_id']
+    payload = job['payload']
+    logger.info('🟣 --------------------- Running job %s', job_id)
+
+    def on_event(event, data):
+        if event in JOB_EVENTS:
+            job_queue.add_event(job_id, event, data)
+
+    try:
+        planner = AgentPlanner(
+            payload.get('session_chat_history'), is_interactive=True,
+            session_id=payload.get('session_id'), user_id=payload.get('user_id'),
+            on_event=on_event, **delta_turn(payload), **payload.get('budgets', {}),
+            **payload.get('questionnaire', {})
+        )
+        planner.run_planner()
+        job_queue.finish(job_id, result=planner.reply())
+    except SessionConflictError as e:
+        logger.warning("Session conflict in job %s: %s", job_id, str(e))
+        job_queue.finish(job_id, error=f"Session was updated by another request: {str(e)}")
+    except Exception as e:
+        logger.error("Exception occurred in job %s: %s", job_id, str(e))
+        logger.error(traceback.format_exc())
+        job_queue.finish(job_id, error=f"Internal server error: {str(e)}")
+
+
+def work(job_queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            job = job_queue.dequeue(timeout=5)
+        except Exception as e:
+            logger.error("Job queue unavailable: %s", str(e))
+            stop.wait(5)
+            continue
+        if job is not None:
+            run_job(job_queue, job)
+
+
+def start_workers(threads: int = JOB_WORKER_THREADS, stop: threading.Event = None) -> threading.Event:
+    """
+    Starts `threads` worker threads in the current process, consuming the configured job queue.
+    """
+    stop = stop or threading.Event()
+    job_queue = get_job_queue()
+    for index in range(threads):
+        threading.Thread(target=work, args=(job_queue, stop), name=f'job-worker-{index}', daemon=True).start()
+    return stop
+
+
+def sweep_interrupted_chains(stop: threading.Event, interval: int = CHAIN_RECOVERY_INTERVAL_SECONDS):
+    """
+    Resumes the interrupted chains every `interval` seconds, until `stop` is set.
+    """
+    session_manager = AgentSessionManager(redis_host=REDIS_HOST, redis_port=REDIS_PORT, db=REDIS_DB)
+    while not stop.wait(interval):
+        try:
+            recovered = recover_interrupted_chains(session_manager)
+        except Exception as e:
+            logger.error("Chain recovery unavailable: %s", str(e))
+            continue
+        if recovered:
+            logger.info('🟣 --------------------- Recovered %s interrupted chains', recovered)
+
+
+def run_worker_process():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(name)s %(processName)s %(threadName)s : %(message)s'
+    )
+    requeued = get_job_queue().requeue_stale()
+    if requeued:
+        logger.info('🟣 --------------------- Requeued %s stale jobs', requeued)
+    stop = start_workers()
+    if CHAIN_RECOVERY_INTERVAL_SECONDS:
+        threading.Thread(target=sweep_interrupted_chains, args=(stop,), name='chain-recovery', daemon=True).start()
+    stop.wait()
+
+
+if __name__ == '__main__':
+    processes = [
+        multiprocessing.Process(target=run_worker_process, name=f'job-worker-process-{index}')
+        for index in range(JOB_WORKER_PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
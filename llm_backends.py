@@ -0,0 +1,354 @@
+# llm_backends.py
+
+import os
+import abc
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import importlib
+import importlib.util
+import threading
+import weakref
+from typing import AsyncIterator, Callable, Dict, Iterator, NamedTuple, Optional
+from prompts import SYSTEM_PROMPT_AGENT_PLANNER, JSON_CHAIN_EXAMPLE
+
+# openai, local, or the module:attribute of a custom backend class or factory
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+# connection pool of the OpenAI backend, shared by all the threads (and by the tasks of an event loop)
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", 100))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_HTTP_KEEPALIVE_SECONDS = float(os.getenv("LLM_HTTP_KEEPALIVE_SECONDS", 60))
+# HTTP/2 is used only when the h2 package is installed
+LLM_HTTP2_ENABLED = os.getenv("LLM_HTTP2_ENABLED", "1") == "1"
+# simulated latency of every call of the local backend
+LLM_LOCAL_LATENCY_SECONDS = float(os.getenv("LLM_LOCAL_LATENCY_SECONDS", 0))
+
+logger = logging.getLogger(__name__)
+
+
+class LLMBackendError(Exception):
+    """
+    Error of a backend request, translated from the error of its SDK. Raised as such (e.g. for
+    an invalid request) it is not retried; the connection, timeout, rate-limit and server errors
+    below are retried by llm_resilience.
+    """
+
+
+class LLMConnectionError(LLMBackendError):
+    pass
+
+
+class LLMTimeoutError(LLMConnectionError):
+    pass
+
+
+class LLMRateLimitError(LLMBackendError):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMServerError(LLMBackendError):
+    pass
+
+
+class Usage(NamedTuple):
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
+
+class Completion(NamedTuple):
+    """
+    The answer of a request, or one delta of a streamed answer. Only the last delta of a
+    stream carries the usage of the request.
+    """
+    text: str
+    usage: Optional[Usage] = None
+
+
+class LLMBackend(abc.ABC):
+    """
+    A provider of chat completions for models.py, which adds the scheduling, retries,
+    deadlines and caching. `timeout` is the time left to the deadline of the call, in seconds.
+    Backends raise the LLMBackendError subclasses, so that the retries do not depend on an SDK.
+    A backend missing one of the four methods cannot be instantiated.
+    """
+    name = 'base'
+
+    @abc.abstractmethod
+    def complete(self, prompt: str, model: str, timeout: float) -> Completion:
+        ...
+
+    @abc.abstractmethod
+    async def complete_async(self, prompt: str, model: str, timeout: float) -> Completion:
+        ...
+
+    @abc.abstractmethod
+    def stream(self, prompt: str, model: str, timeout: float) -> Iterator[Completion]:
+        ...
+
+    @abc.abstractmethod
+    def stream_async(self, prompt: str, model: str, timeout: float) -> AsyncIterator[Completion]:
+        ...
+
+
+def http2_available() -> bool:
+    return LLM_HTTP2_ENABLED and importlib.util.find_spec('h2') is not None
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    The OpenAI API. The SDK is imported and the clients are built on the first call, so that
+    importing the planner needs neither the SDK nor credentials. All the threads share one
+    client and its pool of keep-alive connections; every event loop gets its own async client,
+    since connections cannot move between loops.
+    """
+    name = 'openai'
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.client = None
+        self.async_clients = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+        if not (api_key or os.getenv("OPENAI_API_KEY")):
+            logger.warning('🟠 --------------------- OPENAI_API_KEY is not set, the LLM calls will fail')
+
+    def client_options(self) -> Dict:
+        api_key = self.api_key or os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable is not set")
+        # retries are made by resilient_caller, under the deadline of the call
+        return {'api_key': api_key, 'base_url': self.base_url or os.getenv("OPENAI_BASE_URL") or None, 'max_retries': 0}
+
+    @staticmethod
+    def http_client(client_class):
+        """
+        An HTTP client of the SDK (with its defaults) on the tuned connection pool. The limits
+        are built with the class of the SDK's own, whichever httpx package it depends on.
+        """
+        import openai
+        limits = type(openai.DEFAULT_CONNECTION_LIMITS)(
+            max_connections=LLM_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_HTTP_KEEPALIVE_SECONDS
+        )
+        if http2_available():
+            try:
+                return client_class(limits=limits, http2=True), True
+            except ImportError:
+                pass
+        return client_class(limits=limits), False
+
+    def get_client(self):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    import openai
+                    options = self.client_options()
+                    http_client, http2 = self.http_client(openai.DefaultHttpxClient)
+                    self.client = openai.OpenAI(http_client=http_client, **options)
+                    logger.info('🟢 --------------------- OpenAI client ready (HTTP/2: %s)', http2)
+        return self.client
+
+    def get_async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self.async_clients.get(loop)
+        if client is None:
+            import openai
+            options = self.client_options()
+            http_client, _ = self.http_client(openai.DefaultAsyncHttpxClient)
+            client = self.async_clients[loop] = openai.AsyncOpenAI(http_client=http_client, **options)
+        return client
+
+    @staticmethod
+    def translate_error(error: Exception) -> Exception:
+        import openai
+        if isinstance(error, openai.APITimeoutError):
+            return LLMTimeoutError(str(error))
+        if isinstance(error, openai.APIConnectionError):
+            return LLMConnectionError(str(error))
+        if isinstance(error, openai.RateLimitError):
+            retry_after = None
+            try:
+                retry_after = float(error.response.headers.get('retry-after'))
+            except (AttributeError, TypeError, ValueError):
+                pass
+            return LLMRateLimitError(str(error), retry_after)
+        if isinstance(error, openai.InternalServerError):
+            return LLMServerError(str(error))
+        if isinstance(error, openai.OpenAIError):
+            return LLMBackendError(str(error))
+        return error
+
+    def raise_translated(self, error: Exception):
+        translated = self.translate_error(error)
+        if translated is error:
+            raise error
+        raise translated from error
+
+    @staticmethod
+    def usage(response) -> Optional[Usage]:
+        usage = getattr(response, 'usage', None)
+        return Usage(usage.prompt_tokens, usage.completion_tokens, usage.total_tokens) if usage else None
+
+    @staticmethod
+    def request(prompt: str, model: str, timeout: float, **options) -> Dict:
+        return dict(model=model, messages=[{"role": "user", "content": prompt}], timeout=timeout, **options)
+
+    def complete(self, prompt: str, model: str, timeout: float) -> Completion:
+        try:
+            response = self.get_client().chat.completions.create(**self.request(prompt, model, timeout))
+        except Exception as e:
+            self.raise_translated(e)
+        return Completion(response.choices[0].message.content, self.usage(response))
+
+    async def complete_async(self, prompt: str, model: str, timeout: float) -> Completion:
+        try:
+            response = await self.get_async_client().chat.completions.create(**self.request(prompt, model, timeout))
+        except Exception as e:
+            self.raise_translated(e)
+        return Completion(response.choices[0].message.content, self.usage(response))
+
+    def stream_options(self) -> Dict:
+        # the last chunk carries the usage of the request
+        return {'stream': True, 'stream_options': {"include_usage": True}}
+
+    def stream(self, prompt: str, model: str, timeout: float) -> Iterator[Completion]:
+        try:
+            response = self.get_client().chat.completions.create(**self.request(prompt, model, timeout, **self.stream_options()))
+            try:
+                for chunk in response:
+                    text = chunk.choices[0].delta.content if chunk.choices else None
+                    usage = self.usage(chunk)
+                    if text or usage:
+                        yield Completion(text or '', usage)
+            finally:
+                response.close()
+        except Exception as e:
+            self.raise_translated(e)
+
+    async def stream_async(self, prompt: str, model: str, timeout: float) -> AsyncIterator[Completion]:
+        try:
+            response = await self.get_async_client().chat.completions.create(
+                **self.request(prompt, model, timeout, **self.stream_options())
+            )
+            try:
+                async for chunk in response:
+                    text = chunk.choices[0].delta.content if chunk.choices else None
+                    usage = self.usage(chunk)
+                    if text or usage:
+                        yield Completion(text or '', usage)
+            finally:
+                await response.close()
+        except Exception as e:
+            self.raise_translated(e)
+
+
+class LocalBackend(LLMBackend):
+    """
+    Deterministic answers computed in process, to run the whole pipeline without network or
+    credentials: the planner gets a fixed chain of three agents and an Aggregator, every other
+    prompt an answer derived from a hash of the prompt and the model.
+    """
+    name = 'local'
+    words = 'plan market data report analysis cost risk user result summary value option step'.split()
+
+    def __init__(self, latency: float = LLM_LOCAL_LATENCY_SECONDS):
+        self.latency = latency
+
+    @staticmethod
+    def is_planner(prompt: str) -> bool:
+        # a session can have its own planner prompt, which still shows the json_chain example
+        return prompt.startswith(SYSTEM_PROMPT_AGENT_PLANNER[:80]) or JSON_CHAIN_EXAMPLE.strip() in prompt
+
+    @staticmethod
+    def json_chain() -> str:
+        agents = [
+            {'agent_nickname': 'Research', 'agent_llm_prompt': 'Collect the facts the request depends on.', 'input_from_agents': [], 'complexity': 'low', 'user_questions': []},
+            {'agent_nickname': 'Options', 'agent_llm_prompt': 'List the options available to the user.', 'input_from_agents': [], 'complexity': 'low', 'user_questions': []},
+            {'agent_nickname': 'Analysis', 'agent_llm_prompt': 'Compare the options against the facts.', 'input_from_agents': ['Research', 'Options'], 'complexity': 'medium', 'user_questions': []},
+            {'agent_nickname': 'Aggregator', 'agent_llm_prompt': 'Combine the observations into the final answer.', 'input_from_agents': ['Research', 'Options', 'Analysis'], 'user_questions': []},
+        ]
+        return json.dumps({'agents': agents}, indent=2)
+
+    def answer(self, prompt: str, model: str) -> Completion:
+        if self.is_planner(prompt):
+            text = self.json_chain()
+        else:
+            digest = hashlib.sha256(f'{model}\n{prompt}'.encode('utf-8')).hexdigest()
+            rng = random.Random(digest)
+            text = f"Local answer {digest[:12]}: " + ' '.join(rng.choices(self.words, k=40)) + '.'
+        # about 4 characters per token
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(text) // 4
+        return Completion(text, Usage(prompt_tokens, completion_tokens, prompt_tokens + completion_tokens))
+
+    @staticmethod
+    def deltas(completion: Completion) -> Iterator[Completion]:
+        words = completion.text.split(' ')
+        for index in range(0, len(words), 8):
+            yield Completion(' '.join(words[index:index + 8]) + (' ' if index + 8 < len(words) else ''))
+        yield Completion('', completion.usage)
+
+    def delay(self, timeout: float) -> float:
+        if self.latency > timeout:
+            raise LLMTimeoutError("Local backend request timed out")
+        return self.latency
+
+    def complete(self, prompt: str, model: str, timeout: float) -> Completion:
+        time.sleep(self.delay(timeout))
+        return self.answer(prompt, model)
+
+    async def complete_async(self, prompt: str, model: str, timeout: float) -> Completion:
+        await asyncio.sleep(self.delay(timeout))
+        return self.answer(prompt, model)
+
+    def stream(self, prompt: str, model: str, timeout: float) -> Iterator[Completion]:
+        time.sleep(self.delay(timeout))
+        yield from self.deltas(self.answer(prompt, model))
+
+    async def stream_async(self, prompt: str, model: str, timeout: float) -> AsyncIterator[Completion]:
+        await asyncio.sleep(self.delay(timeout))
+        for delta in self.deltas(self.answer(prompt, model)):
+            yield delta
+
+
+BACKENDS: Dict[str, Callable[[], LLMBackend]] = {
+    'openai': OpenAIBackend,
+    'local': LocalBackend,
+}
+
+
+def register_backend(name: str, factory: Callable[[], LLMBackend]):
+    BACKENDS[name] = factory
+
+
+def load_backend(name: str) -> LLMBackend:
+    if name in BACKENDS:
+        return BACKENDS[name]()
+    module_name, _, attribute = name.partition(':')
+    if not attribute:
+        raise ValueError(f"Unknown LLM backend: {name} (expected one of {sorted(BACKENDS)} or module:attribute)")
+    return getattr(importlib.import_module(module_name), attribute)()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> LLMBackend:
+    """
+    The process-wide backend chosen by LLM_BACKEND, created on the first call.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = load_backend(LLM_BACKEND)
+                logger.info('🟢 --------------------- LLM backend: %s', _backend.name)
+    return _backend
+
@@ -0,0 +1,317 @@
+# llm_cache.py
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+import collections
+from typing import Awaitable, Callable, Dict, Optional
+from agent_session_manager import get_connection_pool, get_async_connection_pool
+from llm_backends import LLMTimeoutError
+from llm_resilience import DeadlineExceededError, TurnCancelledError
+import redis
+import redis.asyncio
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", 1000))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", 24 * 3600))
+# total size of the answers kept in Redis, the oldest ones are evicted beyond it
+LLM_CACHE_REDIS_MAX_BYTES = int(os.getenv("LLM_CACHE_REDIS_MAX_BYTES", 256 * 1024 * 1024))
+
+INDEX_KEY = "llm_cache_index"
+BYTES_KEY = "llm_cache_bytes"
+
+# failures due to the deadline or cancellation of the turn of the leading call: its followers call again
+TURN_SCOPED_ERRORS = (DeadlineExceededError, LLMTimeoutError, TurnCancelledError)
+
+
+class LLMCache:
+    """
+    Content-addressed cache of LLM answers, keyed on a hash of (model, prompt, parameters).
+
+    Answers are kept in a bounded in-process LRU and in Redis with a TTL; the Redis tier
+    is also bounded in bytes, evicting the oldest answers first. Concurrent identical calls
+    of the same process are coalesced: only the first one reaches the LLM, the others wait
+    for its answer until their own deadline. Redis errors never fail a call, the cache is skipped instead.
+    """
+
+    def __init__(
+            self,
+            redis_host: str = REDIS_HOST,
+            redis_port: int = REDIS_PORT,
+            db: int = REDIS_DB,
+            memory_entries: int = LLM_CACHE_MEMORY_ENTRIES,
+            ttl_seconds: int = LLM_CACHE_TTL_SECONDS,
+            redis_max_bytes: int = LLM_CACHE_REDIS_MAX_BYTES
+    ):
+        self.redis_host = redis_host
+        self.redis_port = redis_port
+        self.db = db
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.redis_max_bytes = redis_max_bytes
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.async_in_flight = {}
+        self.counters = collections.Counter()
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def redis(self):
+        return redis.StrictRedis(connection_pool=get_connection_pool(self.redis_host, self.redis_port, self.db))
+
+    @property
+    def async_redis(self):
+        return redis.asyncio.StrictRedis(
+            connection_pool=get_async_connection_pool(self.redis_host, self.redis_port, self.db)
+        )
+
+    def make_key(self, model: str, prompt: str, **params) -> str:
+        payload = json.dumps({'model': model, 'prompt': prompt, 'params': params}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_redis_key(self, key: str) -> str:
+        return f"llm_cache:{key}"
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                name: self.counters[name]
+                for name in ('memory_hits', 'redis_hits', 'misses', 'coalesced', 'memory_evictions', 'redis_evictions', 'redis_errors')
+            }
+
+    # in-process tier
+
+    def memory_get(self, key: str) -> Optional[str]:
+        with self.lock:
+            if key not in self.memory:
+                return None
+            self.memory.move_to_end(key)
+            self.counters['memory_hits'] += 1
+            return self.memory[key]
+
+    def memory_set(self, key: str, answer: str):
+        with self.lock:
+            self.memory[key] = answer
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+                self.counters['memory_evictions'] += 1
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    # Redis tier
+
+    def index_member(self, key: str, answer: bytes) -> str:
+        return f"{key}:{len(answer)}"
+
+    def queue_index(self, pipe, key: str, answer: bytes):
+        pipe.zadd(INDEX_KEY, {self.index_member(key, answer): time.time()})
+        pipe.incrby(BYTES_KEY, len(answer))
+
+    def members_to_evict(self, members_by_age, total_bytes: int):
+        """
+        Picks the index members to drop: the expired ones, then the oldest until the tier fits.
+        """
+        expired_before = time.time() - self.ttl_seconds if self.ttl_seconds else None
+        evicted = []
+        for member, score in members_by_age:
+            member = member.decode() if isinstance(member, bytes) else member
+            if total_bytes <= self.redis_max_bytes and (expired_before is None or score >= expired_before):
+                break
+            evicted.append(member)
+            total_bytes -= int(member.rsplit(':', 1)[1])
+        return evicted
+
+    def queue_evictions(self, pipe, evicted):
+        for member in evicted:
+            key, size = member.rsplit(':', 1)
+            pipe.delete(self.get_redis_key(key))
+            pipe.zrem(INDEX_KEY, member)
+            pipe.decrby(BYTES_KEY, int(size))
+
+    def redis_get(self, key: str) -> Optional[str]:
+        try:
+            answer = self.redis.get(self.get_redis_key(key))
+        except redis.RedisError as e:
+            self.count('redis_errors')
+            self.logger.warning(f"LLM cache unavailable: {e}")
+            return None
+        if answer is None:
+            return None
+        self.count('redis_hits')
+        return answer.decode('utf-8')
+
+    def redis_set(self, key: str, answer: str):
+        try:
+            client = self.redis
+            answer = answer.encode('utf-8')
+            # only the first writer of an answer indexes it, so that its bytes are counted once
+            if not client.set(self.get_redis_key(key), answer, ex=self.ttl_seconds or None, nx=True):
+                return
+            with client.pipeline() as pipe:
+                self.queue_index(pipe, key, answer)
+                pipe.execute()
+            total_bytes = int(client.get(BYTES_KEY) or 0)
+            evicted = self.members_to_evict(client.zrange(INDEX_KEY, 0, 99, withscores=True), total_bytes)
+            if evicted:
+                with client.pipeline() as pipe:
+                    self.queue_evictions(pipe, evicted)
+                    pipe.execute()
+                with self.lock:
+                    self.counters['redis_evictions'] += len(evicted)
+        except redis.RedisError as e:
+            self.count('redis_errors')
+            self.logger.warning(f"LLM cache unavailable: {e}")
+
+    async def redis_get_async(self, key: str) -> Optional[str]:
+        try:
+            answer = await self.async_redis.get(self.get_redis_key(key))
+        except redis.RedisError as e:
+            self.count('redis_errors')
+            self.logger.warning(f"LLM cache unavailable: {e}")
+            return None
+        if answer is None:
+            return None
+        self.count('redis_hits')
+        return answer.decode('utf-8')
+
+    async def redis_set_async(self, key: str, answer: str):
+        try:
+            client = self.async_redis
+            answer = answer.encode('utf-8')
+            # only the first writer of an answer indexes it, so that its bytes are counted once
+            if not await client.set(self.get_redis_key(key), answer, ex=self.ttl_seconds or None, nx=True):
+                return
+            async with client.pipeline() as pipe:
+                self.queue_index(pipe, key, answer)
+                await pipe.execute()
+            total_bytes = int(await client.get(BYTES_KEY) or 0)
+            evicted = self.members_to_evict(await client.zrange(INDEX_KEY, 0, 99, withscores=True), total_bytes)
+            if evicted:
+                async with client.pipeline() as pipe:
+                    self.queue_evictions(pipe, evicted)
+                    await pipe.execute()
+                with self.lock:
+                    self.counters['redis_evictions'] += len(evicted)
+        except redis.RedisError as e:
+            self.count('redis_errors')
+            self.logger.warning(f"LLM cache unavailable: {e}")
+
+    # lookups
+
+    def get(self, key: str) -> Optional[str]:
+        answer = self.memory_get(key)
+        if answer is None:
+            answer = self.redis_get(key)
+            if answer is not None:
+                self.memory_set(key, answer)
+        return answer
+
+    async def get_async(self, key: str) -> Optional[str]:
+        answer = self.memory_get(key)
+        if answer is None:
+            answer = await self.redis_get_async(key)
+            if answer is not None:
+                self.memory_set(key, answer)
+        return answer
+
+    def set(self, key: str, answer: str):
+        self.memory_set(key, answer)
+        self.redis_set(key, answer)
+
+    async def set_async(self, key: str, answer: str):
+        self.memory_set(key, answer)
+        await self.redis_set_async(key, answer)
+
+    def get_or_call(self, key: str, call: Callable[[], str], deadline: Optional[float] = None) -> str:
+        """
+        Returns the cached answer for `key`, or calls the LLM once for all the threads asking for it.
+        A thread waiting for the call of another one fails with DeadlineExceededError at its
+        `deadline` (time.monotonic()), and calls again if that call ended with its turn.
+        """
+        while True:
+            answer = self.get(key)
+            if answer is not None:
+                return answer
+
+            with self.lock:
+                flight = self.in_flight.get(key)
+                if flight is None:
+                    flight = self.in_flight[key] = {'done': threading.Event()}
+                    self.counters['misses'] += 1
+                    break
+                self.counters['coalesced'] += 1
+
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not flight['done'].wait(timeout):
+                raise DeadlineExceededError("LLM call deadline passed while waiting for an identical call")
+            if 'answer' in flight:
+                return flight['answer']
+            if not isinstance(flight['error'], TURN_SCOPED_ERRORS):
+                raise flight['error']
+
+        try:
+            flight['answer'] = call()
+            self.set(key, flight['answer'])
+            return flight['answer']
+        except Exception as e:
+            flight['error'] = e
+            raise e
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight['done'].set()
+
+    async def get_or_call_async(self, key: str, call: Callable[[], Awaitable[str]], deadline: Optional[float] = None) -> str:
+        """
+        Same as `get_or_call`, coalescing the coroutines of the running event loop.
+        """
+        while True:
+            answer = await self.get_async(key)
+            if answer is not None:
+                return answer
+            future = self.async_in_flight.get(key)
+            if future is None:
+                return await self.call_async(key, call)
+            self.count('coalesced')
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                answer = await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                raise DeadlineExceededError("LLM call deadline passed while waiting for an identical call")
+            if answer is not None:
+                return answer
+            # the call ended with the turn that made it: one of its followers makes it again
+
+    async def call_async(self, key: str, call: Callable[[], Awaitable[str]]) -> str:
+        self.count('misses')
+        future = self.async_in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            answer = await call()
+            await self.set_async(key, answer)
+            future.set_result(answer)
+            return answer
+        except (asyncio.CancelledError, *TURN_SCOPED_ERRORS):
+            # the followers may belong to other turns, which are not cancelled and have their own deadline
+            future.set_result(None)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # retrieve the exception so that it is not reported when nobody waits for it
+            future.exception()
+            raise e
+        finally:
+            self.async_in_flight.pop(key, None)
+
+llm_cache = LLMCache()
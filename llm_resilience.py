@@ -0,0 +1,341 @@
+# llm_resilience.py
+
+import os
+import time
+import bisect
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+import collections
+import concurrent.futures
+from typing import Awaitable, Callable, Dict, Optional
+from llm_backends import LLMConnectionError, LLMTimeoutError, LLMRateLimitError, LLMServerError
+
+# Deadline of an LLM call, retries and hedged requests included
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 120))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+# full-jitter exponential backoff: the n-th retry waits up to min(max, base * 2**n)
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", 1))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", 20))
+# a duplicate request is sent when a call is still running after the given latency quantile of its model
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", 0.95))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+LLM_HEDGE_MIN_SECONDS = float(os.getenv("LLM_HEDGE_MIN_SECONDS", 1))
+
+# timeouts, connection errors, 429 and 5xx responses; other API errors would fail again
+RETRYABLE_ERRORS = (LLMConnectionError, LLMRateLimitError, LLMServerError)
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+class TurnCancelledError(Exception):
+    """
+    Raised by the LLM calls of a turn cancelled before its end, e.g. because its client went away.
+    """
+
+
+class TurnDeadline:
+    """
+    End-to-end deadline and cancellation of a turn, seen by its LLM calls through `current_turn`.
+    The critical calls (the Aggregator) may run until `deadline`; the other calls stop `reserve`
+    seconds earlier, so that the Aggregator can still answer on time from the observations
+    gathered so far. Without a deadline, every call is only bounded by its own timeout.
+    """
+
+    def __init__(self):
+        self.deadline = None
+        self.reserve = 0.0
+        self.cancelled = threading.Event()
+        self.reason = None
+
+    def set_deadline(self, deadline: float, reserve: float = 0.0):
+        self.deadline = deadline
+        self.reserve = reserve
+
+    def call_deadline(self, critical: bool) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return self.deadline if critical else self.deadline - self.reserve
+
+    def agents_expired(self) -> bool:
+        """
+        Whether the non-critical calls are past their deadline.
+        """
+        deadline = self.call_deadline(critical=False)
+        return deadline is not None and time.monotonic() >= deadline
+
+    def cancel(self, reason: str = 'cancelled'):
+        if not self.cancelled.is_set():
+            self.reason = reason
+            self.cancelled.set()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise TurnCancelledError(f"Turn cancelled: {self.reason}")
+
+
+current_turn = contextvars.ContextVar('current_turn', default=None)
+
+
+class LatencyHistogram:
+    """
+    Log-bucketed latencies of successful calls. Counts are halved once they reach
+    `max_samples`, so the quantiles follow the recent behaviour of the model.
+    """
+
+    BOUNDS = [0.1 * 1.25 ** i for i in range(40)]  # 0.1s to about 750s
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def observe(self, seconds: float):
+        if self.total >= self.max_samples:
+            self.counts = [count // 2 for count in self.counts]
+            self.total = sum(self.counts)
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+class LatencyTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = collections.defaultdict(LatencyHistogram)
+        self.counters = collections.Counter()
+
+    def observe(self, model: str, seconds: float):
+        with self.lock:
+            self.histograms[model].observe(seconds)
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        """
+        How long to wait for a call before hedging it, or None while too few calls were observed.
+        """
+        latency = self.quantile(model, LLM_HEDGE_QUANTILE)
+        return None if latency is None else max(latency, LLM_HEDGE_MIN_SECONDS)
+
+    def quantile(self, model: str, q: float) -> Optional[float]:
+        """
+        Latency quantile of the model, or None while too few calls were observed.
+        """
+        with self.lock:
+            histogram = self.histograms.get(model)
+            if histogram is None or histogram.total < LLM_HEDGE_MIN_SAMPLES:
+                return None
+            return histogram.quantile(q)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'models': {
+                    model: {
+                        'samples': histogram.total,
+                        **{
+                            f'p{int(q * 100)}_seconds': round(histogram.quantile(q), 3)
+                            for q in (0.5, 0.95, 0.99)
+                        }
+                    }
+                    for model, histogram in self.histograms.items() if histogram.total
+                },
+                **{
+                    name: self.counters[name]
+                    for name in ('retries', 'hedges', 'hedge_wins', 'deadline_exceeded', 'cancelled', 'failures')
+                }
+            }
+
+
+latency_tracker = LatencyTracker()
+
+
+class ResilientCaller:
+    """
+    Runs an LLM request under a deadline, retrying the retryable errors with jittered
+    exponential backoff and, when enabled, hedging it: once the request has run longer
+    than the observed latency quantile of its model, a duplicate is sent and whichever
+    answers first wins.
+
+    The request is a callable taking the absolute deadline (time.monotonic) it must finish by:
+    the timeout of the call, or the deadline of its turn (see TurnDeadline) if earlier.
+    """
+
+    def __init__(
+            self,
+            timeout: float = LLM_TIMEOUT_SECONDS,
+            max_retries: int = LLM_MAX_RETRIES,
+            hedge_enabled: bool = LLM_HEDGE_ENABLED,
+            tracker: LatencyTracker = latency_tracker
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge_enabled = hedge_enabled
+        self.tracker = tracker
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def retry_delay(self, attempt: int, error: Exception, deadline: float) -> Optional[float]:
+        """
+        Seconds to wait before retrying after `error`, or None if the call must fail.
+        """
+        if not isinstance(error, RETRYABLE_ERRORS) or attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+        if isinstance(error, LLMRateLimitError) and error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        if time.monotonic() + delay >= deadline:
+            return None
+        self.tracker.count('retries')
+        self.logger.warning(
+            '🟠 --------------------- LLM call failed (%s), retry %s/%s in %.1fs',
+            type(error).__name__, attempt + 1, self.max_retries, delay
+        )
+        return delay
+
+    def call_deadline(self, critical: bool = False) -> float:
+        deadline = time.monotonic() + self.timeout
+        turn = current_turn.get()
+        turn_deadline = turn.call_deadline(critical) if turn is not None else None
+        return deadline if turn_deadline is None else min(deadline, turn_deadline)
+
+    def check_deadline(self, deadline: float):
+        turn = current_turn.get()
+        if turn is not None and turn.cancelled.is_set():
+            self.tracker.count('cancelled')
+            turn.check()
+        if time.monotonic() >= deadline:
+            self.tracker.count('deadline_exceeded')
+            raise DeadlineExceededError(
+                f"LLM call did not complete before its deadline (timeout {self.timeout}s or latency budget of the turn)"
+            )
+
+    def fail(self, error: Exception):
+        self.tracker.count('failures')
+        if isinstance(error, (LLMTimeoutError, DeadlineExceededError)):
+            self.tracker.count('deadline_exceeded')
+
+    def call(self, request: Callable[[float], str], model: str, critical: bool = False) -> str:
+        deadline = self.call_deadline(critical)
+        attempt = 0
+        while True:
+            self.check_deadline(deadline)
+            try:
+                return self.attempt(request, model, deadline)
+            except Exception as e:
+                delay = self.retry_delay(attempt, e, deadline)
+                if delay is None:
+                    self.fail(e)
+                    raise e
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, request: Callable[[float], Awaitable[str]], model: str, critical: bool = False) -> str:
+        deadline = self.call_deadline(critical)
+        attempt = 0
+        while True:
+            self.check_deadline(deadline)
+            try:
+                return await self.attempt_async(request, model, deadline)
+            except Exception as e:
+                delay = self.retry_delay(attempt, e, deadline)
+                if delay is None:
+                    self.fail(e)
+                    raise e
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def hedge_after(self, model: str, deadline: float) -> Optional[float]:
+        if not self.hedge_enabled:
+            return None
+        delay = self.tracker.hedge_delay(model)
+        if delay is None or time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='llm-hedge')
+            return self.executor
+
+    def attempt(self, request: Callable[[float], str], model: str, deadline: float) -> str:
+        hedge_after = self.hedge_after(model, deadline)
+        if hedge_after is None:
+            return request(deadline)
+
+        executor = self.get_executor()
+        primary = executor.submit(contextvars.copy_context().run, request, deadline)
+        done, _ = concurrent.futures.wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+        self.log_hedge(model, hedge_after)
+        hedge = executor.submit(contextvars.copy_context().run, request, deadline)
+        # the slower request cannot be interrupted, it finishes in the background
+        first_error = None
+        for future in concurrent.futures.as_completed([primary, hedge]):
+            if future.exception() is None:
+                if future is hedge:
+                    self.tracker.count('hedge_wins')
+                return future.result()
+            first_error = first_error or future.exception()
+        raise first_error
+
+    async def attempt_async(self, request: Callable[[float], Awaitable[str]], model: str, deadline: float) -> str:
+        hedge_after = self.hedge_after(model, deadline)
+        if hedge_after is None:
+            return await request(deadline)
+
+        primary = asyncio.ensure_future(request(deadline))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait([primary], timeout=hedge_after)
+            if done:
+                return primary.result()
+            self.log_hedge(model, hedge_after)
+            hedge = asyncio.ensure_future(request(deadline))
+            pending = {primary, hedge}
+            first_error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.tracker.count('hedge_wins')
+                        return task.result()
+                    first_error = first_error or task.exception()
+            raise first_error
+        finally:
+            # the slower request is cancelled, releasing its connection and scheduler slot
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def log_hedge(self, model: str, hedge_after: float):
+        self.tracker.count('hedges')
+        self.logger.info(
+            '🟠 --------------------- LLM call to %s still running after %.1fs, sending a hedged request',
+            model, hedge_after
+        )
+
+
+resilient_caller = ResilientCaller()
@@ -0,0 +1,247 @@
+# llm_scheduler.py
+
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+from typing import Dict, Optional
+from llm_resilience import current_turn, DeadlineExceededError, TurnCancelledError
+
+# Provider limits of the API key and concurrency cap of the process (0 = no RPM / TPM limit)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 16))
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", 500))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", 200000))
+# completion tokens reserved for a call before its actual usage is known
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", 2000))
+# pause of the admissions after a 429 without retry-after header
+LLM_RATE_LIMIT_PAUSE_SECONDS = float(os.getenv("LLM_RATE_LIMIT_PAUSE_SECONDS", 5))
+
+# lower value = admitted first
+PRIORITY_CRITICAL = 0      # Aggregator: the last step before the user gets an answer
+PRIORITY_INTERACTIVE = 1   # planner and agents of an interactive turn
+PRIORITY_BATCH = 2         # non-interactive chains
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if not self.capacity:
+            return 0.0
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+
+class Ticket:
+    def __init__(self, priority: int, seq: int, tokens: int, notify):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.notify = notify
+        self.enqueued = time.monotonic()
+        self.admitted = False
+        self.admitted_at = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class LLMScheduler:
+    """
+    Process-wide admission control for the LLM calls.
+
+    Every call takes a ticket before reaching the provider. Tickets are admitted in
+    priority order when a concurrency slot is free and the requests-per-minute and
+    tokens-per-minute buckets can cover the call, whose tokens are estimated from the
+    prompt size and corrected with the actual usage once it returns. A rate-limited
+    response pauses all admissions instead of letting every caller hit the limit again.
+    Works for threads (`acquire`) and for coroutines (`acquire_async`) alike.
+    """
+
+    def __init__(
+            self,
+            max_concurrency: int = LLM_MAX_CONCURRENCY,
+            rpm_limit: int = LLM_RPM_LIMIT,
+            tpm_limit: int = LLM_TPM_LIMIT,
+            expected_completion_tokens: int = LLM_EXPECTED_COMPLETION_TOKENS
+    ):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm_limit)
+        self.tokens = TokenBucket(tpm_limit)
+        self.expected_completion_tokens = expected_completion_tokens
+        self.lock = threading.Lock()
+        self.queue = []
+        self.seq = itertools.count()
+        self.running = 0
+        self.paused_until = 0.0
+        self.counters = {'admitted': 0, 'rate_limited': 0, 'abandoned': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+        self.logger = logging.getLogger(__name__)
+
+    def estimate_tokens(self, prompt: str) -> int:
+        # about 4 characters per token, plus the expected completion
+        return (len(prompt or '') + 3) // 4 + self.expected_completion_tokens
+
+    def admit(self) -> Optional[float]:
+        """
+        Admits the queued tickets that can run now, in priority order. Must hold the lock.
+        Returns how long the head of the queue has to wait, if it cannot run yet.
+        """
+        while self.queue:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.running >= self.max_concurrency:
+                return None
+            ticket = self.queue[0]
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            delay = max(self.requests.wait_time(1), self.tokens.wait_time(ticket.tokens))
+            if delay > 0:
+                return delay
+            heapq.heappop(self.queue)
+            self.requests.take(1)
+            self.tokens.take(ticket.tokens)
+            self.running += 1
+            ticket.admitted = True
+            ticket.admitted_at = now
+            wait = now - ticket.enqueued
+            self.counters['admitted'] += 1
+            self.counters['wait_seconds'] += wait
+            self.counters['max_wait_seconds'] = max(self.counters['max_wait_seconds'], wait)
+            ticket.notify()
+        return None
+
+    def enqueue(self, prompt: str, priority: int, notify) -> Ticket:
+        ticket = Ticket(priority, next(self.seq), self.estimate_tokens(prompt), notify)
+        heapq.heappush(self.queue, ticket)
+        return ticket
+
+    def abandon_error(self, deadline: Optional[float]) -> Optional[Exception]:
+        """
+        Why a queued call must give up its ticket: its turn was cancelled or its deadline passed.
+        """
+        turn = current_turn.get()
+        if turn is not None and turn.cancelled.is_set():
+            return TurnCancelledError(f"Turn cancelled while its LLM call was queued: {turn.reason}")
+        if deadline is not None and time.monotonic() >= deadline:
+            return DeadlineExceededError("LLM call deadline passed while waiting for the scheduler")
+        return None
+
+    def abandon_locked(self, ticket: Ticket) -> bool:
+        # the ticket may have been admitted since the caller gave up
+        if ticket.admitted:
+            return False
+        self.queue.remove(ticket)
+        heapq.heapify(self.queue)
+        self.counters['abandoned'] += 1
+        return True
+
+    def acquire(self, prompt: str, priority: int = PRIORITY_INTERACTIVE, deadline: Optional[float] = None) -> Ticket:
+        """
+        Blocks the calling thread until the call can be sent. The call leaves the queue
+        when its `deadline` passes or its turn is cancelled.
+        """
+        event = threading.Event()
+        with self.lock:
+            ticket = self.enqueue(prompt, priority, event.set)
+        while True:
+            with self.lock:
+                delay = self.admit()
+                if ticket.admitted:
+                    return ticket
+            event.wait(timeout=min(delay or 1.0, 1.0))
+            error = self.abandon_error(deadline)
+            if error is not None:
+                with self.lock:
+                    if self.abandon_locked(ticket):
+                        raise error
+
+    async def acquire_async(self, prompt: str, priority: int = PRIORITY_INTERACTIVE, deadline: Optional[float] = None) -> Ticket:
+        """
+        Same as `acquire`, waiting without blocking the event loop. A cancelled task leaves the queue.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self.lock:
+            ticket = self.enqueue(prompt, priority, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while True:
+                with self.lock:
+                    delay = self.admit()
+                    if ticket.admitted:
+                        return ticket
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=min(delay or 1.0, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+                error = self.abandon_error(deadline)
+                if error is not None:
+                    with self.lock:
+                        if self.abandon_locked(ticket):
+                            raise error
+        except asyncio.CancelledError:
+            with self.lock:
+                if not self.abandon_locked(ticket):
+                    self.release_locked(ticket)
+            raise
+
+    def release_locked(self, ticket: Ticket, used_tokens: Optional[int] = None):
+        self.running -= 1
+        if used_tokens is not None and self.tokens.capacity:
+            # give back (or take) the difference between the estimate and the actual usage
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + ticket.tokens - used_tokens)
+        self.admit()
+
+    def release(self, ticket: Ticket, used_tokens: Optional[int] = None):
+        with self.lock:
+            self.release_locked(ticket, used_tokens)
+
+    def rate_limited(self, retry_after: Optional[float] = None):
+        """
+        Pauses the admissions after the provider answered 429.
+        """
+        pause = retry_after if retry_after else LLM_RATE_LIMIT_PAUSE_SECONDS
+        with self.lock:
+            self.counters['rate_limited'] += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        self.logger.warning(f"LLM rate limit reached, pausing admissions for {pause:.1f}s")
+
+    def stats(self) -> Dict:
+        with self.lock:
+            now = time.monotonic()
+            admitted = self.counters['admitted']
+            return {
+                'queue_depth': len(self.queue),
+                'queue_depth_by_priority': {
+                    str(priority): sum(1 for t in self.queue if t.priority == priority)
+                    for priority in (PRIORITY_CRITICAL, PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+                },
+                'oldest_wait_seconds': round(max((now - t.enqueued for t in self.queue), default=0.0), 3),
+                'running': self.running,
+                'max_concurrency': self.max_concurrency,
+                'admitted': admitted,
+                'avg_wait_seconds': round(self.counters['wait_seconds'] / admitted, 3) if admitted else 0.0,
+                'max_wait_seconds': round(self.counters['max_wait_seconds'], 3),
+                'rate_limited': self.counters['rate_limited'],
+                'abandoned': self.counters['abandoned'],
+                'paused_seconds': round(max(self.paused_until - now, 0.0), 3),
+            }
+
+
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,46 @@
+# migrate_sessions.py
+#
+# Rewrites the sessions still stored as raw pickle in the current session format.
+# Sessions are also migrated lazily on their next save, so running this is optional.
+# Usage: python migrate_sessions.py [--dry-run]
+
+import os
+import sys
+import logging
+from agent_session_manager import AgentSessionManager
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def migrate_sessions(session_manager: AgentSessionManager, dry_run: bool = False) -> int:
+    migrated = 0
+    for key in session_manager.redis.scan_iter(match=session_manager.get_session_key('*'), count=500):
+        serialized_data = session_manager.redis.get(key)
+        if not serialized_data or session_manager.codec.is_encoded(serialized_data):
+            continue
+        data_model = session_manager.codec.decode(serialized_data)
+        encoded = session_manager.codec.encode(data_model)
+        logger.info(f"{key.decode()}: {len(serialized_data)} -> {len(encoded)} bytes")
+        if not dry_run:
+            # keep the version key untouched so in-flight turns still save normally,
+            # and only overwrite the key if no turn rewrote it meanwhile
+            with session_manager.redis.pipeline() as pipe:
+                pipe.watch(key)
+                if pipe.get(key) != serialized_data:
+                    continue
+                pipe.multi()
+                pipe.set(key, encoded, ex=session_manager.get_ttl(data_model))
+                pipe.execute()
+        migrated += 1
+    return migrated
+
+
+if __name__ == '__main__':
+    session_manager = AgentSessionManager(redis_host=REDIS_HOST, redis_port=REDIS_PORT, db=REDIS_DB)
+    count = migrate_sessions(session_manager, dry_run='--dry-run' in sys.argv)
+    logger.info(f"Migrated {count} sessions")
@@ -0,0 +1,210 @@
+# model_router.py
+
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+import contextvars
+from typing import Dict, Optional
+from llm_resilience import latency_tracker, current_turn, TurnDeadline
+from telemetry import LLM_COST_USD, LLM_ROUTED_CALLS
+
+# route the agents to the model of their complexity tier (off: every agent runs on the "medium" tier)
+MODEL_ROUTING_ENABLED = os.getenv("MODEL_ROUTING_ENABLED", "0") == "1"
+PLANNER_MODEL = os.getenv("PLANNER_MODEL", "o1-mini")
+AGGREGATOR_MODEL = os.getenv("AGGREGATOR_MODEL", "o1-mini")
+# model of an agent by the complexity the planner assigned to it ("complexity" in the json_chain)
+MODEL_TIERS = json.loads(os.getenv("MODEL_TIERS", '{"low": "gpt-4o-mini", "medium": "o1-mini", "high": "o1-mini"}'))
+# agents without a complexity hint are "low" when their task prompt is shorter than this, "medium" otherwise
+MODEL_ROUTING_SHORT_PROMPT_CHARS = int(os.getenv("MODEL_ROUTING_SHORT_PROMPT_CHARS", 200))
+# USD per million prompt and completion tokens
+MODEL_PRICES = json.loads(os.getenv(
+    "MODEL_PRICES", '{"o1-mini": [3.0, 12.0], "gpt-4o-mini": [0.15, 0.6], "gpt-4o": [2.5, 10.0]}'
+))
+# default budgets of a session (0 = none), overridden by the cost_budget_usd / latency_budget_seconds
+# of the request: past them, the agents and the Aggregator are routed to the cheapest or fastest tier.
+# The latency budget is also the deadline of the LLM calls of the turn
+SESSION_COST_BUDGET_USD = float(os.getenv("SESSION_COST_BUDGET_USD", 0))
+SESSION_LATENCY_BUDGET_SECONDS = float(os.getenv("SESSION_LATENCY_BUDGET_SECONDS", 0))
+# latency quantile of a model compared to the time left in the latency budget
+MODEL_ROUTING_LATENCY_QUANTILE = float(os.getenv("MODEL_ROUTING_LATENCY_QUANTILE", 0.95))
+# keep the end of the latency budget for the Aggregator, which then answers from the observations gathered so far
+PARTIAL_AGGREGATION_ENABLED = os.getenv("PARTIAL_AGGREGATION_ENABLED", "1") == "1"
+# time kept for the Aggregator until its model has enough latency samples (at most half of the budget)
+PARTIAL_AGGREGATION_RESERVE_SECONDS = float(os.getenv("PARTIAL_AGGREGATION_RESERVE_SECONDS", 20))
+
+COMPLEXITIES = ('low', 'medium', 'high')
+BUDGET_FIELDS = ('cost_budget_usd', 'latency_budget_seconds')
+
+
+def call_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+def aggregator_reserve(latency_budget_seconds: float) -> float:
+    """
+    Seconds of the latency budget kept for the Aggregator: the latency quantile of its model.
+    """
+    if not PARTIAL_AGGREGATION_ENABLED:
+        return 0.0
+    latency = latency_tracker.quantile(AGGREGATOR_MODEL, MODEL_ROUTING_LATENCY_QUANTILE)
+    return min(latency if latency is not None else PARTIAL_AGGREGATION_RESERVE_SECONDS, latency_budget_seconds / 2)
+
+
+class SessionBudget:
+    """
+    Cost and latency budget of the turn being run. The cost is summed over the turns of
+    the session (AgentDataModel.llm_cost_usd), the latency counts from the start of the turn
+    and sets the deadline of its TurnDeadline.
+    """
+
+    def __init__(self, data_model, cost_budget_usd: float, latency_budget_seconds: float, turn: TurnDeadline = None):
+        self.data_model = data_model
+        self.cost_budget_usd = cost_budget_usd
+        self.latency_budget_seconds = latency_budget_seconds
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.turn = turn or TurnDeadline()
+        if latency_budget_seconds:
+            self.turn.set_deadline(self.start + latency_budget_seconds, aggregator_reserve(latency_budget_seconds))
+
+    def add_cost(self, cost: float):
+        with self.lock:
+            self.data_model.llm_cost_usd += cost
+
+    def cost_exceeded(self) -> bool:
+        return bool(self.cost_budget_usd) and self.data_model.llm_cost_usd >= self.cost_budget_usd
+
+    def remaining_seconds(self) -> Optional[float]:
+        if not self.latency_budget_seconds:
+            return None
+        return self.latency_budget_seconds - (time.monotonic() - self.start)
+
+
+def request_budgets(data: Dict) -> Dict:
+    """
+    The budgets given in a request body, passed to AgentPlanner and kept in the session kwargs.
+    """
+    return {name: float(data[name]) for name in BUDGET_FIELDS if data.get(name) is not None}
+
+
+current_budget = contextvars.ContextVar('current_budget', default=None)
+
+
+@contextlib.contextmanager
+def session_budget(data_model, turn: TurnDeadline = None):
+    """
+    Charges the LLM calls made in the enclosed block, and in the threads and tasks started
+    with its context, to the budget of the session of `data_model`, and bounds them by the
+    deadline of `turn`.
+    """
+    kwargs = data_model.kwargs
+    budget = SessionBudget(
+        data_model,
+        float(kwargs.get('cost_budget_usd') or SESSION_COST_BUDGET_USD),
+        float(kwargs.get('latency_budget_seconds') or SESSION_LATENCY_BUDGET_SECONDS),
+        turn
+    )
+    token = current_budget.set(budget)
+    turn_token = current_turn.set(budget.turn)
+    try:
+        yield budget
+    finally:
+        current_turn.reset(turn_token)
+        current_budget.reset(token)
+
+
+def record_cost(model: str, prompt_tokens: int, completion_tokens: int):
+    """
+    Adds the cost of a request to the LLM cost metric and to the budget of the current session.
+    """
+    cost = call_cost(model, prompt_tokens, completion_tokens)
+    LLM_COST_USD.inc(cost, model=model)
+    budget = current_budget.get()
+    if budget is not None:
+        budget.add_cost(cost)
+
+
+class ModelRouter:
+    """
+    Picks the model of every LLM call of a chain: the planner and the Aggregator have their
+    own model, the other agents the model of their complexity tier. The complexity is the
+    hint of the planner, or is guessed from the length of the task prompt; with routing
+    disabled, every agent runs on the "medium" tier.
+    Once the session is over its cost budget, the agents get the cheapest tier; when the
+    latency quantile of their model does not fit in the time left, the fastest one.
+    """
+
+    def __init__(
+            self,
+            enabled: bool = MODEL_ROUTING_ENABLED,
+            planner_model: str = PLANNER_MODEL,
+            aggregator_model: str = AGGREGATOR_MODEL,
+            tiers: Dict[str, str] = None
+    ):
+        self.enabled = enabled
+        self.planner_model = planner_model
+        self.aggregator_model = aggregator_model
+        self.tiers = tiers or MODEL_TIERS
+        self.logger = logging.getLogger(__name__)
+
+    def complexity(self, agent: Dict):
+        """
+        Returns the complexity of the agent and where it comes from.
+        """
+        hint = str(agent.get('complexity', '')).lower()
+        if hint in COMPLEXITIES:
+            return hint, 'hint'
+        short = len(agent.get('agent_llm_prompt', '')) < MODEL_ROUTING_SHORT_PROMPT_CHARS
+        return 'low' if short else 'medium', 'prompt_length'
+
+    def cheapest_model(self) -> str:
+        return min(self.tiers.values(), key=lambda model: sum(MODEL_PRICES.get(model, (0.0, 0.0))))
+
+    def fastest_model(self) -> Optional[str]:
+        """
+        The tier with the lowest latency quantile, or None while no tier has enough samples.
+        """
+        latencies = {model: latency_tracker.quantile(model, MODEL_ROUTING_LATENCY_QUANTILE) for model in self.tiers.values()}
+        known = {model: latency for model, latency in latencies.items() if latency is not None}
+        return min(known, key=known.get) if known else None
+
+    def apply_budget(self, model: str):
+        budget = current_budget.get()
+        if budget is None:
+            return model, None
+        if budget.cost_exceeded():
+            return self.cheapest_model(), 'cost_budget'
+        remaining = budget.remaining_seconds()
+        if remaining is not None:
+            latency = latency_tracker.quantile(model, MODEL_ROUTING_LATENCY_QUANTILE)
+            if latency is not None and latency > remaining:
+                return self.fastest_model() or model, 'latency_budget'
+        return model, None
+
+    def route(self, role: str, model: str, reason: str) -> str:
+        # the budgets are set per session, so they apply with the tiers disabled too
+        if role != 'planner':
+            routed_model, budget_reason = self.apply_budget(model)
+            if budget_reason and routed_model != model:
+                self.logger.info('🟠 --------------------- Session over its %s: %s instead of %s', budget_reason, routed_model, model)
+                model, reason = routed_model, budget_reason
+        LLM_ROUTED_CALLS.inc(role=role, model=model, reason=reason)
+        return model
+
+    def planner(self) -> str:
+        return self.route('planner', self.planner_model, 'role')
+
+    def agent(self, agent: Dict) -> str:
+        if agent['agent_nickname'] == 'Aggregator':
+            return self.route('aggregator', self.aggregator_model, 'role')
+        if not self.enabled:
+            return self.route('agent', self.tiers['medium'], 'default')
+        complexity, reason = self.complexity(agent)
+        return self.route('agent', self.tiers[complexity], reason)
+
+
+model_router = ModelRouter()
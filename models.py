@@ -1,9 +1,16 @@
 # helpers/utils.py
 
-from openai import OpenAI
 import logging
 import os
+import time
+import asyncio
 import traceback  
+from llm_cache import llm_cache, LLM_CACHE_ENABLED
+from llm_scheduler import llm_scheduler, PRIORITY_CRITICAL, PRIORITY_INTERACTIVE
+from llm_resilience import resilient_caller, latency_tracker, DeadlineExceededError
+from telemetry import span
+from model_router import record_cost
+from llm_backends import get_backend, LLMRateLimitError
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,26 +20,230 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
+def handle_api_error(e: Exception):
+    if isinstance(e, LLMRateLimitError):
+        llm_scheduler.rate_limited(e.retry_after)
+    logger.error(f"LLM API error: {str(e)}")
+    logger.error(traceback.format_exc())
+
+
+def used_tokens(completion):
+    usage = getattr(completion, 'usage', None)
+    return usage.total_tokens if usage else None
+
+
+def record_usage(request_span, ticket, completion=None):
+    request_span.set(queue_wait=round(ticket.admitted_at - ticket.enqueued, 6))
+    usage = getattr(completion, 'usage', None)
+    if usage:
+        request_span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+        record_cost(request_span.attributes['model'], usage.prompt_tokens, usage.completion_tokens)
+
+
+def remaining_seconds(deadline: float) -> float:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceededError("LLM call deadline passed while waiting for the scheduler")
+    return remaining
+
+
+def request_completion(prompt: str, model: str, priority: int, deadline: float) -> str:
+    """
+    One request to the LLM backend, admitted by llm_scheduler and bounded by `deadline`.
+    """
+    backend = get_backend()
+    with span('llm_request', model=model, priority=priority, backend=backend.name) as request_span:
+        ticket = llm_scheduler.acquire(prompt, priority, deadline)
+        completion = None
+        try:
+            start = time.monotonic()
+            completion = backend.complete(prompt, model, remaining_seconds(deadline))
+            latency_tracker.observe(model, time.monotonic() - start)
+
+            answer = completion.text.strip()
+            return answer
+        except Exception as e:
+            handle_api_error(e)
+            raise e
+        finally:
+            llm_scheduler.release(ticket, used_tokens(completion))
+            record_usage(request_span, ticket, completion)
 
-client = OpenAI(
-    api_key=OPENAI_API_KEY 
-)
 
-def call_openai_model(prompt: str = None, model: str = "o1-mini") -> str:
-    try:
-        completion = client.chat.completions.create(
-            model=model, 
-            messages=[
-                {"role": "user", "content": prompt},
-            ]
+async def request_completion_async(prompt: str, model: str, priority: int, deadline: float) -> str:
+    backend = get_backend()
+    with span('llm_request', model=model, priority=priority, backend=backend.name) as request_span:
+        ticket = await llm_scheduler.acquire_async(prompt, priority, deadline)
+        completion = None
+        try:
+            start = time.monotonic()
+            completion = await backend.complete_async(prompt, model, remaining_seconds(deadline))
+            latency_tracker.observe(model, time.monotonic() - start)
+
+            answer = completion.text.strip()
+            return answer
+        except Exception as e:
+            handle_api_error(e)
+            raise e
+        finally:
+            llm_scheduler.release(ticket, used_tokens(completion))
+            record_usage(request_span, ticket, completion)
+
+
+def call_openai_model(
+        prompt: str = None,
+        model: str = "o1-mini",
+        use_cache: bool = False,
+        priority: int = PRIORITY_INTERACTIVE
+) -> str:
+    """
+    Every call waits for its turn in the process-wide llm_scheduler, in `priority` order,
+    and is retried, hedged and bounded by a deadline by resilient_caller. The critical calls
+    (the Aggregator) may use the time the latency budget of the turn keeps in reserve for them.
+    With `use_cache`, identical calls are answered from the LLM cache and concurrent ones share one request.
+    """
+    if use_cache and LLM_CACHE_ENABLED:
+        return llm_cache.get_or_call(
+            llm_cache.make_key(model, prompt),
+            lambda: call_openai_model(prompt=prompt, model=model, priority=priority),
+            deadline=resilient_caller.call_deadline(critical=priority == PRIORITY_CRITICAL)
         )
+    return resilient_caller.call(
+        lambda deadline: request_completion(prompt, model, priority, deadline),
+        model,
+        critical=priority == PRIORITY_CRITICAL
+    )
+
+
+async def call_openai_model_async(
+        prompt: str = None,
+        model: str = "o1-mini",
+        use_cache: bool = False,
+        priority: int = PRIORITY_INTERACTIVE
+) -> str:
+    """
+    Same as `call_openai_model`, without blocking the event loop.
+    """
+    if use_cache and LLM_CACHE_ENABLED:
+        return await llm_cache.get_or_call_async(
+            llm_cache.make_key(model, prompt),
+            lambda: call_openai_model_async(prompt=prompt, model=model, priority=priority),
+            deadline=resilient_caller.call_deadline(critical=priority == PRIORITY_CRITICAL)
+        )
+    return await resilient_caller.call_async(
+        lambda deadline: request_completion_async(prompt, model, priority, deadline),
+        model,
+        critical=priority == PRIORITY_CRITICAL
+    )
+
+
+def stream_openai_model(
+        prompt: str = None,
+        model: str = "o1-mini",
+        use_cache: bool = False,
+        priority: int = PRIORITY_INTERACTIVE
+):
+    """
+    Yields the completion as it is generated, one content delta at a time.
+    A request that fails before its first token is retried; streams are never hedged.
+    With `use_cache`, a cached answer is yielded at once, and a streamed one is cached when complete.
+    """
+    use_cache = use_cache and LLM_CACHE_ENABLED
+    if use_cache:
+        key = llm_cache.make_key(model, prompt)
+        answer = llm_cache.get(key)
+        if answer is not None:
+            yield answer
+            return
+    backend = get_backend()
+    deadline = resilient_caller.call_deadline(critical=priority == PRIORITY_CRITICAL)
+    attempt = 0
+    while True:
+        resilient_caller.check_deadline(deadline)
+        with span('llm_request', model=model, priority=priority, backend=backend.name, stream=True) as request_span:
+            ticket = llm_scheduler.acquire(prompt, priority, deadline)
+            tokens = []
+            # the last chunk carries the usage of the request
+            usage_chunk = None
+            try:
+                start = time.monotonic()
+                stream = backend.stream(prompt, model, remaining_seconds(deadline))
+                for chunk in stream:
+                    if chunk.usage:
+                        usage_chunk = chunk
+                    if chunk.text:
+                        tokens.append(chunk.text)
+                        yield chunk.text
+                latency_tracker.observe(model, time.monotonic() - start)
+                if use_cache:
+                    llm_cache.set(key, ''.join(tokens).strip())
+                return
+            except Exception as e:
+                handle_api_error(e)
+                # tokens already sent to the caller cannot be taken back
+                delay = None if tokens else resilient_caller.retry_delay(attempt, e, deadline)
+                if delay is None:
+                    resilient_caller.fail(e)
+                    raise e
+                request_span.outcome = 'error'
+                request_span.set(error=type(e).__name__)
+            finally:
+                llm_scheduler.release(ticket, used_tokens(usage_chunk))
+                record_usage(request_span, ticket, usage_chunk)
+        time.sleep(delay)
+        attempt += 1
+
 
-        answer = completion.choices[0].message.content.strip()
-        return answer
-    except Exception as e:
-        logger.error(f"OpenAI API error: {str(e)}")
-        logger.error(traceback.format_exc())  
-        raise e
\ No newline at end of file
+async def stream_openai_model_async(
+        prompt: str = None,
+        model: str = "o1-mini",
+        use_cache: bool = False,
+        priority: int = PRIORITY_INTERACTIVE
+):
+    """
+    Same as `stream_openai_model`, without blocking the event loop.
+    """
+    use_cache = use_cache and LLM_CACHE_ENABLED
+    if use_cache:
+        key = llm_cache.make_key(model, prompt)
+        answer = await llm_cache.get_async(key)
+        if answer is not None:
+            yield answer
+            return
+    backend = get_backend()
+    deadline = resilient_caller.call_deadline(critical=priority == PRIORITY_CRITICAL)
+    attempt = 0
+    while True:
+        resilient_caller.check_deadline(deadline)
+        with span('llm_request', model=model, priority=priority, backend=backend.name, stream=True) as request_span:
+            ticket = await llm_scheduler.acquire_async(prompt, priority, deadline)
+            tokens = []
+            # the last chunk carries the usage of the request
+            usage_chunk = None
+            try:
+                start = time.monotonic()
+                stream = backend.stream_async(prompt, model, remaining_seconds(deadline))
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage_chunk = chunk
+                    if chunk.text:
+                        tokens.append(chunk.text)
+                        yield chunk.text
+                latency_tracker.observe(model, time.monotonic() - start)
+                if use_cache:
+                    await llm_cache.set_async(key, ''.join(tokens).strip())
+                return
+            except Exception as e:
+                handle_api_error(e)
+                # tokens already sent to the caller cannot be taken back
+                delay = None if tokens else resilient_caller.retry_delay(attempt, e, deadline)
+                if delay is None:
+                    resilient_caller.fail(e)
+                    raise e
+                request_span.outcome = 'error'
+                request_span.set(error=type(e).__name__)
+            finally:
+                llm_scheduler.release(ticket, used_tokens(usage_chunk))
+                record_usage(request_span, ticket, usage_chunk)
+        await asyncio.sleep(delay)
+        attempt += 1
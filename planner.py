@@ -2,39 +2,128 @@
 import json
 import re
 import os
+import time
+import uuid
+import asyncio
 import logging
-import concurrent.futures
-from typing import List, Dict
+import threading
+import contextlib
+import contextvars
+from typing import List, Dict, Optional
 from prompts import (
     SYSTEM_PROMPT_AGENT_PLANNER, 
     JSON_CHAIN_EXAMPLE, 
     DIPENDENT_AGENT_PROMPT,
-    AGGREGATOR_PROMPT
+    AGGREGATOR_PROMPT,
+    PARTIAL_AGGREGATOR_PROMPT,
+    MISSING_OUTPUTS_NOTE
 )
-from models import call_openai_model
-from agent_session_manager import AgentSessionManager
+from models import call_openai_model, call_openai_model_async, stream_openai_model, stream_openai_model_async
+from agent_session_manager import AgentSessionManager, StaleHistoryError
 from agent_data_model import AgentDataModel
+from chain_scheduler import ChainScheduler
+from chain_stream import ChainStreamParser, parse_chain
+from aggregation import plan_aggregation
+from context_builder import ContextBuilder
+from chain_cache import chain_cache, CHAIN_CACHE_ENABLED
+from llm_scheduler import PRIORITY_CRITICAL, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from telemetry import span, set_span_attributes, CHAINS_IN_FLIGHT
+from session_logs import SessionLogBuffer, SessionLogHandler, capture_session_logs
+from model_router import model_router, session_budget
+from llm_resilience import TurnDeadline, TurnCancelledError
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
+AGENT_MAX_WORKERS = int(os.getenv("AGENT_MAX_WORKERS", 5))
+# call sites answered from the LLM cache: the planner call and the agent calls
+LLM_CACHE_PLANNER = os.getenv("LLM_CACHE_PLANNER", "1") == "1"
+LLM_CACHE_AGENTS = os.getenv("LLM_CACHE_AGENTS", "1") == "1"
+# ask a pending user question at once, and run the agents that do not depend on it after the turn
+SPECULATIVE_EXECUTION_ENABLED = os.getenv("SPECULATIVE_EXECUTION_ENABLED", "1") == "1"
+# interval at which the next turn checks whether the agents run in the background are done
+SPECULATIVE_POLL_SECONDS = float(os.getenv("SPECULATIVE_POLL_SECONDS", 0.2))
+# stream the planner answer and start the agents without inputs as soon as they are generated
+PLANNER_STREAMING_ENABLED = os.getenv("PLANNER_STREAMING_ENABLED", "1") == "1"
+# save the planned chain and every agent observation as they complete, so that an interrupted turn can be resumed
+CHAIN_CHECKPOINT_ENABLED = os.getenv("CHAIN_CHECKPOINT_ENABLED", "1") == "1"
 
+# ask every pending user question of the chain in one turn (overridden by "questionnaire" in the request)
+QUESTIONNAIRE_ENABLED = os.getenv("QUESTIONNAIRE_ENABLED", "0") == "1"
+
+QUESTIONNAIRE_INTRO = (
+    "Please answer the following questions, one per line starting with its number (e.g. \"1. ...\"). "
+    "You can leave some of them out, they will be asked again."
+)
+NUMBERED_LINE = re.compile(r'^\s*(\d+)\s*[.):-]\s*(.*)$')
+
+# background tasks of the async planners, referenced until they finish
+speculative_tasks = set()
+
+
+# one handler for every planner of the process: each record goes to the log buffer of the running session
+session_log_handler = SessionLogHandler()
+session_log_handler.setLevel(logging.INFO)
+session_log_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+logging.getLogger(__name__).addHandler(session_log_handler)
+
+
+def questionnaire_options(data: Dict) -> Dict:
+    """
+    The `questionnaire` mode and the structured `answers` of a request, passed to AgentPlanner.
+    """
+    return {name: data[name] for name in ('questionnaire', 'answers') if data.get(name) is not None}
 
-class MemoryLogHandler(logging.Handler):
-    def __init__(self, memory_logs: List[str], *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.memory_logs = memory_logs
 
-    def emit(self, record):
-        log_entry = self.format(record)
-        self.memory_logs.append(log_entry)
+def parse_numbered_answers(text: str, count: int) -> Dict[int, str]:
+    """
+    Splits a free-text reply to a questionnaire of `count` questions into {index: answer},
+    from lines starting with the 1-based question number. An unnumbered reply answers the
+    first question.
+    """
+    answers = {}
+    current = None
+    for line in text.splitlines():
+        match = NUMBERED_LINE.match(line)
+        if match and 1 <= int(match.group(1)) <= count:
+            current = int(match.group(1)) - 1
+            answers[current] = match.group(2)
+        elif current is not None:
+            answers[current] += '\n' + line
+    if not answers and text.strip():
+        answers[0] = text
+    return {index: answer.strip() for index, answer in answers.items() if answer.strip()}
+
+
+def delta_turn(data: Dict) -> Dict:
+    """
+    The new `message` and the `history_length` of a request without session_chat_history,
+    passed to AgentPlanner with chat_history=None.
+    """
+    if data.get('session_chat_history') is not None:
+        return {}
+    return {'message': data.get('message'), 'history_length': data.get('history_length')}
+
 
 class AgentPlanner:
     def __init__(
             self, 
-            chat_history: List[Dict],
+            chat_history: Optional[List[Dict]],
             **kwargs
     ):
+        # data_model is passed by create_async, which loads the session without blocking
+        data_model = kwargs.pop('data_model', None)
+        # a delta turn sends only the new message, appended to the chat history stored in the session
+        message = kwargs.pop('message', None)
+        history_length = kwargs.pop('history_length', None)
+        # answers to a questionnaire, {question id: answer}; only the mode is kept in the session kwargs
+        self.answers = kwargs.pop('answers', None)
+        # whether the turn holds the lease of its chain; set by chain_recovery, which takes
+        # the lease of the interrupted chain before loading it
+        self.lease_acquired = kwargs.pop('lease_acquired', False)
+        # on_event(event, data) receives the chain progress, e.g. to stream it to the client
+        self.on_event = kwargs.pop('on_event', None)
+        self.context_builder = kwargs.pop('context_builder', None) or ContextBuilder()
         is_interactive = kwargs.get('is_interactive', True)
         self.logger = logging.getLogger(__name__)
 
@@ -47,8 +136,19 @@ class AgentPlanner:
                 redis_port=REDIS_PORT, 
                 db=REDIS_DB
             )
-            logging.info('🟣 --------------------- Loading session: %s', f'planner-{session_id}')
-            self.data = self.session_manager.load_session(f'planner-{session_id}')
+            if data_model is None:
+                logging.info('🟣 --------------------- Loading session: %s', f'planner-{session_id}')
+                data_model = self.session_manager.load_session(f'planner-{session_id}')
+            self.data = data_model
+            # saved in the middle of a chain: its turn was interrupted, or is still running elsewhere
+            self.interrupted = self.data.state == 'running_chain'
+            if chat_history is None:
+                if message is None and self.answers:
+                    message = self.render_answers(self.answers)
+                chat_history = self.delta_chat_history(message, history_length)
+            self.resuming = self.interrupted and self.retries_interrupted_turn(chat_history)
+            if self.interrupted and not self.resuming:
+                self.drop_interrupted_chain()
             self.data.kwargs.update(kwargs)
             self.data.session_id = self.data.session_id or f"planner-{self.data.kwargs.get('session_id', None)}"
             self.data.is_interactive = self.data.is_interactive or self.data.kwargs.get('is_interactive', False)
@@ -62,7 +162,11 @@ class AgentPlanner:
             )
 
         else:
+            if chat_history is None:
+                raise ValueError("chat_history is required for not interactive mode")
             self.data = AgentDataModel(name="AgentNotInteractive")
+            self.interrupted = False
+            self.resuming = False
             self.data.kwargs.update(kwargs)
             self.data.session_id = self.data.session_id or f"planner-{self.data.kwargs.get('session_id', None)}"
             self.data.is_interactive = self.data.is_interactive or self.data.kwargs.get('is_interactive', False)
@@ -74,15 +178,114 @@ class AgentPlanner:
             self.data.initial_message = self.data.initial_message or next(
                 (msg['content'] for msg in chat_history if msg.get('role') == 'user'), ''
             )
-      
-        memory_handler = MemoryLogHandler(self.data.memory_logs)
-        memory_handler.setLevel(logging.INFO)
-        formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
-        memory_handler.setFormatter(formatter)
 
-        if not any(isinstance(h, MemoryLogHandler) for h in self.logger.handlers):
-            self.logger.addHandler(memory_handler)
+        # logs of this session's turns, saved to its capped log stream with the session
+        self.data.log_buffer = SessionLogBuffer()
+        # agents left to run in the background once the turn is saved
+        self.speculative_scheduler = None
+        # agents started while the planner answer was streaming, taken over by elab_chain
+        self.streaming_scheduler = None
+        # set once the turn is saved, for the agents started early that are still running
+        self.speculating = False
+        # tree-reduce plan of the Aggregator of a wide chain, see chain_scheduler
+        self.aggregation = None
+        # deadline (from the latency budget) and cancellation of the turn, seen by all its LLM calls
+        self.turn = TurnDeadline()
+        # subtask agents the Aggregator answers without, their time having run out
+        self.missing_agents = []
+
+    @classmethod
+    async def create_async(cls, chat_history: Optional[List[Dict]], **kwargs) -> 'AgentPlanner':
+        """
+        Builds an AgentPlanner loading the interactive session with async Redis access.
+        """
+        session_id = kwargs.get('session_id')
+        if kwargs.get('is_interactive', True) and session_id:
+            session_manager = AgentSessionManager(
+                redis_host=REDIS_HOST,
+                redis_port=REDIS_PORT,
+                db=REDIS_DB
+            )
+            logging.info('🟣 --------------------- Loading session: %s', f'planner-{session_id}')
+            data_model = await session_manager.load_session_async(f'planner-{session_id}')
+            if chat_history is None or data_model.state == 'running_chain':
+                # a delta turn appends to the stored history, an interrupted turn is compared with it
+                await session_manager.load_field_async(data_model, 'chat_history')
+            kwargs['data_model'] = data_model
+        return cls(chat_history, **kwargs)
+
+    @staticmethod
+    def load_session_logs(session_id, count: int = 200) -> List[str]:
+        """
+        Returns the last `count` log entries saved for the session of `session_id`, oldest first.
+        """
+        session_manager = AgentSessionManager(redis_host=REDIS_HOST, redis_port=REDIS_PORT, db=REDIS_DB)
+        return session_manager.load_logs(f'planner-{session_id}', count)
+
+    @staticmethod
+    async def load_session_logs_async(session_id, count: int = 200) -> List[str]:
+        session_manager = AgentSessionManager(redis_host=REDIS_HOST, redis_port=REDIS_PORT, db=REDIS_DB)
+        return await session_manager.load_logs_async(f'planner-{session_id}', count)
+
+    def delta_chat_history(self, message: str, history_length: Optional[int]) -> List[Dict]:
+        """
+        The stored chat history followed by the new user message. `history_length` is the
+        length of the history the client knows: when it differs from the stored one, the
+        client missed or replayed a turn.
+        """
+        if not message:
+            raise ValueError("message is required when chat_history is not sent")
+        stored_history = self.data.chat_history
+        if self.interrupted and stored_history and stored_history[-1].get('role') == 'user':
+            # the message of the interrupted turn, never answered: the client sends it again or replaces it
+            stored_history = stored_history[:-1]
+        if history_length is not None and int(history_length) != len(stored_history):
+            raise StaleHistoryError(
+                f"Chat history of {self.data.session_id} has {len(stored_history)} messages, "
+                f"the client knows {history_length}"
+            )
+        return stored_history + [{'role': 'user', 'content': message}]
+
+    def retries_interrupted_turn(self, chat_history: List[Dict]) -> bool:
+        """
+        Whether the turn sends again the message of the interrupted turn, whose chain is then
+        resumed from its checkpoints instead of planned again.
+        """
+        stored_history = self.data.chat_history
+        last_message = next((msg for msg in reversed(stored_history) if msg.get('role') == 'user'), None)
+        new_message = next((msg for msg in reversed(chat_history) if msg.get('role') == 'user'), None)
+        return last_message is not None and new_message is not None and last_message['content'] == new_message['content']
+
+    def drop_interrupted_chain(self):
+        self.logger.info('🟠 --------------------- Dropping the interrupted chain, the user sent another message')
+        self.reset_to_init_data_model()
+        # the next chain may reuse the nicknames of the saved observations
+        self.data.saved_observations = []
+
+    def reply(self) -> Dict:
+        # history_length is sent back by the client with its next delta turn
+        reply = {"assistant": self.data.final_answer, "history_length": len(self.data.chat_history)}
+        if self.data.pending_questions:
+            reply["questions"] = self.pending_question_entries()
+        return reply
 
+    def record_answer(self):
+        # the stored history stays complete for the delta turns, a full history sent by a client replaces it
+        self.data.chat_history = self.data.chat_history + [{'role': 'assistant', 'content': self.data.final_answer}]
+
+    @staticmethod
+    def load_chat_history(session_id) -> List[Dict]:
+        """
+        Returns the chat history stored for the session of `session_id`, to resync a client.
+        """
+        session_manager = AgentSessionManager(redis_host=REDIS_HOST, redis_port=REDIS_PORT, db=REDIS_DB)
+        return session_manager.load_session(f'planner-{session_id}').chat_history
+
+    @staticmethod
+    async def load_chat_history_async(session_id) -> List[Dict]:
+        session_manager = AgentSessionManager(redis_host=REDIS_HOST, redis_port=REDIS_PORT, db=REDIS_DB)
+        data_model = await session_manager.load_session_async(f'planner-{session_id}')
+        return await session_manager.load_field_async(data_model, 'chat_history')
 
     def reset_to_init_data_model(self):
         """
@@ -94,10 +297,12 @@ class AgentPlanner:
         reset_fields = {
             'initial_message': '',
             'json_chain': None,
+            'chain_id': None,
             'state': 'idle',
             'agent_chain_step': 0,
-            'sequential_agent_step': 0,
-            'memory_logs': [],
+            'pending_question_agent': None,
+            'pending_questions': [],
+            'speculative_agents': [],
             'thought_history': []
         }
 
@@ -107,13 +312,14 @@ class AgentPlanner:
         self.logger.info('✅ --------------------- AgentDataModel has been reset to initial state')
 
 
-    def sanitize_gpt_response(self, response_str: str) -> str:
-        response_str = re.sub(r'^```json\s*', '', response_str, flags=re.MULTILINE)
-        response_str = re.sub(r'```$', '', response_str, flags=re.MULTILINE)
-        return response_str.strip() 
+    def emit(self, event: str, data: Dict):
+        if self.on_event:
+            self.on_event(event, data)
 
     def gen_prompt_for_dipendent_agents(self, agent_nickname: str, connected_agents: List[Dict], agent_llm_prompt: str) -> str:
-        json_chain_copy = self.data.json_chain.copy()
+        current_agent = next(
+            (a for a in self.data.json_chain['agents'] if a['agent_nickname'] == agent_nickname), {}
+        )
 
         if agent_nickname != 'Aggregator':
             connected_agents_str = ""
@@ -122,229 +328,855 @@ class AgentPlanner:
                 connected_agent_nicknames = [agent['agent_nickname'] for agent in connected_agents]
                 connected_agents_str = f"These are the agents nicknames from which your input comes: {', '.join(connected_agent_nicknames)}\n"
 
-            for agent in json_chain_copy['agents']:
-                if agent['agent_nickname'] not in connected_agent_nicknames:
-                    agent.pop('observation', None)
-            self.data.json_chain = json_chain_copy
-
+            context = self.context_builder.agent_context(
+                self.data.json_chain, agent_nickname, connected_agent_nicknames
+            )
             GENERATED_PROMPT = DIPENDENT_AGENT_PROMPT.format(
                 agent_nickname=agent_nickname,
                 agent_llm_prompt=agent_llm_prompt,
                 connected_agents_str=connected_agents_str,
-                json_chain_without_useless_info=json_chain_copy,
+                json_chain_without_useless_info=context,
                 initial_message=self.data.initial_message,
-                user_questions=self.data.json_chain['agents'][self.data.agent_chain_step].get('user_questions', []),
-                user_answers=self.data.json_chain['agents'][self.data.agent_chain_step].get('user_answers', [])
+                user_questions=current_agent.get('user_questions', []),
+                user_answers=current_agent.get('user_answers', [])
             )
 
             self.logger.info('\n\n\n🟣 --------------------- Generated prompt for agent %s:\n%s', agent_nickname, GENERATED_PROMPT)
+            self.log_prompt_tokens(agent_nickname, GENERATED_PROMPT, context)
             return GENERATED_PROMPT
 
         else:
+            inputs = None
+            if self.aggregation:
+                inputs = self.aggregation.inputs(self.aggregation.top, self.chain_observations())
+            context = self.context_builder.aggregator_context(self.data.json_chain, agent_nickname, inputs)
             GENERATED_AGGREGATOR_PROMPT = AGGREGATOR_PROMPT.format(
                 agent_nickname=agent_nickname,
                 agent_llm_prompt=agent_llm_prompt,
-                json_chain_without_useless_info=json_chain_copy,
+                json_chain_without_useless_info=context,
                 initial_message=self.data.initial_message
             )
+            if self.missing_agents:
+                GENERATED_AGGREGATOR_PROMPT += MISSING_OUTPUTS_NOTE.format(agent_nicknames=', '.join(self.missing_agents))
             self.logger.info('\n\n\n🟣 --------------------- Generated prompt for final agent Aggregator\n: %s', GENERATED_AGGREGATOR_PROMPT)
+            self.log_prompt_tokens(agent_nickname, GENERATED_AGGREGATOR_PROMPT, context)
             return GENERATED_AGGREGATOR_PROMPT
 
+    def log_prompt_tokens(self, agent_nickname: str, prompt: str, context: str):
+        self.logger.info(
+            '🟣 --------------------- Prompt of agent %s: %s tokens, of which %s of chain context',
+            agent_nickname, self.context_builder.count_tokens(prompt), self.context_builder.count_tokens(context)
+        )
+
     def manage_user_questions(self, step: int) -> str:
         user_questions = self.data.json_chain['agents'][step].get('user_questions', [])
         user_answers = self.data.json_chain['agents'][step].get('user_answers', [])
         self.logger.info('⚪ --------------------- Updated User questions for agent %s: %s', self.data.json_chain['agents'][step]['agent_nickname'], user_questions)
         self.logger.info('⚪ --------------------- Updated User answers for agent %s: %s', self.data.json_chain['agents'][step]['agent_nickname'], user_answers)
-        if len(user_questions) > len(user_answers):
-            return user_questions[len(user_answers)]
+        unanswered = self.unanswered_questions(self.data.json_chain['agents'][step])
+        if unanswered:
+            return user_questions[unanswered[0]]
         else:
             return None
-               
 
-    def run_parallel_agents(self, agents: List[Dict]):
-        def process_agent(agent: Dict):
-            try:
-                self.data.agent_chain_step = next(
-                    index for index, a in enumerate(self.data.json_chain['agents']) 
-                    if a['agent_nickname'] == agent['agent_nickname']
-                )
-                
-                connected_agents = [
-                    a for a in self.data.json_chain['agents']
-                    if 'observation' in a and a['agent_nickname'] in agent.get('input_from_agents', [])
-                ]
-                
-                agent_prompt = self.gen_prompt_for_dipendent_agents(
-                    agent['agent_nickname'], connected_agents, agent['agent_llm_prompt']
-                )
-                
-                agent_output = call_openai_model(
-                    prompt=agent_prompt,
-                    model="o1-mini"
-                )
-                
-                for ag in self.data.json_chain['agents']:
-                    if ag['agent_nickname'] == agent['agent_nickname']:
-                        ag['observation'] = agent_output
-                        break
-                
-                self.logger.info(
-                    '\n\n🟡 ---------------------Step nr %s, Generated observation for parallel agent %s\n: %s',
-                    self.data.agent_chain_step, agent['agent_nickname'], agent_output
-                )
-            
-            except Exception as e:
-                self.logger.error(f"Error processing agent {agent['agent_nickname']}: {e}")
+    def unanswered_questions(self, agent: Dict) -> List[int]:
+        # a questionnaire can leave gaps (None) in user_answers
+        user_answers = agent.get('user_answers', []) or []
+        return [
+            index for index in range(len(agent.get('user_questions', []) or []))
+            if index >= len(user_answers) or user_answers[index] is None
+        ]
+
+    def set_user_answer(self, agent: Dict, index: int, answer: str):
+        user_answers = agent.setdefault('user_answers', [])
+        user_answers.extend([None] * (index + 1 - len(user_answers)))
+        user_answers[index] = answer
 
+    def has_pending_questions(self, agent: Dict) -> bool:
+        if not self.data.is_interactive:
+            return False
+        return bool(self.unanswered_questions(agent))
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+    def register_user_answer(self):
+        if self.data.pending_questions:
+            return self.register_questionnaire_answers()
+        subtask_agents = self.data.json_chain['agents'][0:-1]
+        agent = next(
+            (a for a in subtask_agents if a['agent_nickname'] == self.data.pending_question_agent),
+            None
+        ) or next(
+            (a for a in subtask_agents if self.has_pending_questions(a)),
+            None
+        )
+        if agent is None:
+            self.logger.warning('🟠 --------------------- No agent is waiting for the user answer')
+            return
+        self.set_user_answer(agent, self.unanswered_questions(agent)[0], self.data.chat_history[-1]['content'])
+        self.data.pending_question_agent = None
 
-            futures = [executor.submit(process_agent, agent) for agent in agents]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    self.logger.error(f"Agent processing generated an exception: {e}")
-                    
+    def uses_questionnaire(self) -> bool:
+        return bool(self.data.kwargs.get('questionnaire', QUESTIONNAIRE_ENABLED))
 
-    def run_sequential_agents(self, agents: List[Dict]):
+    def pending_question_entries(self) -> List[Dict]:
+        """
+        The questions of the last questionnaire, with their id, agent and text.
+        """
+        agents = {agent['agent_nickname']: agent for agent in self.data.json_chain['agents']}
+        entries = []
+        for question_id in self.data.pending_questions:
+            nickname, _, index = question_id.rpartition(':')
+            entries.append({
+                'id': question_id, 'agent_nickname': nickname,
+                'question': agents[nickname]['user_questions'][int(index)]
+            })
+        return entries
 
-        start_step = self.data.sequential_agent_step
+    def render_answers(self, answers: Dict[str, str]) -> str:
+        # chat history entry of a structured submission
+        questions = {entry['id']: entry['question'] for entry in self.pending_question_entries()}
+        return '\n'.join(
+            f"{questions.get(question_id, question_id)}: {answer}" for question_id, answer in answers.items()
+        )
 
-        for agent in agents[start_step:]:
-            self.data.agent_chain_step = next(
-                index for index, a in enumerate(self.data.json_chain['agents']) 
-                if a['agent_nickname'] == agent['agent_nickname']
+    def register_questionnaire_answers(self):
+        """
+        Routes the answers to the last questionnaire to the user_answers of their agents: the structured
+        `answers` of the request, or the numbered lines of the user message. Questions left out stay pending.
+        """
+        entries = self.pending_question_entries()
+        if self.answers:
+            unknown = [question_id for question_id in self.answers if question_id not in self.data.pending_questions]
+            if unknown:
+                self.logger.warning('🟠 --------------------- Answers to unknown questions ignored: %s', unknown)
+            answers = {
+                index: str(self.answers[entry['id']]).strip() for index, entry in enumerate(entries)
+                if str(self.answers.get(entry['id']) or '').strip()
+            }
+        else:
+            answers = parse_numbered_answers(self.data.chat_history[-1]['content'], len(entries))
+        agents = {agent['agent_nickname']: agent for agent in self.data.json_chain['agents']}
+        for index, answer in answers.items():
+            nickname, _, question_index = entries[index]['id'].rpartition(':')
+            self.set_user_answer(agents[nickname], int(question_index), answer)
+        self.logger.info('⚪ --------------------- Questionnaire: %s of %s questions answered', len(answers), len(entries))
+        self.data.pending_questions = []
+
+    def chain_agent_prompt(self, agent: Dict) -> str:
+        self.emit('agent_start', {'agent_nickname': agent['agent_nickname']})
+        connected_agents = [
+            a for a in self.data.json_chain['agents']
+            if 'observation' in a and a['agent_nickname'] in agent.get('input_from_agents', [])
+        ]
+        return self.gen_prompt_for_dipendent_agents(
+            agent['agent_nickname'], connected_agents, agent['agent_llm_prompt']
+        )
+
+    def store_chain_agent_output(self, agent: Dict, agent_output: str) -> str:
+        step = next(
+            index for index, a in enumerate(self.data.json_chain['agents'])
+            if a['agent_nickname'] == agent['agent_nickname']
+        )
+        agent['observation'] = agent_output
+        self.emit('agent_finish', {'agent_nickname': agent['agent_nickname'], 'observation': agent_output})
+        self.logger.info(
+            '\n\n🟡 ---------------------Step nr %s, Generated observation for agent %s\n: %s',
+            step, agent['agent_nickname'], agent_output
+        )
+        return agent_output
+
+    def llm_priority(self) -> int:
+        # a user waits on interactive turns, batch chains can yield to them
+        return PRIORITY_INTERACTIVE if self.data.is_interactive else PRIORITY_BATCH
+
+    def agent_depth(self, agent_nickname: str) -> int:
+        """
+        Length of the longest chain of inputs leading to the agent (0 = no inputs).
+        """
+        inputs = {a['agent_nickname']: a.get('input_from_agents', []) or [] for a in self.data.json_chain['agents']}
+        depths = {}
+
+        def depth(nickname, visiting):
+            if nickname not in depths:
+                upstream = [n for n in inputs.get(nickname, []) if n in inputs and n not in visiting]
+                depths[nickname] = 1 + max((depth(n, visiting | {n}) for n in upstream), default=-1)
+            return depths[nickname]
+
+        return depth(agent_nickname, frozenset({agent_nickname}))
+
+    def agent_span(self, agent: Dict):
+        return span('agent_call', agent=agent['agent_nickname'], depth=self.agent_depth(agent['agent_nickname']))
+
+    def agent_model(self, agent: Dict) -> str:
+        model = model_router.agent(agent)
+        set_span_attributes(model=model)
+        return model
+
+    def run_chain_agent(self, agent: Dict) -> str:
+        if self.aggregation and self.aggregation.is_node(agent):
+            return self.run_synthesis(agent)
+        with self.agent_span(agent):
+            agent_output = call_openai_model(
+                prompt=self.chain_agent_prompt(agent),
+                model=self.agent_model(agent),
+                use_cache=LLM_CACHE_AGENTS,
+                priority=self.llm_priority()
             )
+            return self.store_chain_agent_output(agent, agent_output)
 
-            self.logger.info(f"agent_chain_step ------------------------------------------------: {self.data.agent_chain_step}")
-            if self.data.state == 'waiting_for_user_answer':
-                if 'user_answers' not in self.data.json_chain['agents'][self.data.agent_chain_step]:
-                    self.data.json_chain['agents'][self.data.agent_chain_step]['user_answers'] = [self.data.chat_history[-1]['content']]
-                else:
-                    self.data.json_chain['agents'][self.data.agent_chain_step]['user_answers'].append(self.data.chat_history[-1]['content'])
-
-            if self.data.is_interactive:
-                new_user_question = self.manage_user_questions(self.data.agent_chain_step)
-                if new_user_question:
-                    self.data.final_answer = new_user_question
-                    self.data.state = 'waiting_for_user_answer'
-                    return True #temporary stop the script and give api response
-                else:
-                    self.data.state = 'running_chain'
-            
-            connected_agents = [
-                a for a in self.data.json_chain['agents']
-                if 'observation' in a and a['agent_nickname'] in agent.get('input_from_agents', [])
-            ]
-            agent_prompt = self.gen_prompt_for_dipendent_agents(
-                agent['agent_nickname'], connected_agents, agent['agent_llm_prompt']
+    async def run_chain_agent_async(self, agent: Dict) -> str:
+        if self.aggregation and self.aggregation.is_node(agent):
+            return await self.run_synthesis_async(agent)
+        with self.agent_span(agent):
+            agent_output = await call_openai_model_async(
+                prompt=self.chain_agent_prompt(agent),
+                model=self.agent_model(agent),
+                use_cache=LLM_CACHE_AGENTS,
+                priority=self.llm_priority()
             )
-            agent_output = call_openai_model(
-                prompt=agent_prompt,
-                model="o1-mini"
+            return self.store_chain_agent_output(agent, agent_output)
+
+    def chain_observations(self) -> Dict[str, str]:
+        return {a['agent_nickname']: a['observation'] for a in self.data.json_chain['agents'] if 'observation' in a}
+
+    def synthesis_prompt(self, node: Dict) -> str:
+        nickname = node['agent_nickname']
+        inputs = self.aggregation.inputs(node['input_from_agents'], self.chain_observations())
+        context = self.context_builder.synthesis_context(self.data.json_chain, nickname, inputs)
+        prompt = PARTIAL_AGGREGATOR_PROMPT.format(
+            agent_nickname=nickname,
+            agent_llm_prompt=self.data.json_chain['agents'][-1]['agent_llm_prompt'],
+            initial_message=self.data.initial_message,
+            json_chain_without_useless_info=context
+        )
+        self.log_prompt_tokens(nickname, prompt, context)
+        return prompt
+
+    def synthesis_inputs(self, node: Dict) -> List[str]:
+        # saved observations of the agents the synthesis covers, to load before its prompt
+        return self.observations_to_load([{'input_from_agents': self.aggregation.covers[node['agent_nickname']]}])
+
+    def store_synthesis(self, node: Dict, synthesis: str) -> str:
+        node['observation'] = synthesis
+        self.logger.info(
+            '\n\n🟡 --------------------- Synthesis %s of %s\n: %s',
+            node['agent_nickname'], ', '.join(node['input_from_agents']), synthesis
+        )
+        return synthesis
+
+    def run_synthesis(self, node: Dict) -> str:
+        """
+        Runs an intermediate synthesis of the tree-reduce aggregation (see AggregationTree).
+        """
+        if self.data.is_interactive:
+            self.load_observations(self.synthesis_inputs(node))
+        with span('synthesis_call', agent=node['agent_nickname'], level=node['aggregation_level']):
+            synthesis = call_openai_model(
+                prompt=self.synthesis_prompt(node),
+                model=self.agent_model(node),
+                use_cache=LLM_CACHE_AGENTS,
+                priority=PRIORITY_CRITICAL
             )
-            for ag in self.data.json_chain['agents']:
-                if ag['agent_nickname'] == agent['agent_nickname']:
-                    ag['observation'] = agent_output
-                    break
-            self.logger.info(
-                '\n\n🟡 ---------------------Step nr %s, Generated observation for sequential agent %s\n: %s',
-                self.data.agent_chain_step, agent['agent_nickname'], agent_output
+        return self.store_synthesis(node, synthesis)
+
+    async def run_synthesis_async(self, node: Dict) -> str:
+        if self.data.is_interactive:
+            await self.load_observations_async(self.synthesis_inputs(node))
+        with span('synthesis_call', agent=node['agent_nickname'], level=node['aggregation_level']):
+            synthesis = await call_openai_model_async(
+                prompt=self.synthesis_prompt(node),
+                model=self.agent_model(node),
+                use_cache=LLM_CACHE_AGENTS,
+                priority=PRIORITY_CRITICAL
             )
-            self.data.sequential_agent_step += 1
-        return False
+        return self.store_synthesis(node, synthesis)
 
-    
-    def run_single_agent(self, agent: Dict):
+    def single_agent_prompt(self, agent: Dict) -> str:
         self.data.agent_chain_step = next(
             index for index, a in enumerate(self.data.json_chain['agents']) 
             if a['agent_nickname'] == agent['agent_nickname']
         )
-        agent_prompt = self.gen_prompt_for_dipendent_agents(
+        return self.gen_prompt_for_dipendent_agents(
             agent['agent_nickname'], [], agent['agent_llm_prompt']
         )
-        agent_output = call_openai_model(
-            prompt=agent_prompt,
-            model="o1-mini"
-        )
+
+    def log_single_agent_output(self, agent: Dict, agent_output: str):
         self.logger.info(
             '\n\n🟡 ---------------------Step nr %s, Generated observation for sequential agent %s\n: %s',
             self.data.agent_chain_step, agent['agent_nickname'], agent_output
         )
+
+    def run_single_agent(self, agent: Dict):
+        with self.agent_span(agent):
+            prompt = self.single_agent_prompt(agent)
+            model = self.agent_model(agent)
+            if self.on_event:
+                # stream the answer token by token to whoever listens to the chain events
+                tokens = []
+                for token in stream_openai_model(
+                        prompt=prompt, model=model, use_cache=LLM_CACHE_AGENTS, priority=PRIORITY_CRITICAL
+                ):
+                    tokens.append(token)
+                    self.emit('token', {'agent_nickname': agent['agent_nickname'], 'token': token})
+                agent_output = ''.join(tokens).strip()
+            else:
+                agent_output = call_openai_model(
+                    prompt=prompt,
+                    model=model,
+                    use_cache=LLM_CACHE_AGENTS,
+                    priority=PRIORITY_CRITICAL
+                )
+        self.log_single_agent_output(agent, agent_output)
         return agent_output
-    
 
-    def elab_chain(self):
-        agents = self.data.json_chain['agents']
-        
-        subtask_agents = agents[0:-1]
+    async def run_single_agent_async(self, agent: Dict):
+        with self.agent_span(agent):
+            prompt = self.single_agent_prompt(agent)
+            model = self.agent_model(agent)
+            if self.on_event:
+                # stream the answer token by token to whoever listens to the chain events
+                tokens = []
+                async for token in stream_openai_model_async(
+                        prompt=prompt, model=model, use_cache=LLM_CACHE_AGENTS, priority=PRIORITY_CRITICAL
+                ):
+                    tokens.append(token)
+                    self.emit('token', {'agent_nickname': agent['agent_nickname'], 'token': token})
+                agent_output = ''.join(tokens).strip()
+            else:
+                agent_output = await call_openai_model_async(
+                    prompt=prompt,
+                    model=model,
+                    use_cache=LLM_CACHE_AGENTS,
+                    priority=PRIORITY_CRITICAL
+                )
+        self.log_single_agent_output(agent, agent_output)
+        return agent_output
+
+    def chain_scheduler(self, run_agent) -> ChainScheduler:
+        if self.data.state == 'waiting_for_user_answer':
+            self.register_user_answer()
+        self.data.state = 'running_chain'
+        agents = self.data.json_chain['agents'][0:-1] + self.plan_aggregation()
+        scheduler, self.streaming_scheduler = self.streaming_scheduler, None
+        if scheduler is None:
+            return self.new_chain_scheduler(agents, run_agent)
+        # the agents started while the planner answer was streaming are already running
+        scheduler.add_agents(agents)
+        return scheduler
 
-        # run subtask_agents with no user questions and no input from other agents
-        agents_noquest_nodep = [
-            agent for agent in subtask_agents
-            if not agent.get('user_questions') and not agent.get('input_from_agents')
+    def plan_aggregation(self) -> List[Dict]:
+        """
+        The synthesis nodes of a tree-reduce aggregation, run by the scheduler with the agents
+        (none when the chain is aggregated in one call).
+        """
+        agents = self.data.json_chain['agents'][0:-1]
+        order = {agent['agent_nickname']: index for index, agent in enumerate(agents)}
+        # agents likely to complete together are synthesized together
+        leaves = sorted(order, key=lambda nickname: (self.agent_depth(nickname), order[nickname]))
+        self.aggregation = plan_aggregation(leaves, self.data.json_chain['agents'][-1]['agent_nickname'])
+        if self.aggregation is None:
+            return []
+        self.logger.info(
+            '🟤 --------------------- Tree-reduce aggregation of %s agents: %s syntheses, %s inputs to the Aggregator',
+            len(leaves), len(self.aggregation.nodes), len(self.aggregation.top)
+        )
+        return self.aggregation.nodes
+
+    def is_blocked(self, agent: Dict) -> bool:
+        if self.aggregation and self.aggregation.is_node(agent):
+            # a synthesis would be lost if the turn ends with a question
+            return any(self.has_pending_questions(a) for a in self.data.json_chain['agents'][0:-1])
+        return self.has_pending_questions(agent)
+
+    def new_chain_scheduler(self, agents: List[Dict], run_agent) -> ChainScheduler:
+        # every agent starts as soon as its input_from_agents have an observation,
+        # agents with unanswered user questions block only their own branch
+        return ChainScheduler(
+            agents,
+            run_agent=run_agent,
+            is_blocked=self.is_blocked,
+            max_workers=AGENT_MAX_WORKERS,
+            completed=self.data.saved_observations
+        )
+
+    def observations_to_load(self, agents: Optional[List[Dict]] = None) -> List[str]:
+        """
+        Nicknames of the saved observations, not loaded yet, that `agents` take as input
+        (all of them when `agents` is None).
+        """
+        chain_agents = {a['agent_nickname']: a for a in self.data.json_chain['agents']}
+        if agents is None:
+            inputs = set(chain_agents)
+        else:
+            inputs = {nickname for agent in agents for nickname in agent.get('input_from_agents', []) or []}
+        return [
+            nickname for nickname in self.data.saved_observations
+            if nickname in inputs and nickname in chain_agents and 'observation' not in chain_agents[nickname]
         ]
-        if self.data.state != 'waiting_for_user_answer':
-            self.run_parallel_agents(agents_noquest_nodep)
-
-        agents_noquest_depwithobs = [
-            agent for agent in subtask_agents
-            if agent not in agents_noquest_nodep and not agent.get('user_questions') and all(
-                any(a['agent_nickname'] == input_nickname and 'observation' in a and a['observation']
-                    for a in self.data.json_chain['agents'])
-                for input_nickname in agent.get('input_from_agents', [])
-            )
+
+    def pending_chain_agents(self) -> List[Dict]:
+        return [
+            a for a in self.data.json_chain['agents'][0:-1]
+            if 'observation' not in a and a['agent_nickname'] not in self.data.saved_observations
         ]
-        if self.data.state != 'waiting_for_user_answer':
-            self.run_parallel_agents(agents_noquest_depwithobs)
 
-        sequential_agents = [
-            agent for agent in subtask_agents
-            if agent not in agents_noquest_nodep and agent not in agents_noquest_depwithobs
+    def set_observations(self, observations: Dict[str, str]):
+        for agent in self.data.json_chain['agents']:
+            if agent['agent_nickname'] in observations:
+                agent['observation'] = observations[agent['agent_nickname']]
+
+    def load_observations(self, nicknames: List[str]):
+        if nicknames:
+            self.set_observations(self.session_manager.load_observations(self.data.session_id, nicknames))
+
+    async def load_observations_async(self, nicknames: List[str]):
+        if nicknames:
+            self.set_observations(await self.session_manager.load_observations_async(self.data.session_id, nicknames))
+
+    def ask_questionnaire(self, blocked: List[Dict]) -> bool:
+        """
+        Asks every unanswered question of the blocked agents in one turn.
+        """
+        self.data.pending_questions = [
+            f"{agent['agent_nickname']}:{index}"
+            for agent in blocked if self.has_pending_questions(agent)
+            for index in self.unanswered_questions(agent)
         ]
-        self.logger.info('🟣 --------------------- Running sequential agents: %s', sequential_agents)
-        must_block = self.run_sequential_agents(sequential_agents)
-        if must_block:
+        if not self.data.pending_questions:
+            return False
+        self.data.final_answer = QUESTIONNAIRE_INTRO + '\n\n' + '\n'.join(
+            f"{number}. {entry['question']}" for number, entry in enumerate(self.pending_question_entries(), 1)
+        )
+        self.data.pending_question_agent = None
+        self.data.state = 'waiting_for_user_answer'
+        return True
+
+    def ask_blocked_question(self, blocked: List[Dict]) -> bool:
+        if self.aggregation:
+            blocked = [agent for agent in blocked if not self.aggregation.is_node(agent)]
+        if self.uses_questionnaire():
+            return self.ask_questionnaire(blocked)
+        agents = self.data.json_chain['agents']
+        for agent in blocked:
+            new_user_question = self.manage_user_questions(agents.index(agent))
+            if new_user_question:
+                self.data.final_answer = new_user_question
+                self.data.pending_question_agent = agent['agent_nickname']
+                self.data.state = 'waiting_for_user_answer'
+                return True
+        return False
+
+    def ask_question_early(self, scheduler: ChainScheduler) -> bool:
+        """
+        With speculative execution, a pending user question is asked before any agent runs,
+        and the agents that do not depend on it are left to `run_speculative_agents`.
+        """
+        if not SPECULATIVE_EXECUTION_ENABLED or not self.data.is_interactive:
+            return False
+        pending = [agent for agent in scheduler.agents if agent['agent_nickname'] not in scheduler.completed]
+        if not self.ask_blocked_question(pending):
+            return False
+        self.speculative_scheduler = scheduler
+        # saved with the turn: the next one waits for these agents instead of running them again
+        self.data.speculative_agents = [agent['agent_nickname'] for agent in pending if not self.is_blocked(agent)]
+        return True
+
+    def take_checkpointed_observations(self, observations: Dict[str, str]):
+        # observations of the agents that completed after the last save of the session
+        observations = {
+            nickname: observation for nickname, observation in observations.items()
+            if nickname not in self.data.saved_observations
+        }
+        if observations:
+            self.logger.info('🟤 --------------------- Observations taken from the agent checkpoints: %s', ', '.join(observations))
+            self.set_observations(observations)
+
+    def takes_checkpoints_over(self) -> bool:
+        return self.data.is_interactive and (self.data.state == 'waiting_for_user_answer' or self.resuming)
+
+    def speculation_wait_over(self) -> bool:
+        self.turn.check()
+        deadline = self.turn.call_deadline(critical=False)
+        if deadline is not None and time.monotonic() >= deadline:
+            self.logger.warning('🟠 --------------------- Latency budget spent, not waiting for the background agents anymore')
+            return True
+        return False
+
+    def wait_for_speculative_agents(self):
+        """
+        Waits for the agents the previous turn left running in the background (see
+        `run_speculative_agents`), so that their observations are taken from their checkpoints
+        instead of being generated again. Those that failed, or did not end within the latency
+        budget of the turn, are run again.
+        """
+        if not self.data.speculative_agents:
+            return
+        self.logger.info('🟤 --------------------- Waiting for the background agents: %s', ', '.join(self.data.speculative_agents))
+        while self.session_manager.speculation_running(self.data) and not self.speculation_wait_over():
+            time.sleep(SPECULATIVE_POLL_SECONDS)
+        self.data.speculative_agents = []
+        self.data.llm_cost_usd += self.session_manager.take_speculation_cost(self.data.session_id)
+
+    async def wait_for_speculative_agents_async(self):
+        if not self.data.speculative_agents:
+            return
+        self.logger.info('🟤 --------------------- Waiting for the background agents: %s', ', '.join(self.data.speculative_agents))
+        while await self.session_manager.speculation_running_async(self.data) and not self.speculation_wait_over():
+            await asyncio.sleep(SPECULATIVE_POLL_SECONDS)
+        self.data.speculative_agents = []
+        self.data.llm_cost_usd += await self.session_manager.take_speculation_cost_async(self.data.session_id)
+
+    def take_speculative_scheduler(self) -> Optional[ChainScheduler]:
+        scheduler, self.speculative_scheduler = self.speculative_scheduler, None
+        if scheduler is not None:
+            # the turn has been answered, nobody listens to its events anymore
+            self.on_event = None
+            self.speculating = True
+        return scheduler
+
+    def run_speculative_agents(self):
+        """
+        Runs the agents left by `ask_question_early` in a background thread, saving every
+        observation to the session as soon as it is generated. Called in the turn context:
+        the thread keeps its log capture, and charges its LLM calls to the session budget,
+        with a deadline of its own since the turn has been answered.
+        """
+        scheduler = self.take_speculative_scheduler()
+        if scheduler is None:
+            return
+        cost_usd = self.data.llm_cost_usd
+
+        def run():
+            try:
+                with session_budget(self.data), span('speculative_chain', session_id=self.data.session_id):
+                    scheduler.run()
+            finally:
+                self.session_manager.end_speculation(self.data, self.data.llm_cost_usd - cost_usd)
+
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), name='speculative-chain', daemon=True).start()
+
+    def start_speculative_agents_async(self):
+        """
+        Same as `run_speculative_agents`, as a task of the running event loop (which runs it
+        in a copy of the turn context).
+        """
+        scheduler = self.take_speculative_scheduler()
+        if scheduler is None:
+            return
+        cost_usd = self.data.llm_cost_usd
+
+        async def run():
+            try:
+                with session_budget(self.data), span('speculative_chain', session_id=self.data.session_id):
+                    await scheduler.run_async()
+            finally:
+                await self.session_manager.end_speculation_async(self.data, self.data.llm_cost_usd - cost_usd)
+
+        task = asyncio.ensure_future(run())
+        speculative_tasks.add(task)
+        task.add_done_callback(speculative_tasks.discard)
+
+    def checkpoints_agents(self) -> bool:
+        # the agents run in the background after the turn is saved always checkpoint their observation
+        return self.speculating or (CHAIN_CHECKPOINT_ENABLED and self.data.is_interactive)
+
+    def is_checkpointed(self, agent: Dict) -> bool:
+        # the syntheses of a tree-reduce aggregation are planned again by a resumed chain
+        return self.checkpoints_agents() and not (self.aggregation and self.aggregation.is_node(agent))
+
+    def run_checkpointed_agent(self, agent: Dict) -> str:
+        agent_output = self.run_chain_agent(agent)
+        if self.is_checkpointed(agent):
+            self.session_manager.save_agent_checkpoint(self.data, agent['agent_nickname'], agent_output)
+        return agent_output
+
+    async def run_checkpointed_agent_async(self, agent: Dict) -> str:
+        agent_output = await self.run_chain_agent_async(agent)
+        if self.is_checkpointed(agent):
+            await self.session_manager.save_agent_checkpoint_async(self.data, agent['agent_nickname'], agent_output)
+        return agent_output
+
+    def checkpoint_chain(self):
+        """
+        Saves the planned chain before its agents complete, leased to this turn: if the turn
+        is interrupted, the next one (or chain_recovery.py) resumes it from the agent checkpoints.
+        """
+        if CHAIN_CHECKPOINT_ENABLED and self.data.is_interactive:
+            self.session_manager.save_session(self.data)
+            self.lease_acquired = True
+
+    async def checkpoint_chain_async(self):
+        if CHAIN_CHECKPOINT_ENABLED and self.data.is_interactive:
+            await self.session_manager.save_session_async(self.data)
+            self.lease_acquired = True
+
+    def check_partial_aggregation(self):
+        """
+        Once the latency budget left only the Aggregator's reserve, the agents that did not
+        complete in time are left out and the Aggregator is told about them.
+        """
+        if not self.turn.agents_expired():
+            return
+        self.missing_agents = [a['agent_nickname'] for a in self.data.json_chain['agents'][0:-1] if 'observation' not in a]
+        if self.missing_agents:
+            self.logger.warning(
+                '🟠 --------------------- Latency budget spent, aggregating without %s', ', '.join(self.missing_agents)
+            )
+            set_span_attributes(partial_aggregation=len(self.missing_agents))
+            self.data.chain_stats = {**(self.data.chain_stats or {}), 'missing': self.missing_agents}
+
+    def cancel(self, reason: str = 'cancelled'):
+        """
+        Cancels the turn, e.g. when its client went away: the queued LLM calls of the turn
+        leave the llm_scheduler, and no new call is sent. The requests in flight are cancelled
+        in async mode, and end by their deadline in sync mode.
+        """
+        self.logger.warning('🟠 --------------------- Turn cancelled: %s', reason)
+        self.turn.cancel(reason)
+
+    def abandon_cancelled_chain(self):
+        # the chain resumes if the client sends its message again, not through chain_recovery
+        if self.lease_acquired:
+            self.session_manager.abandon_chain(self.data.session_id)
+
+    async def abandon_cancelled_chain_async(self):
+        if self.lease_acquired:
+            await self.session_manager.abandon_chain_async(self.data.session_id)
+
+    def cancel_streaming_agents(self):
+        # agents started while the planner answer was streaming
+        if self.streaming_scheduler is not None:
+            for task in self.streaming_scheduler.running:
+                task.cancel()
+
+    def release_failed_chain(self):
+        # the chain stays checkpointed: a retry of the request resumes it at once, or chain_recovery does
+        if self.lease_acquired:
+            self.session_manager.release_chain_lease(self.data.session_id)
+
+    async def release_failed_chain_async(self):
+        if self.lease_acquired:
+            await self.session_manager.release_chain_lease_async(self.data.session_id)
+
+    def complete_chain(self, aggregator_agent_output: str):
+        self.data.final_answer = aggregator_agent_output
+        self.data.state = 'completed'
+        self.reset_to_init_data_model()
+
+    def elab_chain(self):
+        if self.takes_checkpoints_over():
+            self.wait_for_speculative_agents()
+            self.take_checkpointed_observations(self.session_manager.load_agent_checkpoints(self.data))
+        # a resumed chain loads only the saved observations its remaining agents take as input
+        self.load_observations(self.observations_to_load(self.pending_chain_agents()))
+        scheduler = self.chain_scheduler(self.run_checkpointed_agent)
+        if self.ask_question_early(scheduler):
+            return
+        self.data.chain_stats = scheduler.run()
+        self.turn.check()
+
+        if self.ask_blocked_question(scheduler.blocked):
             return #temporary stop the script and give api response
 
         # run aggregator agent
-        if self.data.sequential_agent_step == len(sequential_agents):
-            aggregator_agent = agents[-1]
-            aggregator_agent_output = self.run_single_agent(aggregator_agent)
+        self.load_observations(self.observations_to_load())
+        self.check_partial_aggregation()
+        aggregator_agent = self.data.json_chain['agents'][-1]
+        self.complete_chain(self.run_single_agent(aggregator_agent))
 
-            self.data.final_answer = aggregator_agent_output
-            self.data.state = 'completed'
-            self.reset_to_init_data_model()
+    async def elab_chain_async(self):
+        if self.takes_checkpoints_over():
+            await self.wait_for_speculative_agents_async()
+            self.take_checkpointed_observations(await self.session_manager.load_agent_checkpoints_async(self.data))
+        # a resumed chain loads only the saved observations its remaining agents take as input
+        await self.load_observations_async(self.observations_to_load(self.pending_chain_agents()))
+        scheduler = self.chain_scheduler(self.run_checkpointed_agent_async)
+        if self.ask_question_early(scheduler):
+            return
+        self.data.chain_stats = await scheduler.run_async()
+        self.turn.check()
 
+        if self.ask_blocked_question(scheduler.blocked):
+            return #temporary stop the script and give api response
 
-    def run_planner(self):
-        if self.data.state != 'waiting_for_user_answer':
-            self.logger.info('\n\n🟢 --------------------- Starting planner')
-            self.data.state = 'running_chain'
-            response = call_openai_model(
-                prompt=self.data.start_system_prompt.format(
-                    initial_message=self.data.initial_message, 
-                    json_chain_example=JSON_CHAIN_EXAMPLE
-                ),
-                model="o1-mini"
-            )
-            
-            self.data.json_chain = json.loads(self.sanitize_gpt_response(response))
-            if not self.data.is_interactive:
-                self.logger.info('🟣 --------------------- Removing user questions from json chain for not interactive mode')
-                for agent in self.data.json_chain.get('agents', []):
-                    agent['user_questions'] = []
-            self.logger.info(
-                '\n\n\n🔵 --------------------- Generated initial json chain:\n%s', 
-                json.dumps(self.data.json_chain, indent=4)
-            )
-            self.elab_chain()
-        else:
-            self.logger.info('\n\n🟢 --------------------- Received user answer, running chain')
-            self.elab_chain()
-        if self.data.is_interactive:
-            self.session_manager.save_session(self.data)
-            
+        # run aggregator agent
+        await self.load_observations_async(self.observations_to_load())
+        self.check_partial_aggregation()
+        aggregator_agent = self.data.json_chain['agents'][-1]
+        self.complete_chain(await self.run_single_agent_async(aggregator_agent))
+
+    def planner_prompt(self) -> str:
+        self.logger.info('\n\n🟢 --------------------- Starting planner')
+        self.data.state = 'running_chain'
+        # set before the agents started while the planner answer streams checkpoint their observation
+        self.data.chain_id = uuid.uuid4().hex
+        return self.data.start_system_prompt.format(
+            initial_message=self.data.initial_message, 
+            json_chain_example=JSON_CHAIN_EXAMPLE
+        )
+
+    def uses_chain_cache(self) -> bool:
+        # cached chains were planned with the default system prompt
+        return CHAIN_CACHE_ENABLED and self.data.start_system_prompt == SYSTEM_PROMPT_AGENT_PLANNER
 
+    def streamed_agent(self, agent: Dict):
+        self.logger.info('🔵 --------------------- Planned agent %s', agent['agent_nickname'])
+        self.emit('agent_planned', agent)
+
+    def request_json_chain(self, prompt: str):
+        """
+        Returns the json_chain and the answer of the planner. While the answer streams, every
+        agent without inputs or pending questions is started as soon as it is generated,
+        on the scheduler that elab_chain takes over.
+        """
+        model = model_router.planner()
+        if not PLANNER_STREAMING_ENABLED:
+            response = call_openai_model(prompt=prompt, model=model, use_cache=LLM_CACHE_PLANNER, priority=self.llm_priority())
+            return parse_chain(response), response
+        parser = ChainStreamParser()
+        scheduler = self.new_chain_scheduler([], self.run_checkpointed_agent)
+        # the agents started early see the part of the chain generated before them
+        self.data.json_chain = {'agents': parser.agents}
+        # captured outside the stream, whose request span is current between its chunks
+        context = contextvars.copy_context()
+        for chunk in stream_openai_model(prompt=prompt, model=model, use_cache=LLM_CACHE_PLANNER, priority=self.llm_priority()):
+            for agent in parser.feed(chunk):
+                self.streamed_agent(agent)
+                context.run(scheduler.start, agent)
+        set_span_attributes(streamed_agents=len(scheduler.running))
+        self.streaming_scheduler = scheduler
+        return parser.finish(), parser.text
+
+    async def request_json_chain_async(self, prompt: str):
+        """
+        Same as `request_json_chain`, starting the agents as tasks of the running event loop.
+        """
+        model = model_router.planner()
+        if not PLANNER_STREAMING_ENABLED:
+            response = await call_openai_model_async(prompt=prompt, model=model, use_cache=LLM_CACHE_PLANNER, priority=self.llm_priority())
+            return parse_chain(response), response
+        parser = ChainStreamParser()
+        scheduler = self.new_chain_scheduler([], self.run_checkpointed_agent_async)
+        self.data.json_chain = {'agents': parser.agents}
+        context = contextvars.copy_context()
+        async for chunk in stream_openai_model_async(prompt=prompt, model=model, use_cache=LLM_CACHE_PLANNER, priority=self.llm_priority()):
+            for agent in parser.feed(chunk):
+                self.streamed_agent(agent)
+                context.run(scheduler.start_async, agent)
+        set_span_attributes(streamed_agents=len(scheduler.running))
+        self.streaming_scheduler = scheduler
+        return parser.finish(), parser.text
 
+    def load_json_chain(self, json_chain: Dict):
+        self.data.json_chain = json_chain
+        if not self.data.is_interactive:
+            self.logger.info('🟣 --------------------- Removing user questions from json chain for not interactive mode')
+            for agent in self.data.json_chain.get('agents', []):
+                agent['user_questions'] = []
+        self.logger.info(
+            '\n\n\n🔵 --------------------- Generated initial json chain:\n%s', 
+            json.dumps(self.data.json_chain, indent=4)
+        )
+        self.emit('json_chain', self.data.json_chain)
+
+    @contextlib.contextmanager
+    def turn_context(self, mode: str):
+        # a turn is traced as a chain span, its logs go to the session log buffer
+        # and its LLM calls are charged to the session budget
+        CHAINS_IN_FLIGHT.inc()
+        try:
+            with capture_session_logs(self.data.log_buffer), session_budget(self.data, self.turn), span(
+                    'chain', mode=mode, session_id=self.data.session_id,
+                    resumed=self.data.state == 'waiting_for_user_answer' or self.resuming
+            ) as chain:
+                yield chain
+                chain.set(state=self.data.state)
+        finally:
+            CHAINS_IN_FLIGHT.dec()
+
+    def run_planner(self):
+        with self.turn_context('sync'):
+            try:
+                if self.interrupted and not self.lease_acquired:
+                    self.session_manager.acquire_chain_lease(self.data.session_id)
+                    self.lease_acquired = True
+                if self.resuming:
+                    self.logger.info('\n\n🟢 --------------------- Resuming the interrupted chain from its checkpoints')
+                    self.emit('json_chain', self.data.json_chain)
+                    self.elab_chain()
+                elif self.data.state != 'waiting_for_user_answer':
+                    prompt = self.planner_prompt()
+                    with span('planner_call') as planner_call:
+                        json_chain = chain_cache.lookup(self.data.initial_message) if self.uses_chain_cache() else None
+                        planner_call.set(chain_cache_hit=json_chain is not None)
+                        if json_chain is None:
+                            planner_start = time.monotonic()
+                            json_chain, response = self.request_json_chain(prompt)
+                            if self.uses_chain_cache():
+                                # parsed again, the agents of json_chain may already be running
+                                chain_cache.store(self.data.initial_message, parse_chain(response), time.monotonic() - planner_start)
+                    self.load_json_chain(json_chain)
+                    self.checkpoint_chain()
+                    self.elab_chain()
+                else:
+                    self.logger.info('\n\n🟢 --------------------- Received user answer, running chain')
+                    self.emit('json_chain', self.data.json_chain)
+                    self.elab_chain()
+                if self.data.is_interactive:
+                    self.record_answer()
+                    self.session_manager.save_session(self.data)
+            except TurnCancelledError:
+                self.abandon_cancelled_chain()
+                raise
+            except Exception:
+                self.release_failed_chain()
+                raise
+            self.run_speculative_agents()
+
+    async def run_planner_async(self):
+        """
+        Same as `run_planner`, awaiting the LLM and Redis calls so that one event loop
+        can serve many chains that are only waiting on network I/O.
+        """
+        with self.turn_context('async'):
+            try:
+                if self.interrupted and not self.lease_acquired:
+                    await self.session_manager.acquire_chain_lease_async(self.data.session_id)
+                    self.lease_acquired = True
+                if self.resuming:
+                    self.logger.info('\n\n🟢 --------------------- Resuming the interrupted chain from its checkpoints')
+                    self.emit('json_chain', self.data.json_chain)
+                    await self.elab_chain_async()
+                elif self.data.state != 'waiting_for_user_answer':
+                    prompt = self.planner_prompt()
+                    with span('planner_call') as planner_call:
+                        json_chain = await chain_cache.lookup_async(self.data.initial_message) if self.uses_chain_cache() else None
+                        planner_call.set(chain_cache_hit=json_chain is not None)
+                        if json_chain is None:
+                            planner_start = time.monotonic()
+                            json_chain, response = await self.request_json_chain_async(prompt)
+                            if self.uses_chain_cache():
+                                # parsed again, the agents of json_chain may already be running
+                                await chain_cache.store_async(self.data.initial_message, parse_chain(response), time.monotonic() - planner_start)
+                    self.load_json_chain(json_chain)
+                    await self.checkpoint_chain_async()
+                    await self.elab_chain_async()
+                else:
+                    self.logger.info('\n\n🟢 --------------------- Received user answer, running chain')
+                    self.emit('json_chain', self.data.json_chain)
+                    await self.elab_chain_async()
+                if self.data.is_interactive:
+                    self.record_answer()
+                    await self.session_manager.save_session_async(self.data)
+            except (asyncio.CancelledError, TurnCancelledError):
+                if not self.turn.cancelled.is_set():
+                    # e.g. the ASGI server cancels the request when its client disconnects
+                    self.cancel('request task cancelled')
+                self.cancel_streaming_agents()
+                await self.abandon_cancelled_chain_async()
+                raise
+            except Exception:
+                self.cancel_streaming_agents()
+                await self.release_failed_chain_async()
+                raise
+            self.start_speculative_agents_async()
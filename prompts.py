@@ -9,6 +9,7 @@ Each will have the following attributes:
 - **agent_llm_prompt**: The extended prompt to send to the LLM. The prompt must be specific and well-structured to enable the model to create the appropriate output contextualized to the overall project.
 - **input_from_agents**: An array listing all `agent_nickname`s whose outputs should feed into this agent's input.
 - **user_questions**: An array listing the information needed to best generate the output; these will be questions directed to the user, and must be in the same language as the user prompt.
+- **complexity**: `low` for simple tasks (short answers, lists, extraction, reformatting), `medium` for standard analysis or writing tasks, `high` for tasks needing deep multi-step reasoning, calculations or planning. It is used to choose the model running the agent, so do not overrate it.
 
 **Important Instructions:**
 
@@ -34,6 +35,7 @@ You should generate a JSON chain like this:
       "agent_nickname": "MarketAnalysis",
       "agent_llm_prompt": "Conduct a comprehensive market analysis for a new e-commerce business aiming to break even within 1 year and achieve $1,000,000 revenue in 2 years. Include industry trends, target demographics, competitor analysis, and potential market size.",
       "input_from_agents": [],
+      "complexity": "medium",
       "user_questions": [
         "What specific products or services will your e-commerce business offer?",
         "Do you have a target geographic market?"
@@ -43,6 +45,7 @@ You should generate a JSON chain like this:
       "agent_nickname": "OperationalPlanning",
       "agent_llm_prompt": "Develop an operational plan for the e-commerce business, including supply chain management, inventory management, order fulfillment, customer service, and technology infrastructure.",
       "input_from_agents": ["MarketAnalysis"],
+      "complexity": "medium",
       "user_questions": [
         "What platforms or technologies are you considering for your e-commerce site?"
       ]
@@ -51,12 +54,14 @@ You should generate a JSON chain like this:
       "agent_nickname": "MarketingStrategy",
       "agent_llm_prompt": "Create a detailed marketing strategy for the e-commerce business, focusing on brand positioning, online marketing channels, content strategy, social media engagement, and advertising campaigns.",
       "input_from_agents": ["MarketAnalysis"],
+      "complexity": "medium",
       "user_questions": []
     },
     {
       "agent_nickname": "ExpenseForecasting",
       "agent_llm_prompt": "Prepare an expense forecast for the e-commerce business for the next two years, including startup costs, operational expenses, marketing budgets, staffing costs, and other relevant expenditures.",
       "input_from_agents": ["OperationalPlanning", "MarketingStrategy"],
+      "complexity": "high",
       "user_questions": [
         "What is your initial budget for starting the business?"
       ]
@@ -65,12 +70,14 @@ You should generate a JSON chain like this:
       "agent_nickname": "CustomerAcquisition",
       "agent_llm_prompt": "Outline customer acquisition strategies for the e-commerce business, including customer acquisition cost (CAC) analysis, retention strategies, referral programs, and loyalty incentives.",
       "input_from_agents": ["MarketingStrategy"],
+      "complexity": "medium",
       "user_questions": []
     },
     {
       "agent_nickname": "CostOptimization",
       "agent_llm_prompt": "Identify opportunities for cost optimization within the e-commerce business operations, including bulk purchasing, automation tools, outsourcing, and process improvements.",
       "input_from_agents": ["ExpenseForecasting"],
+      "complexity": "low",
       "user_questions": [
         "Do you prefer in-house operations or outsourcing certain functions?"
       ]
@@ -79,6 +86,7 @@ You should generate a JSON chain like this:
       "agent_nickname": "GrowthStrategy",
       "agent_llm_prompt": "Develop a growth strategy for the e-commerce business to scale operations, expand product lines, enter new markets, and increase revenue streams over the next two years.",
       "input_from_agents": ["OperationalPlanning", "CustomerAcquisition"],
+      "complexity": "high",
       "user_questions": [
         "Are you considering international markets?"
       ]
@@ -210,3 +218,29 @@ As the Aggregator, your primary responsibility is to collect the outputs from al
 **Final Note:**
 Your aggregation is pivotal for the success of the overall task. Strive to produce a final response that is not only comprehensive and coherent but also rich in detail and articulation, thereby effectively synthesizing the information provided by all agents to meet and exceed the expectations of the initial prompt.
 """
+
+
+PARTIAL_AGGREGATOR_PROMPT = """
+You are an intermediate Aggregator agent, nickname "{agent_nickname}". The outputs of a large group of agents are merged in steps: you synthesize a part of them, and your synthesis is merged with the others by the final Aggregator.
+
+**Task of the final Aggregator:**
+"{agent_llm_prompt}"
+
+**Initial prompt broken down into subtasks by the "Planner":**
+"{initial_message}"
+
+**Outputs to synthesize** (the `observation` attribute of each agent):
+{json_chain_without_useless_info}
+
+**Guidelines:**
+- Merge these outputs into one cohesive synthesis, organized by topic rather than by agent.
+- Keep every fact, figure, recommendation and caveat: the final Aggregator only sees your synthesis, not these outputs.
+- Remove repetitions, and point out contradictions between the agents instead of resolving them silently.
+- Do not write the final answer to the initial prompt, nor an introduction or a conclusion.
+"""
+
+
+MISSING_OUTPUTS_NOTE = """
+**Missing Outputs:**
+The time available for this answer ran out before these agents completed: {agent_nicknames}. Their outputs are missing from the JSON chain. Answer from the outputs available, and state briefly which parts of the task could not be covered.
+"""
@@ -0,0 +1,33 @@
+# runtime_stats.py
+
+from typing import Dict, Optional
+from llm_cache import llm_cache
+from chain_cache import chain_cache
+from llm_scheduler import llm_scheduler
+from llm_resilience import latency_tracker
+
+# components served by app.py and asgi.py at GET /<component>/stats
+STATS = {
+    'llm-cache': llm_cache.stats,
+    'chain-cache': chain_cache.stats,
+    'llm-scheduler': llm_scheduler.stats,
+    'llm-latency': latency_tracker.stats,
+}
+# stats read from Redis, collected without blocking the event loop in asgi.py
+ASYNC_STATS = {
+    'chain-cache': chain_cache.stats_async,
+}
+
+
+def component_stats(component: str) -> Optional[Dict]:
+    """
+    The stats of a component, or None if it has none.
+    """
+    collect = STATS.get(component)
+    return collect() if collect else None
+
+
+async def component_stats_async(component: str) -> Optional[Dict]:
+    if component in ASYNC_STATS:
+        return await ASYNC_STATS[component]()
+    return component_stats(component)
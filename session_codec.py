@@ -0,0 +1,122 @@
+# session_codec.py
+
+import dataclasses
+import json
+import pickle
+import zlib
+from agent_data_model import AgentDataModel
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Layout of a stored session: MAGIC | schema version | codec id | compression id | payload
+MAGIC = b'AMS'
+HEADER_SIZE = len(MAGIC) + 3
+
+# Increase when the fields of AgentDataModel change, and add the upgrade step to migrate_fields.
+# 2: AgentSessionManager stores observations and large lists under their own keys
+# 3: memory_logs replaced by the capped session_logs stream
+# 4: llm_cost_usd added
+# 5: chain_id added
+# 6: pending_questions added
+# 7: speculative_agents added
+# 8: sequential_agent_step removed
+SCHEMA_VERSION = 8
+
+CODECS = {
+    'json': (1, lambda fields: json.dumps(fields, separators=(',', ':')).encode('utf-8'), json.loads),
+    'msgpack': (2, lambda fields: msgpack.packb(fields, use_bin_type=True), lambda payload: msgpack.unpackb(payload, raw=False)),
+}
+
+COMPRESSIONS = {
+    'none': (0, lambda payload: payload, lambda payload: payload),
+    'zlib': (1, lambda payload: zlib.compress(payload, 6), zlib.decompress),
+    'zstd': (2, lambda payload: zstandard.ZstdCompressor(level=3).compress(payload), lambda payload: zstandard.ZstdDecompressor().decompress(payload)),
+}
+
+OPTIONAL_MODULES = {'msgpack': msgpack, 'zstd': zstandard}
+
+
+def migrate_fields(fields: dict, schema_version: int) -> dict:
+    """
+    Upgrades the fields of a session stored with an older schema version.
+    """
+    if schema_version > SCHEMA_VERSION:
+        raise ValueError(f"Session schema version {schema_version} is newer than {SCHEMA_VERSION}")
+    # fields unknown to the current AgentDataModel are dropped, missing ones take their default
+    known = {field.name for field in dataclasses.fields(AgentDataModel)}
+    return {name: value for name, value in fields.items() if name in known}
+
+
+class SessionCodec:
+    """
+    Encodes an AgentDataModel as schema-versioned JSON or msgpack, compressed when
+    the payload is larger than `compression_threshold` bytes. Sessions saved by older
+    releases as raw pickle are still decoded, and rewritten in the new format on save.
+    """
+
+    def __init__(self, codec: str = 'json', compression: str = 'zlib', compression_threshold: int = 1024):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown session codec: {codec}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown session compression: {compression}")
+        for name in (codec, compression):
+            if name in OPTIONAL_MODULES and OPTIONAL_MODULES[name] is None:
+                raise ValueError(f"Session {name} support requires the {name} package to be installed")
+        self.codec = codec
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    def encode(self, data_model: AgentDataModel) -> bytes:
+        return self.encode_fields(dataclasses.asdict(data_model))
+
+    def decode(self, serialized_data: bytes) -> AgentDataModel:
+        return AgentDataModel(**self.decode_fields(serialized_data))
+
+    def encode_fields(self, fields: dict) -> bytes:
+        return self.encode_value(fields)
+
+    def decode_fields(self, serialized_data: bytes) -> dict:
+        if not self.is_encoded(serialized_data):
+            # legacy session saved with pickle.dumps: the unpickled instance only has the
+            # attributes of the AgentDataModel of its release, so it is read as a field dict
+            return migrate_fields(dict(vars(pickle.loads(serialized_data))), 0)
+        schema_version, fields = self.unpack(serialized_data)
+        return migrate_fields(fields, schema_version)
+
+    def encode_value(self, value) -> bytes:
+        codec_id, dumps, _ = CODECS[self.codec]
+        payload = dumps(value)
+        compression = self.compression if len(payload) > self.compression_threshold else 'none'
+        compression_id, compress, _ = COMPRESSIONS[compression]
+        return MAGIC + bytes([SCHEMA_VERSION, codec_id, compression_id]) + compress(payload)
+
+    def decode_value(self, serialized_data: bytes):
+        return self.unpack(serialized_data)[1]
+
+    def unpack(self, serialized_data: bytes):
+        schema_version, codec_id, compression_id = serialized_data[len(MAGIC):HEADER_SIZE]
+        _, _, decompress = self.lookup(COMPRESSIONS, compression_id)
+        _, _, loads = self.lookup(CODECS, codec_id)
+        return schema_version, loads(decompress(serialized_data[HEADER_SIZE:]))
+
+    @staticmethod
+    def is_encoded(serialized_data: bytes) -> bool:
+        return serialized_data[:len(MAGIC)] == MAGIC
+
+    @staticmethod
+    def lookup(registry: dict, format_id: int):
+        for name, entry in registry.items():
+            if entry[0] == format_id:
+                if name in OPTIONAL_MODULES and OPTIONAL_MODULES[name] is None:
+                    raise ValueError(f"Decoding this session requires the {name} package to be installed")
+                return entry
+        raise ValueError(f"Unknown session format id: {format_id}")
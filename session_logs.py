@@ -0,0 +1,84 @@
+# session_logs.py
+
+import os
+import logging
+import threading
+import contextlib
+import contextvars
+import collections
+from typing import List, Tuple
+
+# entries kept per session in its Redis stream, and in memory between two saves
+SESSION_LOG_MAX_ENTRIES = int(os.getenv("SESSION_LOG_MAX_ENTRIES", 1000))
+# longer entries (e.g. whole generated prompts) are cut
+SESSION_LOG_MAX_CHARS = int(os.getenv("SESSION_LOG_MAX_CHARS", 2000))
+
+TRUNCATION_MARK = ' [...]'
+
+
+class SessionLogBuffer:
+    """
+    Ring buffer of the log entries of one session that are not saved yet. When more than
+    `max_entries` are logged between two saves, the oldest ones are dropped.
+    """
+
+    def __init__(self, max_entries: int = SESSION_LOG_MAX_ENTRIES):
+        self.entries = collections.deque(maxlen=max_entries)
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.dropped = 0
+
+    def append(self, entry: str):
+        with self.lock:
+            if len(self.entries) == self.entries.maxlen:
+                self.dropped += 1
+            self.seq += 1
+            self.entries.append((self.seq, entry))
+
+    def snapshot(self) -> Tuple[List[str], int]:
+        """
+        Returns the pending entries and the position to pass to `consume` once they are saved.
+        """
+        with self.lock:
+            return [entry for _, entry in self.entries], self.seq
+
+    def consume(self, seq: int):
+        with self.lock:
+            while self.entries and self.entries[0][0] <= seq:
+                self.entries.popleft()
+
+
+current_log_buffer = contextvars.ContextVar('current_log_buffer', default=None)
+
+
+@contextlib.contextmanager
+def capture_session_logs(buffer: SessionLogBuffer):
+    """
+    Sends the records of SessionLogHandler logged in the enclosed block, and in the
+    threads and tasks started with its context, to `buffer`.
+    """
+    token = current_log_buffer.set(buffer)
+    try:
+        yield buffer
+    finally:
+        current_log_buffer.reset(token)
+
+
+class SessionLogHandler(logging.Handler):
+    """
+    Formats the records into the buffer of the session being run, if any.
+    One handler serves every session of the process.
+    """
+
+    def __init__(self, max_chars: int = SESSION_LOG_MAX_CHARS, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_chars = max_chars
+
+    def emit(self, record):
+        buffer = current_log_buffer.get()
+        if buffer is None:
+            return
+        entry = self.format(record)
+        if len(entry) > self.max_chars:
+            entry = entry[:self.max_chars] + TRUNCATION_MARK
+        buffer.append(entry)
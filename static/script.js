@@ -6,6 +6,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
 
     sessionId = generateSessionId();
+    // number of messages of the chat history stored on the server, sent with every new message
+    let historyLength = 0;
 
     chatForm.addEventListener('submit', async (e) => {
         e.preventDefault();
@@ -16,37 +18,155 @@ document.addEventListener('DOMContentLoaded', () => {
         userInput.value = '';
 
         try {
-            const response = await fetch('/agent-planner', {
+            const response = await fetch('/agent-planner/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
                 body: JSON.stringify({
                     session_id: sessionId,
-                    session_chat_history: getChatHistory(),
+                    message: message,
+                    history_length: historyLength,
+                    // no "questionnaire" field: the server default (QUESTIONNAIRE_ENABLED) applies
                     user_id: 'user123', 
                 }),
             });
 
-            const data = await response.json();
-
-            if (response.ok) {
-                if (typeof data.assistant === 'string') {
-                    appendMessage('assistant', data.assistant);
-                } else {
-                    appendMessage('assistant', JSON.stringify(data.assistant));
-                    console.warn('assistant is not a string:', data.assistant);
-                }
-            } else {
+            if (!response.ok) {
+                const data = await response.json();
                 appendMessage('assistant', `Error: ${data.error}`);
                 console.error('Backend Error:', data.error);
+                return;
             }
+
+            await renderEventStream(response);
         } catch (error) {
             appendMessage('assistant', `Error: ${error.message}`);
             console.error('Fetch Error:', error);
         }
     });
 
+    // Reads the Server-Sent Events of /agent-planner/stream and renders them as they arrive
+    async function renderEventStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        const progress = createProgress();
+        let answerDiv = null;
+        let answer = '';
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                const { event, data } = parseEvent(rawEvent);
+                if (!event) continue;
+
+                if (event === 'agent_planned') {
+                    addChainAgent(progress, data.agent_nickname);
+                } else if (event === 'json_chain') {
+                    renderChain(progress, data);
+                } else if (event === 'agent_start') {
+                    setAgentStatus(progress, data.agent_nickname, 'running');
+                } else if (event === 'agent_finish') {
+                    setAgentStatus(progress, data.agent_nickname, 'done', data.observation);
+                } else if (event === 'token') {
+                    if (!answerDiv) answerDiv = appendMessage('assistant', '');
+                    answer += data.token;
+                    renderMarkdown(answerDiv, answer);
+                } else if (event === 'final') {
+                    historyLength = data.history_length;
+                    const message = typeof data.assistant === 'string'
+                        ? data.assistant
+                        : JSON.stringify(data.assistant);
+                    if (answerDiv) {
+                        renderMarkdown(answerDiv, message);
+                    } else {
+                        appendMessage('assistant', message);
+                    }
+                } else if (event === 'error') {
+                    appendMessage('assistant', `Error: ${data.error}`);
+                    console.error('Backend Error:', data.error);
+                    await syncHistoryLength();
+                }
+            }
+        }
+    }
+
+    function parseEvent(rawEvent) {
+        let event = null;
+        const dataLines = [];
+        rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                event = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                dataLines.push(line.slice(5).trim());
+            }
+        });
+        return { event, data: dataLines.length ? JSON.parse(dataLines.join('\n')) : null };
+    }
+
+    // The progress panel is not a .message, so it stays out of the chat history
+    function createProgress() {
+        const progressDiv = document.createElement('div');
+        progressDiv.classList.add('chain-progress');
+        progressDiv.textContent = 'Planning...';
+        chatBox.appendChild(progressDiv);
+        chatBox.scrollTop = chatBox.scrollHeight;
+        return progressDiv;
+    }
+
+    // Agents streamed by the planner are added before the whole chain arrives, and may already be running
+    function addChainAgent(progress, nickname) {
+        const existing = Array.from(progress.querySelectorAll('.chain-agent'))
+            .find(el => el.dataset.nickname === nickname);
+        if (existing) return existing;
+        const agentDetails = document.createElement('details');
+        agentDetails.classList.add('chain-agent');
+        agentDetails.dataset.nickname = nickname;
+        const summary = document.createElement('summary');
+        summary.textContent = nickname;
+        agentDetails.appendChild(summary);
+        progress.appendChild(agentDetails);
+        chatBox.scrollTop = chatBox.scrollHeight;
+        return agentDetails;
+    }
+
+    function renderChain(progress, jsonChain) {
+        (jsonChain.agents || []).slice(0, -1).forEach(agent => {
+            const agentDetails = addChainAgent(progress, agent.agent_nickname);
+            if (agent.observation && !agentDetails.classList.contains('done')) {
+                setAgentStatus(progress, agent.agent_nickname, 'done', agent.observation);
+            }
+        });
+        chatBox.scrollTop = chatBox.scrollHeight;
+    }
+
+    function setAgentStatus(progress, nickname, status, observation) {
+        const agentDetails = Array.from(progress.querySelectorAll('.chain-agent'))
+            .find(el => el.dataset.nickname === nickname);
+        if (!agentDetails) return;
+        agentDetails.classList.remove('running', 'done');
+        agentDetails.classList.add(status);
+        if (observation) {
+            const observationDiv = document.createElement('div');
+            renderMarkdown(observationDiv, observation);
+            agentDetails.appendChild(observationDiv);
+        }
+        chatBox.scrollTop = chatBox.scrollHeight;
+    }
+
+    function renderMarkdown(element, message) {
+        const rawHtml = marked.parse(message);
+        element.innerHTML = DOMPurify.sanitize(rawHtml);
+        chatBox.scrollTop = chatBox.scrollHeight;
+    }
+
     function appendMessage(role, message) {
         const msgDiv = document.createElement('div');
         msgDiv.classList.add('message', role);
@@ -66,17 +186,19 @@ document.addEventListener('DOMContentLoaded', () => {
 
         chatBox.appendChild(msgDiv);
         chatBox.scrollTop = chatBox.scrollHeight;
+        return msgDiv;
     }
 
-    function getChatHistory() {
-        const messages = chatBox.querySelectorAll('.message');
-        const history = [];
-        messages.forEach(msg => {
-            const role = msg.classList.contains('user') ? 'user' : 'assistant';
-            const message = role === 'user' ? msg.textContent : msg.innerText;
-            history.push({ role, content: message });
-        });
-        return history;
+    // After an error (e.g. a turn rejected as stale), continue from the history stored on the server
+    async function syncHistoryLength() {
+        try {
+            const response = await fetch(`/sessions/${encodeURIComponent(sessionId)}/history`);
+            if (response.ok) {
+                historyLength = (await response.json()).history_length;
+            }
+        } catch (error) {
+            console.error('History Error:', error);
+        }
     }
 
     function generateSessionId() {
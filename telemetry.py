@@ -0,0 +1,232 @@
+# telemetry.py
+
+import os
+import json
+import time
+import asyncio
+import uuid
+import bisect
+import logging
+import threading
+import contextlib
+import contextvars
+from typing import Dict, Iterable, Optional, Tuple
+
+# spans are logged as one JSON line each on the "telemetry" logger
+TRACE_LOG_ENABLED = os.getenv("TRACE_LOG_ENABLED", "1") == "1"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+SIZE_BUCKETS = tuple(2 ** exponent for exponent in range(8, 25, 2))  # 256 B to 16 MB
+
+logger = logging.getLogger(__name__)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                yield from self.render_value(key, value)
+
+    def render_value(self, key, value):
+        yield f"{self.name}{format_labels(self.label_names, key)} {value}"
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        with self.lock:
+            key = self.key(labels)
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount: float = 1, **labels):
+        with self.lock:
+            key = self.key(labels)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        with self.lock:
+            key = self.key(labels)
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render_value(self, key, value):
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            labels = format_labels(self.label_names, key, 'le="' + le + '"')
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        yield f"{self.name}_sum{format_labels(self.label_names, key)} {total}"
+        yield f"{self.name}_count{format_labels(self.label_names, key)} {cumulative}"
+
+
+class Registry:
+    """
+    Metrics of this process, rendered in the Prometheus text format. Every worker
+    process exports its own values, to be summed by the Prometheus queries.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+registry = Registry()
+
+CHAIN_SECONDS = registry.register(Histogram(
+    'planner_chain_seconds', 'Duration of a planner turn, by mode and final state', ('mode', 'state')))
+CHAINS_IN_FLIGHT = registry.register(Gauge(
+    'planner_chains_in_flight', 'Planner turns currently running'))
+PLANNER_CALL_SECONDS = registry.register(Histogram(
+    'planner_call_seconds', 'Duration of the planner step, cache lookups included, by outcome', ('outcome',)))
+AGENT_SECONDS = registry.register(Histogram(
+    'agent_call_seconds', 'Duration of an agent, by depth in the chain DAG (0 = no inputs) and outcome', ('depth', 'outcome')))
+LLM_REQUEST_SECONDS = registry.register(Histogram(
+    'llm_request_seconds', 'Duration of a request to the LLM provider, by model and outcome', ('model', 'outcome')))
+LLM_QUEUE_WAIT_SECONDS = registry.register(Histogram(
+    'llm_queue_wait_seconds', 'Time an LLM request waited for admission by the scheduler', ('model',)))
+LLM_TOKENS = registry.register(Counter(
+    'llm_tokens_total', 'Tokens reported by the LLM provider, by model and kind', ('model', 'kind')))
+LLM_COST_USD = registry.register(Counter(
+    'llm_cost_usd_total', 'Estimated cost of the LLM requests from MODEL_PRICES, by model', ('model',)))
+LLM_ROUTED_CALLS = registry.register(Counter(
+    'llm_routed_calls_total', 'LLM calls by role, model picked by the router and reason', ('role', 'model', 'reason')))
+SESSION_IO_SECONDS = registry.register(Histogram(
+    'session_io_seconds', 'Duration of a session load or save, by operation and outcome', ('operation', 'outcome')))
+SESSION_PAYLOAD_BYTES = registry.register(Histogram(
+    'session_payload_bytes', 'Bytes read or written to Redis by a session load or save', ('operation',), SIZE_BUCKETS))
+
+
+def record_metrics(span: 'Span'):
+    attributes = span.attributes
+    if span.name == 'chain':
+        CHAIN_SECONDS.observe(span.duration, mode=attributes.get('mode'), state=attributes.get('state', span.outcome))
+    elif span.name == 'planner_call':
+        PLANNER_CALL_SECONDS.observe(span.duration, outcome=span.outcome)
+    elif span.name == 'agent_call':
+        AGENT_SECONDS.observe(span.duration, depth=attributes.get('depth'), outcome=span.outcome)
+    elif span.name == 'llm_request':
+        model = attributes.get('model')
+        LLM_REQUEST_SECONDS.observe(span.duration, model=model, outcome=span.outcome)
+        if 'queue_wait' in attributes:
+            LLM_QUEUE_WAIT_SECONDS.observe(attributes['queue_wait'], model=model)
+        for kind in ('prompt_tokens', 'completion_tokens'):
+            if attributes.get(kind):
+                LLM_TOKENS.inc(attributes[kind], model=model, kind=kind.split('_')[0])
+    elif span.name in ('session_load', 'session_save'):
+        operation = span.name.split('_')[1]
+        SESSION_IO_SECONDS.observe(span.duration, operation=operation, outcome=span.outcome)
+        if 'payload_bytes' in attributes:
+            SESSION_PAYLOAD_BYTES.observe(attributes['payload_bytes'], operation=operation)
+
+
+# tracing
+
+class Span:
+    def __init__(self, name: str, parent: Optional['Span'], attributes: Dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.outcome = 'ok'
+        self.start = time.time()
+        self.duration = 0.0
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict:
+        return {
+            'span': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+            'start': round(self.start, 6), 'duration': round(self.duration, 6), 'outcome': self.outcome,
+            **self.attributes
+        }
+
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Times the enclosed block as a child of the current span (a new trace if there is none).
+    The block can add attributes with `span.set(...)`; the outcome is `error` when it raises.
+    Worker threads must be given the caller's context (contextvars.copy_context().run).
+    """
+    current = Span(name, current_span.get(), attributes)
+    token = current_span.set(current)
+    start = time.monotonic()
+    try:
+        yield current
+    except BaseException as e:
+        current.outcome = 'cancelled' if isinstance(e, asyncio.CancelledError) else 'error'
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        current.duration = time.monotonic() - start
+        current_span.reset(token)
+        finish(current)
+
+
+def set_span_attributes(**attributes):
+    """
+    Adds attributes to the current span, if there is one.
+    """
+    current = current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def finish(current: Span):
+    try:
+        record_metrics(current)
+    except Exception as e:
+        logger.warning(f"Span metrics not recorded: {e}")
+    if TRACE_LOG_ENABLED:
+        logger.info(json.dumps(current.to_dict(), default=str))
@@ -0,0 +1,27 @@
+# tests/conftest.py
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# read on import: no LLM or Redis cache, and a backend that needs no network
+os.environ.setdefault('LLM_BACKEND', 'local')
+os.environ.setdefault('LLM_CACHE_ENABLED', '0')
+os.environ.setdefault('CHAIN_CACHE_ENABLED', '0')
+os.environ.setdefault('PLANNER_STREAMING_ENABLED', '0')
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """
+    Every Redis client created during the test talks to the same in-memory fakeredis server.
+    """
+    import redis
+    import redis.asyncio
+    import fakeredis
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, 'StrictRedis', lambda *args, **kwargs: fakeredis.FakeStrictRedis(server=server))
+    monkeypatch.setattr(redis.asyncio, 'StrictRedis', lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=server))
+    return fakeredis.FakeStrictRedis(server=server)
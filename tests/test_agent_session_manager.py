@@ -0,0 +1,71 @@
+# tests/test_agent_session_manager.py
+
+import gc
+import asyncio
+import pytest
+import agent_session_manager
+from agent_session_manager import AgentSessionManager, SessionConflictError, get_async_connection_pool
+
+
+def test_async_pools_are_kept_per_event_loop_and_dropped_with_it():
+    async def pools():
+        return get_async_connection_pool('redis', 6379, 0), get_async_connection_pool('redis', 6379, 0)
+
+    first, same = asyncio.run(pools())
+    assert first is same
+    second, _ = asyncio.run(pools())
+    assert second is not first
+    gc.collect()
+    assert len(agent_session_manager._async_pools) == 0
+
+
+@pytest.fixture
+def session_manager(fake_redis):
+    return AgentSessionManager(redis_host='redis', redis_port=6379, db=0)
+
+
+def test_session_is_saved_with_a_new_version(session_manager):
+    data_model = session_manager.load_session('s1')
+    assert data_model.version == 0
+    data_model.initial_message = 'plan it'
+    session_manager.save_session(data_model)
+    assert data_model.version == 1
+    loaded = session_manager.load_session('s1')
+    assert loaded.version == 1 and loaded.initial_message == 'plan it'
+
+
+def test_concurrent_saves_of_a_session_conflict(session_manager):
+    first = session_manager.load_session('s1')
+    second = session_manager.load_session('s1')
+    first.final_answer = 'first'
+    session_manager.save_session(first)
+    second.final_answer = 'second'
+    with pytest.raises(SessionConflictError):
+        session_manager.save_session(second)
+    assert session_manager.load_session('s1').final_answer == 'first'
+
+
+def test_concurrent_async_saves_of_a_session_conflict(session_manager):
+    async def saves():
+        first = await session_manager.load_session_async('s1')
+        second = await session_manager.load_session_async('s1')
+        await session_manager.save_session_async(first)
+        with pytest.raises(SessionConflictError):
+            await session_manager.save_session_async(second)
+        return await session_manager.load_session_async('s1')
+
+    assert asyncio.run(saves()).version == 1
+
+
+def test_save_watching_a_version_changed_meanwhile_conflicts(session_manager, fake_redis, monkeypatch):
+    data_model = session_manager.load_session('s1')
+    check_version = session_manager.check_version
+
+    def save_in_between(data_model, stored_version):
+        check_version(data_model, stored_version)
+        # another turn saves after the version was read, before the transaction runs
+        fake_redis.incr(session_manager.get_version_key('s1'))
+
+    monkeypatch.setattr(session_manager, 'check_version', save_in_between)
+    with pytest.raises(SessionConflictError):
+        session_manager.save_session(data_model)
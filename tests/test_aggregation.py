@@ -0,0 +1,41 @@
+# tests/test_aggregation.py
+
+from aggregation import AggregationTree, plan_aggregation
+
+LEAVES = [f'A{index}' for index in range(10)]
+
+
+def test_narrow_chains_are_aggregated_in_one_call():
+    assert plan_aggregation(LEAVES, 'Aggregator', min_agents=0) is None
+    assert plan_aggregation(LEAVES[:4], 'Aggregator', min_agents=2, fan_in=4) is None
+    assert plan_aggregation(LEAVES, 'Aggregator', min_agents=11) is None
+
+
+def test_wide_chain_is_reduced_by_groups_of_fan_in():
+    tree = plan_aggregation(LEAVES, 'Aggregator', min_agents=5, fan_in=3)
+    # 10 leaves: 3 + 3 + 3 syntheses and one leaf left, then one synthesis of level 2
+    assert [node['agent_nickname'] for node in tree.nodes] == [
+        'Aggregator/1.0', 'Aggregator/1.1', 'Aggregator/1.2', 'Aggregator/2.0'
+    ]
+    assert tree.nodes[0]['input_from_agents'] == ['A0', 'A1', 'A2']
+    assert tree.nodes[3]['input_from_agents'] == ['Aggregator/1.0', 'Aggregator/1.1', 'Aggregator/1.2']
+    assert tree.top == ['Aggregator/2.0', 'A9']
+    assert tree.covers['Aggregator/2.0'] == LEAVES[:9]
+    assert tree.is_node(tree.nodes[0]) and not tree.is_node({'agent_nickname': 'A0'})
+
+
+def test_inputs_use_the_syntheses_that_have_an_observation():
+    tree = AggregationTree(LEAVES[:4], 'Aggregator', fan_in=2)
+    observations = {nickname: f'obs {nickname}' for nickname in LEAVES[:4]}
+    tree.by_nickname['Aggregator/1.0']['observation'] = 'synthesis of A0 A1'
+    entries = tree.inputs(tree.top, observations)
+    assert entries[0]['observation'] == 'synthesis of A0 A1'
+    assert entries[0]['input_from_agents'] == ['A0', 'A1']
+    # the other synthesis failed: the Aggregator gets its inputs instead
+    assert [entry['agent_nickname'] for entry in entries[1:]] == ['A2', 'A3']
+
+
+def test_inputs_leave_out_agents_without_an_observation():
+    tree = AggregationTree(LEAVES[:4], 'Aggregator', fan_in=2)
+    entries = tree.inputs(tree.top, {'A0': 'obs A0'})
+    assert [entry['agent_nickname'] for entry in entries] == ['A0']
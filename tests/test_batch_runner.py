@@ -0,0 +1,34 @@
+# tests/test_batch_runner.py
+
+from batch_runner import BatchCheckpoint, read_items
+
+
+def write_input(path, count):
+    path.write_text(''.join(f'{{"id": {line}, "prompt": "p{line}"}}\n' for line in range(count)))
+
+
+def test_checkpoint_watermark_and_out_of_order_lines(tmp_path):
+    checkpoint = BatchCheckpoint(str(tmp_path / 'checkpoint'))
+    for line in (0, 2, 3, 1, 5):
+        checkpoint.mark_done(line, 10 * line)
+    assert checkpoint.watermark == 4 and checkpoint.done == {5}
+    reloaded = BatchCheckpoint(str(tmp_path / 'checkpoint'))
+    assert [line for line in range(7) if not reloaded.is_done(line)] == [4, 6]
+    assert reloaded.output_bytes == 50
+
+
+def test_failed_lines_are_retried_by_the_next_run(tmp_path):
+    input_path = tmp_path / 'input.jsonl'
+    write_input(input_path, 4)
+    checkpoint = BatchCheckpoint(str(tmp_path / 'checkpoint'))
+    checkpoint.mark_done(0, 10)
+    checkpoint.mark_done(1, 20, failed=True)
+    checkpoint.mark_done(2, 30)
+    # the failed line does not hold the watermark back
+    assert checkpoint.watermark == 3
+
+    resumed = BatchCheckpoint(str(tmp_path / 'checkpoint'))
+    assert [line for line, _ in read_items(str(input_path), resumed)] == [1, 3]
+    resumed.mark_done(1, 40)
+    resumed.mark_done(3, 50)
+    assert list(read_items(str(input_path), BatchCheckpoint(str(tmp_path / 'checkpoint')))) == []
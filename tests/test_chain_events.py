@@ -0,0 +1,36 @@
+# tests/test_chain_events.py
+
+import asyncio
+import planner
+
+
+def collect(events):
+    return lambda event, payload: events.append((event, payload))
+
+
+def check_events(events, reply):
+    names = [event for event, _ in events]
+    assert names[0] == 'json_chain'
+    assert names.count('agent_start') == names.count('agent_finish') == 3
+    tokens = ''.join(payload['token'] for event, payload in events if event == 'token')
+    assert tokens.strip() == reply['assistant']
+
+
+def test_sync_turn_sends_the_chain_progress_and_the_answer_tokens(fake_redis):
+    events = []
+    turn = planner.AgentPlanner(None, message='plan a trip', session_id='s1', is_interactive=True, on_event=collect(events))
+    turn.run_planner()
+    check_events(events, turn.reply())
+
+
+def test_async_turn_sends_the_chain_progress_and_the_answer_tokens(fake_redis):
+    events = []
+
+    async def run():
+        turn = await planner.AgentPlanner.create_async(
+            None, message='plan a trip', session_id='s1', is_interactive=True, on_event=collect(events)
+        )
+        await turn.run_planner_async()
+        return turn
+
+    check_events(events, asyncio.run(run()).reply())
@@ -0,0 +1,81 @@
+# tests/test_chain_lease.py
+
+import asyncio
+import collections
+import pytest
+import llm_backends
+import planner
+from llm_backends import LocalBackend, LLMBackendError
+from agent_session_manager import AgentSessionManager, SessionConflictError
+
+
+class FailingAggregatorBackend(LocalBackend):
+    """
+    The local backend, whose first Aggregator call fails with an error that is not retried.
+    """
+
+    def __init__(self):
+        super().__init__(latency=0)
+        self.calls = collections.Counter()
+
+    def answer(self, prompt, model):
+        nickname = 'planner' if self.is_planner(prompt) else prompt.split('your nickname is: "', 1)[-1].split('"', 1)[0]
+        self.calls[nickname] += 1
+        if nickname == 'Aggregator' and self.calls[nickname] == 1:
+            raise LLMBackendError("invalid request")
+        return super().answer(prompt, model)
+
+
+@pytest.fixture
+def backend(fake_redis, monkeypatch):
+    backend = FailingAggregatorBackend()
+    monkeypatch.setattr(llm_backends, '_backend', backend)
+    return backend
+
+
+def session_manager():
+    return AgentSessionManager(redis_host=planner.REDIS_HOST, redis_port=planner.REDIS_PORT, db=planner.REDIS_DB)
+
+
+def test_failed_turn_releases_the_lease_and_its_retry_resumes(backend, fake_redis):
+    first = planner.AgentPlanner(None, message='plan a trip', session_id='s1', is_interactive=True)
+    with pytest.raises(LLMBackendError):
+        first.run_planner()
+    assert not fake_redis.exists('session_lease:planner-s1')
+    # still listed for chain_recovery, with its checkpoints
+    assert session_manager().interrupted_chains() == ['planner-s1']
+    assert len(fake_redis.hkeys('session_checkpoints:planner-s1')) == 3
+
+    retry = planner.AgentPlanner(None, message='plan a trip', session_id='s1', is_interactive=True)
+    assert retry.resuming
+    retry.run_planner()
+    assert retry.data.state == 'idle' and retry.data.final_answer.startswith('Local answer')
+    assert backend.calls == {'planner': 1, 'Research': 1, 'Options': 1, 'Analysis': 1, 'Aggregator': 2}
+    assert not fake_redis.hexists('running_chains', 'planner-s1')
+
+
+def test_failed_async_turn_releases_the_lease_and_its_retry_resumes(backend, fake_redis):
+    async def turns():
+        first = await planner.AgentPlanner.create_async(None, message='plan a trip', session_id='s1', is_interactive=True)
+        with pytest.raises(LLMBackendError):
+            await first.run_planner_async()
+        assert not fake_redis.exists('session_lease:planner-s1')
+        retry = await planner.AgentPlanner.create_async(None, message='plan a trip', session_id='s1', is_interactive=True)
+        await retry.run_planner_async()
+        return retry
+
+    retry = asyncio.run(turns())
+    assert retry.data.final_answer.startswith('Local answer')
+    assert backend.calls['Research'] == 1 and backend.calls['Aggregator'] == 2
+
+
+def test_running_chain_is_leased_to_its_turn(backend, fake_redis):
+    first = planner.AgentPlanner(None, message='plan a trip', session_id='s1', is_interactive=True)
+    with pytest.raises(LLMBackendError):
+        first.run_planner()
+    session_manager().acquire_chain_lease('planner-s1')
+    retry = planner.AgentPlanner(None, message='plan a trip', session_id='s1', is_interactive=True)
+    with pytest.raises(SessionConflictError):
+        retry.run_planner()
+    # the lease of the other turn is left alone
+    assert fake_redis.exists('session_lease:planner-s1')
@@ -0,0 +1,154 @@
+# tests/test_chain_scheduler.py
+
+import time
+import asyncio
+import threading
+from chain_scheduler import ChainScheduler
+
+
+def agent(nickname, *inputs, questions=()):
+    return {'agent_nickname': nickname, 'input_from_agents': list(inputs), 'user_questions': list(questions)}
+
+
+class Recorder:
+    """
+    run_agent of the tests: records when every agent starts and ends.
+    """
+
+    def __init__(self, delay=0.02, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.events = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def enter(self, nickname):
+        with self.lock:
+            self.events.append(('start', nickname))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def leave(self, nickname):
+        with self.lock:
+            self.running -= 1
+            self.events.append(('end', nickname))
+        if nickname in self.fail:
+            raise RuntimeError(f'{nickname} failed')
+        return f'output of {nickname}'
+
+    def __call__(self, agent):
+        self.enter(agent['agent_nickname'])
+        time.sleep(self.delay)
+        return self.leave(agent['agent_nickname'])
+
+    async def run_async(self, agent):
+        self.enter(agent['agent_nickname'])
+        await asyncio.sleep(self.delay)
+        return self.leave(agent['agent_nickname'])
+
+    def index(self, kind, nickname):
+        return self.events.index((kind, nickname))
+
+
+def diamond():
+    return [agent('A'), agent('B', 'A'), agent('C', 'A'), agent('D', 'B', 'C')]
+
+
+def test_agents_start_after_their_inputs():
+    recorder = Recorder()
+    stats = ChainScheduler(diamond(), recorder).run()
+    assert stats['failed'] == [] and stats['blocked'] == []
+    for nickname, inputs in (('B', 'A'), ('C', 'A'), ('D', 'B'), ('D', 'C')):
+        assert recorder.index('end', inputs) < recorder.index('start', nickname)
+    assert stats['critical_path'][0] == 'A' and stats['critical_path'][-1] == 'D'
+
+
+def test_independent_branches_run_together_up_to_max_workers():
+    recorder = Recorder(delay=0.05)
+    ChainScheduler([agent(f'A{i}') for i in range(6)], recorder, max_workers=3).run()
+    assert recorder.max_running == 3
+
+
+def test_blocked_agents_hold_back_their_dependents():
+    agents = [agent('A'), agent('Q', questions=['?']), agent('B', 'Q'), agent('C', 'A')]
+    recorder = Recorder()
+    scheduler = ChainScheduler(agents, recorder, is_blocked=lambda a: bool(a['user_questions']))
+    stats = scheduler.run()
+    assert scheduler.completed == {'A', 'C'}
+    assert stats['blocked'] == ['Q', 'B']
+
+
+def test_completed_agents_are_not_run_again():
+    agents = diamond()
+    agents[0]['observation'] = 'saved'
+    recorder = Recorder()
+    ChainScheduler(agents, recorder, completed=['B']).run()
+    assert {nickname for kind, nickname in recorder.events} == {'C', 'D'}
+
+
+def test_failed_agent_does_not_stop_its_dependents():
+    recorder = Recorder(fail=['B'])
+    stats = ChainScheduler(diamond(), recorder).run()
+    assert stats['failed'] == ['B']
+    assert ('end', 'D') in recorder.events
+
+
+def test_cycle_is_broken_at_the_earliest_agent():
+    agents = [agent('A', 'C'), agent('B', 'A'), agent('C', 'B')]
+    recorder = Recorder()
+    scheduler = ChainScheduler(agents, recorder)
+    scheduler.run()
+    assert scheduler.completed == {'A', 'B', 'C'}
+    assert [nickname for kind, nickname in recorder.events if kind == 'start'] == ['A', 'B', 'C']
+
+
+def test_unknown_inputs_are_ignored():
+    recorder = Recorder()
+    scheduler = ChainScheduler([agent('A', 'Ghost')], recorder)
+    scheduler.run()
+    assert scheduler.completed == {'A'}
+
+
+def test_started_agents_are_awaited_by_run():
+    agents = diamond()
+    recorder = Recorder()
+    scheduler = ChainScheduler(agents[:1], recorder)
+    assert scheduler.start(agents[0])
+    scheduler.add_agents(agents[1:])
+    scheduler.run()
+    assert scheduler.completed == {'A', 'B', 'C', 'D'}
+    assert [nickname for kind, nickname in recorder.events].count('A') == 2
+
+
+def test_run_async_follows_the_dependencies():
+    recorder = Recorder()
+    scheduler = ChainScheduler(diamond(), recorder.run_async, max_workers=2)
+    stats = asyncio.run(scheduler.run_async())
+    assert scheduler.completed == {'A', 'B', 'C', 'D'} and stats['failed'] == []
+    assert recorder.index('end', 'B') < recorder.index('start', 'D')
+    assert recorder.max_running <= 2
+
+
+def test_run_async_records_cancelled_agents_as_failed():
+    async def run_agent(agent):
+        if agent['agent_nickname'] == 'B':
+            asyncio.current_task().cancel()
+        await asyncio.sleep(0.01)
+        return 'output'
+
+    async def main():
+        agents = [agent('A'), agent('B'), agent('C'), agent('D', 'A', 'B', 'C')]
+        scheduler = ChainScheduler(agents, run_agent, max_workers=1)
+        scheduler.start_async(agents[0])
+        scheduler.start_async(agents[2])
+        # C is cancelled while it waits for the worker taken by A
+        for task, started in list(scheduler.running.items()):
+            if started['agent_nickname'] == 'C':
+                task.cancel()
+        return scheduler, await scheduler.run_async()
+
+    scheduler, stats = asyncio.run(main())
+    assert stats['failed'] == ['B', 'C']
+    assert scheduler.completed == {'A', 'D'}
+    assert stats['agents']['C']['duration'] == 0.0
@@ -0,0 +1,70 @@
+# tests/test_chain_stream.py
+
+import json
+import pytest
+from chain_stream import ChainStreamParser, extract_json, parse_chain
+
+AGENTS = [
+    {'agent_nickname': 'A', 'agent_llm_prompt': 'find {the} "facts"', 'input_from_agents': [], 'user_questions': []},
+    {'agent_nickname': 'B', 'agent_llm_prompt': 'list ] the options', 'input_from_agents': ['A'], 'user_questions': []},
+    {'agent_nickname': 'Aggregator', 'agent_llm_prompt': 'combine', 'input_from_agents': ['A', 'B'], 'user_questions': []},
+]
+ANSWER = '```json\n' + json.dumps({'agents': AGENTS}, indent=2) + '\n```'
+
+
+def feed(parser, text, size):
+    released = []
+    for index in range(0, len(text), size):
+        released.append([agent['agent_nickname'] for agent in parser.feed(text[index:index + size])])
+    return released
+
+
+@pytest.mark.parametrize('size', [1, 7, len(ANSWER)])
+def test_agents_are_released_once_followed_by_another(size):
+    parser = ChainStreamParser()
+    released = [nickname for chunk in feed(parser, ANSWER, size) for nickname in chunk]
+    # the last agent, the Aggregator, is only known once the answer is complete
+    assert released == ['A', 'B']
+    assert [agent['agent_nickname'] for agent in parser.finish()['agents']] == ['A', 'B', 'Aggregator']
+
+
+def test_agent_is_released_as_soon_as_the_next_one_starts():
+    parser = ChainStreamParser()
+    text = ANSWER[:ANSWER.index('"agent_nickname": "B"')]
+    assert [agent['agent_nickname'] for agent in parser.feed(text)] == ['A']
+
+
+def test_finish_keeps_the_streamed_agent_objects():
+    parser = ChainStreamParser()
+    streamed = parser.feed(ANSWER)
+    assert parser.finish()['agents'][0] is streamed[0]
+
+
+def test_cut_answer_keeps_the_streamed_agents_and_closes_the_chain():
+    parser = ChainStreamParser()
+    parser.feed(ANSWER[:ANSWER.index('"agent_nickname": "Aggregator"') + 10])
+    agents = parser.finish()['agents']
+    assert [agent['agent_nickname'] for agent in agents] == ['A', 'B', 'Aggregator']
+    assert agents[-1]['input_from_agents'] == ['A', 'B']
+
+
+def test_invalid_agents_are_skipped_and_fields_normalized():
+    chain = parse_chain(json.dumps({'agents': [
+        {'agent_nickname': 'A', 'agent_llm_prompt': 'a', 'input_from_agents': None, 'user_questions': 'why?'},
+        {'agent_nickname': 'A', 'agent_llm_prompt': 'duplicate'},
+        {'agent_llm_prompt': 'no nickname'},
+        {'agent_nickname': 'Aggregator', 'agent_llm_prompt': 'combine'},
+    ]}))
+    assert [agent['agent_nickname'] for agent in chain['agents']] == ['A', 'Aggregator']
+    assert chain['agents'][0]['input_from_agents'] == [] and chain['agents'][0]['user_questions'] == ['why?']
+
+
+def test_trailing_commas_and_surrounding_text_are_tolerated():
+    assert extract_json('Here is the chain: {"agents": [{"agent_nickname": "A",},],} Done.') == {
+        'agents': [{'agent_nickname': 'A'}]
+    }
+
+
+def test_answer_without_a_chain_is_refused():
+    with pytest.raises(ValueError):
+        parse_chain('I cannot plan this.')
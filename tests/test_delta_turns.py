@@ -0,0 +1,39 @@
+# tests/test_delta_turns.py
+
+import pytest
+import planner
+from planner import delta_turn
+from agent_session_manager import StaleHistoryError
+
+
+def turn(message, history_length=None):
+    agent_planner = planner.AgentPlanner(
+        None, message=message, history_length=history_length, session_id='s1', is_interactive=True
+    )
+    agent_planner.run_planner()
+    return agent_planner.reply()
+
+
+def test_delta_turns_extend_the_stored_history(fake_redis):
+    first = turn('plan a trip', 0)
+    second = turn('and a cheaper one', first['history_length'])
+    assert second['history_length'] == 4
+    history = planner.AgentPlanner.load_chat_history('s1')
+    assert [message['role'] for message in history] == ['user', 'assistant', 'user', 'assistant']
+    assert history[2]['content'] == 'and a cheaper one'
+
+
+def test_client_with_another_history_is_refused(fake_redis):
+    turn('plan a trip', 0)
+    with pytest.raises(StaleHistoryError):
+        turn('and a cheaper one', 0)
+
+
+def test_delta_turn_needs_a_message(fake_redis):
+    with pytest.raises(ValueError):
+        turn('')
+
+
+def test_requests_with_a_full_history_are_not_delta_turns():
+    assert delta_turn({'session_chat_history': [], 'message': 'x'}) == {}
+    assert delta_turn({'message': 'x', 'history_length': 2}) == {'message': 'x', 'history_length': 2}
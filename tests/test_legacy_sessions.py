@@ -0,0 +1,55 @@
+# tests/test_legacy_sessions.py
+
+import pickle
+from agent_data_model import AgentDataModel
+from agent_session_manager import AgentSessionManager
+from session_codec import SessionCodec
+from migrate_sessions import migrate_sessions
+
+# attributes of an AgentDataModel pickled by the release before the session codec
+BASELINE_FIELDS = {
+    'name': 'AgentSInteractive', 'session_id': 's1', 'user_id': 'u1',
+    'chat_history': [{'role': 'user', 'content': 'plan it'}, {'role': 'assistant', 'content': 'q1?'}],
+    'initial_message': 'plan it', 'kwargs': {'is_interactive': True}, 'is_interactive': True,
+    'json_chain': {'agents': [{'agent_nickname': 'A', 'agent_llm_prompt': 'a', 'observation': 'obs A'}]},
+    'state': 'waiting_for_user_answer', 'agent_chain_step': 1, 'sequential_agent_step': 0,
+    'memory_logs': ['log'], 'thought_history': ['thought'], 'final_answer': 'q1?', 'start_system_prompt': 'sys',
+}
+
+
+def baseline_pickle() -> bytes:
+    # pickle stores the class and the instance __dict__, so this is what the baseline release saved
+    data_model = AgentDataModel.__new__(AgentDataModel)
+    data_model.__dict__.update(BASELINE_FIELDS)
+    return pickle.dumps(data_model)
+
+
+def test_baseline_pickle_is_decoded():
+    data_model = SessionCodec().decode(baseline_pickle())
+    assert data_model.chat_history == BASELINE_FIELDS['chat_history']
+    assert not hasattr(data_model, 'memory_logs') and not hasattr(data_model, 'sequential_agent_step')
+    assert data_model.saved_observations == [] and data_model.field_digests == {} and data_model.pending_questions == []
+
+
+def test_baseline_pickle_round_trip_through_the_session_manager(fake_redis):
+    fake_redis.set('session:s1', baseline_pickle())
+    session_manager = AgentSessionManager()
+    data_model = session_manager.load_session('s1')
+    assert data_model.chat_history == BASELINE_FIELDS['chat_history']
+    assert data_model.json_chain['agents'][0]['observation'] == 'obs A'
+    session_manager.save_session(data_model)
+    assert session_manager.codec.is_encoded(fake_redis.get('session:s1'))
+    reloaded = session_manager.load_session('s1')
+    assert reloaded.chat_history == BASELINE_FIELDS['chat_history']
+    assert reloaded.thought_history == ['thought']
+    # observations are loaded by the planner when an agent needs them
+    assert reloaded.saved_observations == ['A']
+    assert session_manager.load_observations('s1', ['A']) == {'A': 'obs A'}
+
+
+def test_migrate_sessions_rewrites_baseline_pickles(fake_redis):
+    fake_redis.set('session:s1', baseline_pickle())
+    session_manager = AgentSessionManager()
+    assert migrate_sessions(session_manager) == 1
+    assert session_manager.codec.decode(fake_redis.get('session:s1')).chat_history == BASELINE_FIELDS['chat_history']
+    assert migrate_sessions(session_manager) == 0
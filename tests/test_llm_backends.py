@@ -0,0 +1,85 @@
+# tests/test_llm_backends.py
+
+import json
+import asyncio
+import pytest
+import llm_resilience
+from llm_backends import (
+    LLMBackend, LocalBackend, LLMBackendError, LLMConnectionError, LLMTimeoutError, LLMRateLimitError, LLMServerError,
+    load_backend
+)
+from llm_resilience import ResilientCaller, LatencyTracker
+from prompts import SYSTEM_PROMPT_AGENT_PLANNER, JSON_CHAIN_EXAMPLE
+
+
+def test_local_answers_are_deterministic():
+    backend = LocalBackend()
+    answer = backend.complete('prompt', 'm', timeout=1)
+    assert answer == backend.complete('prompt', 'm', timeout=1)
+    assert answer.text != backend.complete('prompt', 'other', timeout=1).text
+    assert answer.usage.total_tokens == answer.usage.prompt_tokens + answer.usage.completion_tokens
+
+
+def test_local_planner_gets_a_chain():
+    prompt = SYSTEM_PROMPT_AGENT_PLANNER.format(initial_message='plan a trip', json_chain_example=JSON_CHAIN_EXAMPLE)
+    agents = json.loads(LocalBackend().complete(prompt, 'm', timeout=1).text)['agents']
+    assert [agent['agent_nickname'] for agent in agents][-1] == 'Aggregator'
+
+
+def test_local_stream_yields_the_answer():
+    backend = LocalBackend()
+
+    async def stream():
+        return [delta async for delta in backend.stream_async('prompt', 'm', timeout=1)]
+
+    deltas = list(backend.stream('prompt', 'm', timeout=1))
+    assert ''.join(delta.text for delta in deltas) == backend.complete('prompt', 'm', timeout=1).text
+    assert deltas[-1].usage is not None
+    assert [delta.text for delta in asyncio.run(stream())] == [delta.text for delta in deltas]
+
+
+def test_local_latency_longer_than_the_timeout_times_out():
+    with pytest.raises(LLMTimeoutError):
+        LocalBackend(latency=1).complete('prompt', 'm', timeout=0.01)
+
+
+def test_backend_missing_a_method_cannot_be_instantiated():
+    class CompleteOnly(LLMBackend):
+        def complete(self, prompt, model, timeout):
+            return LocalBackend().complete(prompt, model, timeout)
+
+    with pytest.raises(TypeError):
+        CompleteOnly()
+
+
+def test_backends_are_loaded_by_name_or_path():
+    assert isinstance(load_backend('local'), LocalBackend)
+    assert isinstance(load_backend('llm_backends:LocalBackend'), LocalBackend)
+    with pytest.raises(ValueError):
+        load_backend('unknown')
+
+
+@pytest.mark.parametrize('error, retried', [
+    (LLMBackendError('invalid request'), False),
+    (LLMConnectionError('reset'), True),
+    (LLMTimeoutError('timed out'), True),
+    (LLMRateLimitError('slow down', retry_after=0), True),
+    (LLMServerError('502'), True),
+])
+def test_only_the_subclasses_of_backend_errors_are_retried(monkeypatch, error, retried):
+    monkeypatch.setattr(llm_resilience, 'LLM_RETRY_BASE_SECONDS', 0)
+    attempts = []
+
+    def request(deadline):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise error
+        return 'answer'
+
+    caller = ResilientCaller(timeout=5, max_retries=1, hedge_enabled=False, tracker=LatencyTracker())
+    if retried:
+        assert caller.call(request, 'm') == 'answer'
+    else:
+        with pytest.raises(LLMBackendError):
+            caller.call(request, 'm')
+    assert len(attempts) == (2 if retried else 1)
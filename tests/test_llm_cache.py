@@ -0,0 +1,172 @@
+# tests/test_llm_cache.py
+
+import time
+import asyncio
+import threading
+import pytest
+from llm_cache import LLMCache
+from llm_backends import LLMBackendError
+from llm_resilience import DeadlineExceededError, TurnCancelledError
+
+
+@pytest.fixture
+def cache(fake_redis):
+    return LLMCache(memory_entries=10)
+
+
+def test_answers_are_cached_in_memory_and_redis(cache, fake_redis):
+    calls = []
+    key = cache.make_key('m', 'prompt')
+    assert cache.get_or_call(key, lambda: calls.append(1) or 'answer') == 'answer'
+    assert cache.get_or_call(key, lambda: calls.append(1) or 'other') == 'answer'
+    assert len(calls) == 1
+    assert LLMCache().get(key) == 'answer'
+
+
+def test_concurrent_identical_calls_are_coalesced(cache):
+    calls = []
+
+    def call():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'answer'
+
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(cache.get_or_call('k', call))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert answers == ['answer'] * 4 and len(calls) == 1
+
+
+def test_concurrent_identical_coroutines_are_coalesced(cache):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'answer'
+
+    async def main():
+        return await asyncio.gather(*[cache.get_or_call_async('k', call) for _ in range(4)])
+
+    assert asyncio.run(main()) == ['answer'] * 4 and len(calls) == 1
+
+
+def test_cancelled_leader_does_not_cancel_its_followers(cache):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return f'answer {len(calls)}'
+
+    async def main():
+        leader = asyncio.ensure_future(cache.get_or_call_async('k', call))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.ensure_future(cache.get_or_call_async('k', call)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+
+    # one of the followers makes the call again, for both of them
+    assert asyncio.run(main()) == ['answer 2', 'answer 2']
+    assert len(calls) == 2
+
+
+def start(target):
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread
+
+
+def test_follower_retries_when_the_leader_runs_out_of_time(cache):
+    calls = []
+
+    def call():
+        calls.append(1)
+        time.sleep(0.05)
+        if len(calls) == 1:
+            raise DeadlineExceededError("latency budget of the leading turn spent")
+        return 'answer'
+
+    errors, answers = [], []
+
+    def leader():
+        try:
+            cache.get_or_call('k', call)
+        except DeadlineExceededError as e:
+            errors.append(e)
+
+    threads = [start(leader)]
+    time.sleep(0.01)
+    threads.append(start(lambda: answers.append(cache.get_or_call('k', call, deadline=time.monotonic() + 5))))
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 1 and answers == ['answer'] and len(calls) == 2
+
+
+def test_follower_inherits_other_errors_of_the_leader(cache):
+    def call():
+        time.sleep(0.05)
+        raise LLMBackendError("invalid request")
+
+    errors = []
+
+    def ask():
+        try:
+            cache.get_or_call('k', call)
+        except LLMBackendError as e:
+            errors.append(e)
+
+    threads = [start(ask) for _ in range(2)]
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+
+def test_follower_waits_only_until_its_own_deadline(cache):
+    release = threading.Event()
+    leader = start(lambda: cache.get_or_call('k', lambda: release.wait(5) and 'answer'))
+    time.sleep(0.01)
+    start_time = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        cache.get_or_call('k', lambda: 'other', deadline=time.monotonic() + 0.05)
+    assert time.monotonic() - start_time < 1
+    release.set()
+    leader.join()
+
+
+def test_coroutine_follower_retries_when_the_leader_runs_out_of_time(cache):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            raise TurnCancelledError("Turn cancelled: client went away")
+        return 'answer'
+
+    async def main():
+        leader = asyncio.ensure_future(cache.get_or_call_async('k', call))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(cache.get_or_call_async('k', call, deadline=time.monotonic() + 5))
+        with pytest.raises(TurnCancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == 'answer' and len(calls) == 2
+
+
+def test_coroutine_follower_waits_only_until_its_own_deadline(cache):
+    async def main():
+        leader = asyncio.ensure_future(cache.get_or_call_async('k', lambda: asyncio.sleep(5, 'answer')))
+        await asyncio.sleep(0.01)
+        with pytest.raises(DeadlineExceededError):
+            await cache.get_or_call_async('k', lambda: asyncio.sleep(0, 'other'), deadline=time.monotonic() + 0.05)
+        leader.cancel()
+
+    asyncio.run(main())
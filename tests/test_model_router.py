@@ -0,0 +1,42 @@
+# tests/test_model_router.py
+
+import pytest
+from agent_data_model import AgentDataModel
+from model_router import ModelRouter, session_budget
+
+TIERS = {'low': 'small', 'medium': 'large', 'high': 'large'}
+
+
+def agent(prompt='short task', **fields):
+    return {'agent_nickname': 'A', 'agent_llm_prompt': prompt, **fields}
+
+
+def test_agents_stay_on_the_medium_tier_by_default():
+    router = ModelRouter(tiers=TIERS)
+    assert not router.enabled
+    assert router.agent(agent()) == 'large'
+    assert router.agent(agent(complexity='low')) == 'large'
+
+
+@pytest.mark.parametrize('fields, model', [
+    ({'complexity': 'low'}, 'small'),
+    ({'complexity': 'high'}, 'large'),
+    ({}, 'small'),
+    ({'agent_llm_prompt': 'x' * 500}, 'large'),
+])
+def test_enabled_routing_follows_the_complexity(fields, model):
+    router = ModelRouter(enabled=True, tiers=TIERS)
+    assert router.agent(agent(**fields)) == model
+
+
+def test_aggregator_keeps_its_model():
+    router = ModelRouter(enabled=True, aggregator_model='agg', tiers=TIERS)
+    assert router.agent({'agent_nickname': 'Aggregator', 'agent_llm_prompt': 'x'}) == 'agg'
+
+
+def test_cost_budget_applies_without_routing():
+    router = ModelRouter(tiers={'low': 'gpt-4o-mini', 'medium': 'o1-mini', 'high': 'o1-mini'})
+    data_model = AgentDataModel(name='n', kwargs={'cost_budget_usd': 1.0}, llm_cost_usd=2.0)
+    with session_budget(data_model):
+        assert router.agent(agent()) == 'gpt-4o-mini'
+    assert router.agent(agent()) == 'o1-mini'
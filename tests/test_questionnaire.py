@@ -0,0 +1,67 @@
+# tests/test_questionnaire.py
+
+import json
+import pytest
+import planner
+from planner import parse_numbered_answers
+from prompts import SYSTEM_PROMPT_AGENT_PLANNER
+
+CHAIN = {'agents': [
+    {'agent_nickname': 'Budget', 'agent_llm_prompt': 'b', 'input_from_agents': [], 'user_questions': ['What budget?']},
+    {'agent_nickname': 'Dates', 'agent_llm_prompt': 'd', 'input_from_agents': [], 'user_questions': ['Which dates?', 'How flexible?']},
+    {'agent_nickname': 'Aggregator', 'agent_llm_prompt': 'g', 'input_from_agents': ['Budget', 'Dates']},
+]}
+
+
+def test_numbered_lines_answer_their_question():
+    assert parse_numbered_answers('1. 2000 euros\n3) a week\nor two', 3) == {0: '2000 euros', 2: 'a week\nor two'}
+
+
+def test_unnumbered_reply_answers_the_first_question():
+    assert parse_numbered_answers('2000 euros', 2) == {0: '2000 euros'}
+
+
+def test_numbers_beyond_the_questions_are_part_of_the_answer():
+    assert parse_numbered_answers('1. see below\n4. not a question', 2) == {0: 'see below\n4. not a question'}
+
+
+@pytest.fixture
+def prompts(fake_redis, monkeypatch):
+    prompts = []
+
+    def call(prompt=None, **kwargs):
+        if prompt.startswith(SYSTEM_PROMPT_AGENT_PLANNER[:80]):
+            return json.dumps(CHAIN)
+        prompts.append(prompt)
+        return 'observation'
+
+    monkeypatch.setattr(planner, 'call_openai_model', call)
+    return prompts
+
+
+def test_questions_are_asked_at_once_and_answered_in_one_turn(prompts):
+    first = planner.AgentPlanner(None, message='plan a trip', session_id='s1', is_interactive=True, questionnaire=True)
+    first.run_planner()
+    reply = first.reply()
+    assert [entry['id'] for entry in reply['questions']] == ['Budget:0', 'Dates:0', 'Dates:1']
+    assert reply['assistant'].endswith('1. What budget?\n2. Which dates?\n3. How flexible?')
+
+    # the second question is left out, and asked again in the next questionnaire
+    second = planner.AgentPlanner(
+        None, answers={'Budget:0': '2000 euros', 'Dates:1': 'not at all'}, session_id='s1', is_interactive=True
+    )
+    second.run_planner()
+    assert [entry['id'] for entry in second.reply()['questions']] == ['Dates:0']
+    assert second.data.chat_history[-2]['content'] == 'What budget?: 2000 euros\nHow flexible?: not at all'
+
+    third = planner.AgentPlanner(None, message='1. May 3 to 6', session_id='s1', is_interactive=True)
+    third.run_planner()
+    assert third.data.state == 'idle' and 'questions' not in third.reply()
+    dates_prompt = next(prompt for prompt in prompts if 'your nickname is: "Dates"' in prompt)
+    assert "['May 3 to 6', 'not at all']" in dates_prompt
+
+
+def test_questions_are_asked_one_per_turn_by_default(prompts):
+    first = planner.AgentPlanner(None, message='plan a trip', session_id='s1', is_interactive=True)
+    first.run_planner()
+    assert first.reply() == {'assistant': 'What budget?', 'history_length': 2}
@@ -0,0 +1,15 @@
+# tests/test_runtime_stats.py
+
+import asyncio
+from runtime_stats import STATS, component_stats, component_stats_async
+
+
+def test_every_component_has_stats(fake_redis):
+    for component in STATS:
+        assert isinstance(component_stats(component), dict)
+        assert isinstance(asyncio.run(component_stats_async(component)), dict)
+
+
+def test_unknown_component_has_none():
+    assert component_stats('sessions') is None
+    assert asyncio.run(component_stats_async('sessions')) is None
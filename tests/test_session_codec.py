@@ -0,0 +1,78 @@
+# tests/test_session_codec.py
+
+import pytest
+import session_codec
+from agent_data_model import AgentDataModel
+from agent_session_manager import AgentSessionManager
+from session_codec import SessionCodec, SCHEMA_VERSION, HEADER_SIZE, MAGIC, CODECS, COMPRESSIONS
+
+
+def optional(name):
+    # msgpack and zstd are only supported when their package is installed
+    if session_codec.OPTIONAL_MODULES.get(name, True) is None:
+        pytest.skip(f"the {name} package is not installed")
+
+
+@pytest.mark.parametrize('codec', ['json', 'msgpack'])
+@pytest.mark.parametrize('compression', ['none', 'zlib', 'zstd'])
+def test_round_trip(codec, compression):
+    optional(codec)
+    optional(compression)
+    encoder = SessionCodec(codec=codec, compression=compression, compression_threshold=10)
+    data_model = AgentDataModel(name='n', session_id='s', chat_history=[{'role': 'user', 'content': 'x' * 100}])
+    encoded = encoder.encode(data_model)
+    assert encoded[:len(MAGIC)] == MAGIC
+    assert list(encoded[len(MAGIC):HEADER_SIZE]) == [SCHEMA_VERSION, CODECS[codec][0], COMPRESSIONS[compression][0]]
+    assert encoder.decode(encoded) == data_model
+
+
+def test_small_payloads_are_not_compressed():
+    codec = SessionCodec(compression='zlib', compression_threshold=10 ** 6)
+    assert codec.encode(AgentDataModel(name='n'))[HEADER_SIZE - 1] == 0
+
+
+def test_unknown_or_missing_formats_are_refused(monkeypatch):
+    with pytest.raises(ValueError):
+        SessionCodec(codec='yaml')
+    with pytest.raises(ValueError):
+        SessionCodec(compression='lz4')
+    monkeypatch.setitem(session_codec.OPTIONAL_MODULES, 'zstd', None)
+    with pytest.raises(ValueError):
+        SessionCodec(compression='zstd')
+    encoded = SessionCodec(compression='none').encode(AgentDataModel(name='n'))
+    with pytest.raises(ValueError):
+        SessionCodec().decode(encoded[:HEADER_SIZE - 1] + bytes([COMPRESSIONS['zstd'][0]]) + encoded[HEADER_SIZE:])
+
+
+def test_fields_of_older_schemas_are_migrated():
+    codec = SessionCodec()
+    encoded = codec.encode_fields({'name': 'n', 'memory_logs': ['dropped']})
+    old = encoded[:len(MAGIC)] + bytes([2]) + encoded[len(MAGIC) + 1:]
+    data_model = codec.decode(old)
+    assert data_model.name == 'n' and data_model.pending_questions == [] and data_model.llm_cost_usd == 0.0
+
+
+def test_newer_schema_is_refused():
+    codec = SessionCodec()
+    encoded = codec.encode(AgentDataModel(name='n'))
+    with pytest.raises(ValueError):
+        codec.decode(encoded[:len(MAGIC)] + bytes([SCHEMA_VERSION + 1]) + encoded[len(MAGIC) + 1:])
+
+
+def test_sessions_expire_sooner_once_their_chain_is_completed(fake_redis):
+    session_manager = AgentSessionManager(ttl_seconds=1000, completed_ttl_seconds=100)
+    data_model = AgentDataModel(name='n', session_id='s1', json_chain={'agents': []})
+    session_manager.save_session(data_model)
+    assert 900 < fake_redis.ttl(session_manager.get_session_key('s1')) <= 1000
+
+    data_model = session_manager.load_session('s1')
+    data_model.json_chain = None
+    session_manager.save_session(data_model)
+    assert 0 < fake_redis.ttl(session_manager.get_session_key('s1')) <= 100
+    assert 0 < fake_redis.ttl(session_manager.get_version_key('s1')) <= 100
+
+
+def test_sessions_without_a_ttl_do_not_expire(fake_redis):
+    session_manager = AgentSessionManager(ttl_seconds=0, completed_ttl_seconds=0)
+    session_manager.save_session(AgentDataModel(name='n', session_id='s1'))
+    assert fake_redis.ttl(session_manager.get_session_key('s1')) == -1
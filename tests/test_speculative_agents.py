@@ -0,0 +1,144 @@
+# tests/test_speculative_agents.py
+
+import json
+import asyncio
+import logging
+import threading
+import pytest
+import planner
+from model_router import record_cost
+from prompts import SYSTEM_PROMPT_AGENT_PLANNER
+
+# Slow runs in the background once the question of Asked is sent, Aggregator needs both
+CHAIN = {'agents': [
+    {'agent_nickname': 'Asked', 'agent_llm_prompt': 'a', 'input_from_agents': [], 'user_questions': ['Which one?']},
+    {'agent_nickname': 'Slow', 'agent_llm_prompt': 's', 'input_from_agents': [], 'user_questions': []},
+    {'agent_nickname': 'Aggregator', 'agent_llm_prompt': 'g', 'input_from_agents': ['Asked', 'Slow']},
+]}
+
+
+class FakeLLM:
+    """
+    Answers the planner with CHAIN and every agent with its nickname; Slow answers once released.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.slow_started = threading.Event()
+        self.release_slow = threading.Event()
+
+    def agent(self, prompt):
+        if prompt.startswith(SYSTEM_PROMPT_AGENT_PLANNER[:80]):
+            return 'planner'
+        return next(
+            agent['agent_nickname'] for agent in CHAIN['agents']
+            if f'your nickname is: "{agent["agent_nickname"]}"' in prompt
+        )
+
+    def answer(self, agent):
+        self.calls.append(agent)
+        # charged to the budget of the session being run, if any
+        record_cost('gpt-4o-mini', 1_000_000, 0)
+        return json.dumps(CHAIN) if agent == 'planner' else f'observation of {agent}'
+
+    def call(self, prompt=None, **kwargs):
+        agent = self.agent(prompt)
+        if agent == 'Slow':
+            self.slow_started.set()
+            assert self.release_slow.wait(5)
+        return self.answer(agent)
+
+    async def call_async(self, prompt=None, **kwargs):
+        agent = self.agent(prompt)
+        if agent == 'Slow':
+            self.slow_started.set()
+            while not self.release_slow.is_set():
+                await asyncio.sleep(0.01)
+        return self.answer(agent)
+
+
+@pytest.fixture
+def llm(fake_redis, monkeypatch):
+    llm = FakeLLM()
+    monkeypatch.setattr(planner, 'call_openai_model', llm.call)
+    monkeypatch.setattr(planner, 'call_openai_model_async', llm.call_async)
+    monkeypatch.setattr(planner, 'SPECULATIVE_POLL_SECONDS', 0.01)
+    return llm
+
+
+def release_later(llm, seconds=0.2):
+    threading.Timer(seconds, llm.release_slow.set).start()
+
+
+def wait_for_background_agents():
+    for thread in threading.enumerate():
+        if thread.name == 'speculative-chain':
+            thread.join(5)
+
+
+def test_answer_turn_waits_for_the_background_agent(llm, fake_redis):
+    first = planner.AgentPlanner([{'role': 'user', 'content': 'plan it'}], session_id='s1', is_interactive=True)
+    first.run_planner()
+    assert first.reply()['assistant'] == 'Which one?'
+    assert llm.slow_started.wait(5)
+    assert fake_redis.get('session_speculation:planner-s1').decode('utf-8') == first.data.chain_id
+
+    release_later(llm)
+    second = planner.AgentPlanner(None, message='the first', session_id='s1', is_interactive=True)
+    assert second.data.speculative_agents == ['Slow']
+    second.run_planner()
+
+    assert llm.calls.count('Slow') == 1
+    assert second.data.final_answer == 'observation of Aggregator'
+    assert not fake_redis.exists('session_speculation:planner-s1')
+    # planner, Asked, Slow (run in the background) and Aggregator
+    assert second.data.llm_cost_usd == pytest.approx(4 * 0.15)
+
+
+def test_background_agent_logs_are_saved(llm, fake_redis, caplog):
+    caplog.set_level(logging.INFO, logger='planner')
+    first = planner.AgentPlanner([{'role': 'user', 'content': 'plan it'}], session_id='s1', is_interactive=True)
+    first.run_planner()
+    release_later(llm, 0)
+    second = planner.AgentPlanner(None, message='the first', session_id='s1', is_interactive=True)
+    second.run_planner()
+    logs = planner.AgentPlanner.load_session_logs('s1', count=1000)
+    assert any('Generated observation for agent Slow' in entry for entry in logs)
+
+
+def test_agent_not_done_within_the_latency_budget_is_run_again(llm, fake_redis, monkeypatch):
+    first = planner.AgentPlanner([{'role': 'user', 'content': 'plan it'}], session_id='s1', is_interactive=True)
+    first.run_planner()
+    assert llm.slow_started.wait(5)
+
+    def call(prompt=None, **kwargs):
+        # the background agent ends once this turn has stopped waiting for it and runs it again
+        if llm.agent(prompt) == 'Slow':
+            llm.release_slow.set()
+        return llm.call(prompt=prompt, **kwargs)
+
+    monkeypatch.setattr(planner, 'call_openai_model', call)
+    second = planner.AgentPlanner(
+        None, message='the first', session_id='s1', is_interactive=True, latency_budget_seconds=0.2
+    )
+    second.run_planner()
+    wait_for_background_agents()
+    assert llm.calls.count('Slow') == 2
+    assert second.data.final_answer == 'observation of Aggregator'
+
+
+def test_answer_turn_waits_for_the_background_task(llm, fake_redis):
+    async def turns():
+        first = await planner.AgentPlanner.create_async([{'role': 'user', 'content': 'plan it'}], session_id='s1', is_interactive=True)
+        await first.run_planner_async()
+        while not llm.slow_started.is_set():
+            await asyncio.sleep(0.01)
+        release_later(llm)
+        second = await planner.AgentPlanner.create_async(None, message='the first', session_id='s1', is_interactive=True)
+        await second.run_planner_async()
+        return second
+
+    second = asyncio.run(turns())
+    assert llm.calls.count('Slow') == 1
+    assert second.data.final_answer == 'observation of Aggregator'
+    assert second.data.llm_cost_usd == pytest.approx(4 * 0.15)
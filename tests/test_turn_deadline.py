@@ -0,0 +1,73 @@
+# tests/test_turn_deadline.py
+
+import time
+import pytest
+import llm_backends
+import planner
+from llm_backends import LocalBackend
+from llm_resilience import ResilientCaller, LatencyTracker, TurnDeadline, DeadlineExceededError, TurnCancelledError, current_turn
+
+
+def run_in_turn(turn, function):
+    token = current_turn.set(turn)
+    try:
+        return function()
+    finally:
+        current_turn.reset(token)
+
+
+def caller():
+    return ResilientCaller(timeout=5, max_retries=0, hedge_enabled=False, tracker=LatencyTracker())
+
+
+def test_critical_calls_may_use_the_reserve():
+    turn = TurnDeadline()
+    turn.set_deadline(100.0, reserve=20.0)
+    assert turn.call_deadline(critical=True) == 100.0
+    assert turn.call_deadline(critical=False) == 80.0
+    assert TurnDeadline().call_deadline(critical=False) is None
+
+
+def test_calls_get_the_deadline_of_their_turn():
+    turn = TurnDeadline()
+    turn.set_deadline(time.monotonic() + 1, reserve=0.5)
+    deadlines = []
+    run_in_turn(turn, lambda: caller().call(lambda deadline: deadlines.append(deadline), 'm'))
+    assert deadlines == [turn.call_deadline(critical=False)]
+
+
+def test_calls_past_the_deadline_of_their_turn_are_not_sent():
+    turn = TurnDeadline()
+    turn.set_deadline(time.monotonic() - 1)
+    with pytest.raises(DeadlineExceededError):
+        run_in_turn(turn, lambda: caller().call(lambda deadline: 'answer', 'm'))
+
+
+def test_calls_of_a_cancelled_turn_are_not_sent():
+    turn = TurnDeadline()
+    turn.cancel('client went away')
+    with pytest.raises(TurnCancelledError, match='client went away'):
+        run_in_turn(turn, lambda: caller().call(lambda deadline: 'answer', 'm'))
+
+
+class SlowAnalysisBackend(LocalBackend):
+    """
+    The local backend, whose Analysis agent answers only after the latency budget of the turn.
+    """
+
+    def complete(self, prompt, model, timeout):
+        if 'your nickname is: "Analysis"' in prompt:
+            time.sleep(timeout)
+            raise llm_backends.LLMTimeoutError("Local backend request timed out")
+        return super().complete(prompt, model, timeout)
+
+
+def test_aggregator_answers_without_the_agents_out_of_time(fake_redis, monkeypatch):
+    monkeypatch.setattr(llm_backends, '_backend', SlowAnalysisBackend(latency=0))
+    turn = planner.AgentPlanner(
+        None, message='plan a trip', session_id='s1', is_interactive=True, latency_budget_seconds=0.4
+    )
+    turn.run_planner()
+    assert turn.missing_agents == ['Analysis']
+    assert turn.data.chain_stats['missing'] == ['Analysis']
+    assert turn.data.final_answer.startswith('Local answer')